@@ -0,0 +1,579 @@
+# pylint: disable=no-member
+"""Micro-benchmarks for print-client hot paths.
+
+Most of these do not need GCP credentials, emulators or a printer; they drive the relevant code in
+main.py against in-process fakes and print their timings to stdout. Run one benchmark with e.g.
+
+    python benchmark.py logging
+
+The native, optimize and render benchmarks need Ghostscript, the subscriber benchmark needs the
+Pub/Sub emulator, and the traffic benchmark replays captured traffic to the emulator for a print
+client that is running against it.
+"""
+import argparse
+import base64
+import datetime
+import gzip
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from unittest import mock
+
+from google.cloud import pubsub_v1  # pylint: disable=no-name-in-module
+
+import main
+
+
+def _timeit(func, iterations):
+    """ returns the mean wall clock time in microseconds for a single call of func """
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations * 10**6
+
+
+class _SlowCloudLogger():
+    # pylint: disable=too-few-public-methods
+    """ stands in for a Stackdriver logger whose batch commits take `latency` seconds """
+    def __init__(self, latency):
+        self.latency = latency
+
+    def batch(self):
+        """ returns a batch whose commit() blocks like a slow network round trip """
+        batch = mock.Mock(entries=[])
+        batch.log_struct.side_effect = lambda **entry: batch.entries.append(entry)
+        batch.commit.side_effect = lambda: time.sleep(self.latency)
+        return batch
+
+
+def bench_logging(args):
+    """ measures the per-message cost of the logging done in the message callback """
+    message = mock.Mock(message_id="1234567890", size=20480,
+                        attributes={"order_number": "1234", "event_date": "1900-01-01"})
+    logger = main.MESSAGE_LOG
+
+    def _eager():
+        logger.debug(f'Received message id: {message.message_id}; size {message.size}')
+        logger.debug(f"Received print message with attributes '{message.attributes}'")
+
+    def _lazy():
+        logger.debug('Received message id: %s; size %s', message.message_id, message.size)
+        logger.debug("Received print message with attributes '%s'", message.attributes)
+
+    root = logging.getLogger()
+    root.handlers = []
+    # the transport's own worker logs would otherwise be fed back into the transport
+    logging.getLogger("google.cloud").propagate = False
+    client = mock.Mock()
+    client.logger.return_value = _SlowCloudLogger(args.latency)
+    transport = main.BoundedBackgroundThreadTransport(client, "python",
+                                                      max_queue_size=args.queue_size)
+    handler = logging.Handler()
+    handler.emit = lambda record: transport.send(record, handler.format(record))
+    root.addHandler(handler)
+
+    root.setLevel(logging.INFO)
+    print(f"DEBUG filtered, eager f-string:     {_timeit(_eager, args.iterations):8.2f} us/msg")
+    print(f"DEBUG filtered, lazy %-format:      {_timeit(_lazy, args.iterations):8.2f} us/msg")
+
+    root.setLevel(logging.DEBUG)
+    print(f"DEBUG shipped, bounded queue:       {_timeit(_lazy, args.iterations):8.2f} us/msg "
+          f"({transport.dropped} dropped)")
+
+    handler.addFilter(main.LOG_SAMPLER)
+    main.LOG_SAMPLER.configure([(main.MESSAGE_LOG.name, 0.1)])
+    print(f"DEBUG shipped, sampled at 0.1:      {_timeit(_lazy, args.iterations):8.2f} us/msg")
+    transport.worker.stop(grace_period=0)
+
+
+def bench_preflight(args):
+    """ measures the cost of preflighting the sample label, with and without the result cache """
+    with open("tests/test_label.pdf", "rb") as pdf:
+        data = pdf.read()
+    limits = {"max_bytes": 5 * 1024 * 1024, "max_pages": 10, "max_image_pixels": 20000000}
+
+    def _uncached():
+        main._PREFLIGHT_CACHE.clear()  # pylint: disable=protected-access
+        main.preflight_pdf(data, **limits)
+
+    def _truncated():
+        main._PREFLIGHT_CACHE.clear()  # pylint: disable=protected-access
+        try:
+            main.preflight_pdf(data[:-100], **limits)
+        except main.PreflightError:
+            pass
+
+    print(f"preflight, uncached:       {_timeit(_uncached, args.iterations):8.2f} us/label")
+    print(f"preflight, cached:         "
+          f"{_timeit(lambda: main.preflight_pdf(data, **limits), args.iterations):8.2f} us/label")
+    print(f"preflight, truncated PDF:  {_timeit(_truncated, args.iterations):8.2f} us/label")
+
+
+def bench_encoding(args):
+    """ compares bytes on the wire and decode time for each supported label content encoding """
+    with open("tests/test_label.pdf", "rb") as pdf:
+        data = pdf.read()
+    encoders = {
+        'base64': base64.b64encode,
+        'binary': lambda pdf: pdf,
+        'gzip': gzip.compress,
+        'zstd': lambda pdf: main.zstandard.ZstdCompressor().compress(pdf),
+    }
+
+    print(f"{'encoding':<10} {'bytes':>8} {'vs PDF':>8} {'decode':>12}")
+    for encoding in main.CONTENT_ENCODINGS:
+        if encoding == 'zstd' and main.zstandard is None:
+            print(f"{encoding:<10} (zstandard is not installed)")
+            continue
+        payload = encoders[encoding](data)
+        assert main.decode_payload(payload, encoding, len(data)) == data
+        decode_us = _timeit(lambda: main.decode_payload(payload, encoding, len(data)),
+                            args.iterations)
+        print(f"{encoding:<10} {len(payload):>8} {len(payload) / len(data):>7.0%} "
+              f"{decode_us:>8.2f} us")
+
+
+def bench_template(args):
+    """ compares the size of a template message with a full PDF, and measures render time """
+    main.ARGS = main.Config(argparse.Namespace(template_dir="templates"))
+    fields = json.dumps({"name": "Smith", "items": ["2x Fish Dinner", "1x Fries"]}).encode()
+    attributes = {"order_number": "1234", "event_date": "1900-01-01", "template_id": "example"}
+    pdf = main.render_label("example", fields, attributes)
+    with open("tests/test_label.pdf", "rb") as label:
+        print(f"base64 PDF message data:   {len(base64.b64encode(label.read())):>8} bytes")
+    print(f"template message data:     {len(fields):>8} bytes")
+    print(f"rendered PDF:              {len(pdf):>8} bytes")
+    render_us = _timeit(lambda: main.render_label('example', fields, attributes), args.iterations)
+    print(f"render from cached template: {render_us:6.2f} us/label")
+
+
+def bench_native(args):
+    """ compares time to first label through Ghostscript rasterization with native passthrough """
+    with open("tests/test_label.pdf", "rb") as pdf:
+        data = pdf.read()
+    main.GHOSTSCRIPT = args.ghostscript
+    if shutil.which(args.ghostscript.strip('"')) is None:
+        print(f"Ghostscript ('{args.ghostscript}') is not installed; see --ghostscript")
+        return
+
+    with tempfile.TemporaryDirectory() as cache_dir, main.WinNamedTempFile() as label:
+        label.write(data)
+        label.close()
+        # mswinpr2 needs a Windows printer, so time rasterizing at label resolution instead
+        rasterize = f'{args.ghostscript} -dBATCH -dNOPAUSE -dSAFER -q -r{args.dpi} ' \
+                    f'-sDEVICE=pbmraw -sOutputFile={os.devnull} "{label.name}"'
+        gs_ms = _timeit(lambda: subprocess.run(rasterize, shell=True, check=True),
+                        args.gs_runs) / 1000
+
+        def _convert():
+            return main.convert_pdf(data, args.native_format, args.dpi, cache_dir, 1)
+
+        first_ms = _timeit(_convert, 1) / 1000
+        native = _convert()
+        cached_ms = _timeit(_convert, args.iterations) / 1000
+
+    print(f"Ghostscript rasterization:          {gs_ms:8.2f} ms/label")
+    print(f"{args.native_format} conversion, first print:      {first_ms:8.2f} ms/label "
+          f"({len(native)} bytes)")
+    print(f"{args.native_format} conversion, cached:           {cached_ms:8.2f} ms/label")
+    if args.printer:
+        send_ms = _timeit(lambda: main.send_raw(args.printer, native, "benchmark"),
+                          args.gs_runs) / 1000
+        print(f"raw send to '{args.printer}':  {send_ms:8.2f} ms/label")
+
+
+def bench_optimize(args):
+    """ compares Ghostscript rasterization time for a label before and after optimize_pdf() """
+    with open(args.label, "rb") as pdf:
+        data = pdf.read()
+    main.GHOSTSCRIPT = args.ghostscript
+    if shutil.which(args.ghostscript.strip('"')) is None:
+        print(f"Ghostscript ('{args.ghostscript}') is not installed; see --ghostscript")
+        return
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        optimize_ms = _timeit(lambda: main.optimize_pdf(data, args.dpi, cache_dir, 1), 1) / 1000
+        optimized = main.optimize_pdf(data, args.dpi, cache_dir, 1)
+
+    for name, label_data in (("original", data), ("optimized", optimized)):
+        with main.WinNamedTempFile() as label:
+            label.write(label_data)
+            label.close()
+            # mswinpr2 needs a Windows printer, so time rasterizing at label resolution instead
+            rasterize = f'{args.ghostscript} -dBATCH -dNOPAUSE -dSAFER -q -r{args.dpi} ' \
+                        f'-dPDFFitPage -sDEVICE=pbmraw -sOutputFile={os.devnull} "{label.name}"'
+            gs_ms = _timeit(lambda: subprocess.run(rasterize, shell=True, check=True),
+                            args.gs_runs) / 1000
+        print(f"{name:9} label: {len(label_data):9} bytes, {gs_ms:8.2f} ms/print")
+    print(f"one-off optimization: {optimize_ms:8.2f} ms")
+
+
+# Ghostscript options to time the render corpus under; see --profile. The print client always
+# prints with -dPDFFitPage, so each profile is timed with it too
+RENDER_PROFILES = {
+    '203': '-r203',
+    '300': '-r300',
+    '203-threads': '-r203 -dNumRenderingThreads=4 -dBandHeight=64',
+}
+
+
+def render_profile(value):
+    """ parses a NAME=OPTIONS Ghostscript profile from the command line """
+    name, _, options = value.partition("=")
+    if not name or not options:
+        raise argparse.ArgumentTypeError(f"'{value}' is not of the form NAME=OPTIONS")
+    return name, options
+
+
+def _photo_pdf(pixels, width=288, height=432):
+    """ returns a one page, 4x6" label PDF filled by a pixels x pixels grayscale image """
+    # random pixels compress (and decompress) about as badly as a photo does
+    image = zlib.compress(os.urandom(pixels * pixels))
+    content = b"q %d 0 0 %d 0 0 cm /Im1 Do Q" % (width, height)
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Contents 4 0 R "
+        b"/Resources << /XObject << /Im1 5 0 R >> >> >>" % (width, height),
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content),
+        b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceGray "
+        b"/BitsPerComponent 8 /Filter /FlateDecode /Length %d >>\nstream\n%s\nendstream" %
+        (pixels, pixels, len(image), image),
+    ]
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    startxref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % \
+        (len(objects) + 1, startxref)
+    return bytes(pdf)
+
+
+def _render_corpus(args, directory):
+    """ returns {name: path} of label PDFs of varying page count and image content, built from
+        the sample label
+    """
+    photos = {}
+    for pixels in (600, 1200, 2400):
+        photos[pixels] = os.path.join(directory, f"photo-{pixels}.pdf")
+        with open(photos[pixels], "wb") as photo:
+            photo.write(_photo_pdf(pixels))
+    parts = {f"label-x{pages}": [args.label] * pages for pages in (1, 2, 4, 8)}
+    parts.update({f"photo-{pixels}": [path] for pixels, path in photos.items()})
+    parts["label-x2+photo-1200"] = [args.label, args.label, photos[1200]]
+
+    corpus = {}
+    for name, inputs in parts.items():
+        if len(inputs) == 1:
+            corpus[name] = inputs[0]
+            continue
+        corpus[name] = os.path.join(directory, f"{name}.pdf")
+        # pdfwrite concatenates the pages of its inputs
+        subprocess.run(f'{args.ghostscript} -dBATCH -dNOPAUSE -dSAFER -q -sDEVICE=pdfwrite '
+                       f'-sOutputFile="{corpus[name]}" ' + " ".join(f'"{path}"' for path in inputs),
+                       shell=True, check=True)
+    return corpus
+
+
+def bench_render(args):
+    """ times rendering a corpus of labels under each Ghostscript profile, and fits a render cost
+        model for each profile that predicts a label's print time from cheap PDF features
+
+    The models are written to --model-out, for the print client's --cost-model. Rendering is to a
+    file output device (--device) rather than a printer, so this runs on Linux too.
+    """
+    if shutil.which(args.ghostscript.strip('"')) is None:
+        print(f"Ghostscript ('{args.ghostscript}') is not installed; see --ghostscript")
+        return
+    profiles = dict(args.profile or RENDER_PROFILES)
+
+    with tempfile.TemporaryDirectory() as directory:
+        corpus = _render_corpus(args, directory)
+        features = {}
+        for name, path in corpus.items():
+            with open(path, "rb") as pdf:
+                features[name] = main.pdf_features(pdf.read())
+        timings = {profile: {} for profile in profiles}
+        for profile, options in profiles.items():
+            for name, path in corpus.items():
+                render = f'{args.ghostscript} -dBATCH -dNOPAUSE -dSAFER -q -dPDFFitPage ' \
+                         f'{options} -sDEVICE={args.device} -sOutputFile={os.devnull} "{path}"'
+                timings[profile][name] = _timeit(
+                    lambda: subprocess.run(render, shell=True, check=True), args.gs_runs) / 10**6
+
+    print(f"{'label':22} {'pages':>5} {'MP':>6}  " + "  ".join(f"{p:>15}" for p in profiles))
+    for name in corpus:
+        print(f"{name:22} {features[name]['pages']:5d} {features[name]['megapixels']:6.2f}  " +
+              "  ".join(f"{timings[profile][name] * 1000:12.1f} ms" for profile in profiles))
+
+    models = {}
+    for profile, options in profiles.items():
+        samples = [(features[name], seconds) for name, seconds in timings[profile].items()]
+        model = main.RenderCostModel.fit(samples, options)
+        error = sum(abs(model.predict_features(features) - seconds)
+                    for features, seconds in samples) / len(samples)
+        models[profile] = {**model.to_dict(), u'corpus_seconds': sum(timings[profile].values()),
+                           u'mean_error_seconds': error}
+        print(f"{profile}: {model.intercept * 1000:.1f} ms + "
+              + " + ".join(f"{coefficient * 1000:.1f} ms/{feature[:-1]}"
+                           for feature, coefficient in model.coefficients.items())
+              + f" (mean error {error * 1000:.1f} ms)")
+    fastest = min(models, key=lambda profile: models[profile][u'corpus_seconds'])
+    print(f"fastest profile: {fastest} ({profiles[fastest]})")
+    with open(args.model_out, "w", encoding="utf-8") as model_file:
+        json.dump({u'version': 1, u'device': args.device, u'fastest': fastest,
+                   u'profiles': models}, model_file, indent=2)
+    print(f"wrote render cost models to {args.model_out}; use with --cost-model")
+
+
+SUBSCRIBER_DEFAULTS = dict(print_slots=5, callback_threads=None, streams=1, keepalive=30,
+                           keepalive_timeout=10, compression='none', max_message_bytes=0)
+
+
+def subscriber_setting(value):
+    """ parses a NAME=VALUE[,NAME=VALUE...] set of print client subscriber settings """
+    setting = {}
+    for pair in value.split(","):
+        name, _, number = pair.partition("=")
+        name = name.strip().replace("-", "_")
+        if name not in SUBSCRIBER_DEFAULTS:
+            raise argparse.ArgumentTypeError(f"'{name}' is not one of "
+                                             f"{', '.join(sorted(SUBSCRIBER_DEFAULTS))}")
+        try:
+            setting[name] = int(number) if number.isdigit() else float(number)
+        except ValueError:
+            setting[name] = number
+    return setting
+
+
+def _first_delivery(subscriber, subscription_path, received):
+    """ returns seconds from opening streaming pulls until the first message arrives """
+    received.clear()
+    started = time.monotonic()
+    futures = main.subscribe(subscriber, subscription_path,
+                             lambda message: (received.append(time.monotonic()), message.ack()))
+    while not received and time.monotonic() - started < 60:
+        time.sleep(0.001)
+    for future in futures:
+        future.cancel()
+    return received[0] - started if received else float("nan")
+
+
+def bench_subscriber(args):
+    """ measures reconnect time and message throughput under each set of subscriber settings
+
+    Each setting gets its own topic and subscription on the Pub/Sub emulator. The reconnect time is
+    from opening new streaming pulls, on a new channel, to the first message being delivered, as
+    after a dropped connection; throughput is with each label taking --work seconds to handle.
+    """
+    if not os.environ.get("PUBSUB_EMULATOR_HOST"):
+        print("PUBSUB_EMULATOR_HOST is not set; subscribers are only benchmarked on the emulator")
+        return
+
+    with open("tests/test_label.pdf", "rb") as pdf:
+        label = base64.b64encode(pdf.read())
+    publisher = pubsub_v1.PublisherClient()
+    admin = pubsub_v1.SubscriberClient()
+    for setting in args.setting or [{}, {"streams": 2}, {"compression": "gzip"},
+                                    {"streams": 4, "callback_threads": 8}]:
+        main.ARGS = main.Config(argparse.Namespace(**{**SUBSCRIBER_DEFAULTS, **setting}))
+        name = f"benchmark-{uuid.uuid4().hex[:8]}"
+        topic_path = publisher.topic_path(args.project, name)
+        subscription_path = admin.subscription_path(args.project, name)
+        publisher.create_topic(topic_path)
+        admin.create_subscription(subscription_path, topic_path)
+        try:
+            received = []
+            reconnects = []
+            for _ in range(args.reconnects):
+                publisher.publish(topic_path, label, order_number="0").result()
+                reconnects.append(_first_delivery(main.subscriber_client(), subscription_path,
+                                                  received))
+
+            for future in [publisher.publish(topic_path, label, order_number=str(order))
+                           for order in range(args.messages)]:
+                future.result()
+            done = threading.Event()
+            received.clear()
+
+            def _callback(message):
+                time.sleep(args.work)
+                message.ack()
+                received.append(time.monotonic())
+                if len(received) >= args.messages:
+                    done.set()
+
+            started = time.monotonic()
+            futures = main.subscribe(main.subscriber_client(), subscription_path, _callback)
+            done.wait(timeout=max(60, args.messages * args.work * 2))
+            for future in futures:
+                future.cancel()
+        finally:
+            admin.delete_subscription(subscription_path)
+            publisher.delete_topic(topic_path)
+
+        elapsed = (received[-1] if received else time.monotonic()) - started
+        reconnect = sorted(reconnects)[len(reconnects) // 2] if reconnects else float("nan")
+        described = ",".join(f"{key}={value}" for key, value in sorted(setting.items()))
+        print(f"{described or 'defaults':40} reconnect {reconnect:6.3f}s"
+              f"  {len(received) / elapsed if elapsed else 0:8.1f} messages/s "
+              f"({len(received)}/{args.messages})")
+
+
+def bench_traffic(args):
+    """ re-publishes captured traffic to the Pub/Sub emulator at its recorded pace (or faster)
+
+    Run a print client against the emulator with e.g. `--fake-printer 0.5 --trace-file traces.jsonl`
+    first; pass the same --trace-file here to report the latency and throughput it achieved.
+    """
+    if not os.environ.get("PUBSUB_EMULATOR_HOST"):
+        print("PUBSUB_EMULATOR_HOST is not set; traffic is only replayed to the Pub/Sub emulator")
+        return
+    if not args.capture:
+        print("--capture is required to replay traffic")
+        return
+
+    with open("tests/test_label.pdf", "rb") as pdf:
+        label = base64.b64encode(pdf.read())
+    publisher = pubsub_v1.PublisherClient()
+    topic_path = publisher.topic_path(args.project, args.topic)
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+    started = time.monotonic()
+    futures = []
+    for record in main.read_capture(args.capture):
+        delay = record["t"] / args.speed - (time.monotonic() - started)
+        if delay > 0:
+            time.sleep(delay)
+        attributes = dict(record["attributes"])
+        if "data" in record:
+            data = base64.b64decode(record["data"])
+        else:
+            # without the captured payload, send the sample label in place of whatever it was
+            data = label
+            for attribute in ("content_encoding", "template_id", "format"):
+                attributes.pop(attribute, None)
+        if args.reprint:
+            attributes["reprint"] = "true"
+        futures.append(publisher.publish(topic_path, data, **attributes))
+    for future in futures:
+        future.result()
+    elapsed = time.monotonic() - started
+    print(f"published {len(futures)} messages in {elapsed:.1f}s "
+          f"({len(futures) / elapsed if elapsed else 0:.1f}/s) at {args.speed}x recorded speed")
+
+    if args.trace_file:
+        time.sleep(args.settle)
+        traces = main.slowest_traces(args.trace_file, len(futures), since=started_at)
+        printed = [trace for trace in traces if trace["outcome"] == "ack"]
+        if len(printed) < 2:
+            print(f"only {len(printed)} traced labels were printed; is the client running?")
+            return
+        durations = sorted(trace["duration"] for trace in printed)
+        p50, p95, p99 = (durations[round(percent / 100 * (len(durations) - 1))]
+                         for percent in (50, 95, 99))
+        published = [datetime.datetime.fromisoformat(trace["publish_time"]).timestamp()
+                     for trace in printed]
+        finished = max(start + trace["duration"] for start, trace in zip(published, printed))
+        print(f"printed {len(printed)} labels at {len(printed) / (finished - min(published)):.2f}"
+              f"/s; latency p50 {p50:.2f}s  p95 {p95:.2f}s  p99 {p99:.2f}s")
+
+
+BENCHMARKS = {
+    'encoding': bench_encoding,
+    'logging': bench_logging,
+    'native': bench_native,
+    'optimize': bench_optimize,
+    'preflight': bench_preflight,
+    'render': bench_render,
+    'subscriber': bench_subscriber,
+    'template': bench_template,
+    'traffic': bench_traffic,
+}
+
+
+def parse_command_line_args(args):
+    """ parses arguments specified on the command line when benchmarks are run """
+    parser = argparse.ArgumentParser(description='Benchmark print-client hot paths')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS),
+                        help='which benchmark to run')
+    parser.add_argument('-i', '--iterations', type=int, default=10000,
+                        help='how many iterations to time (default is 10000)')
+    parser.add_argument('--latency', type=float, default=0.5,
+                        help='simulated Stackdriver round trip in seconds (default is 0.5)')
+    parser.add_argument('--queue-size', type=int, default=1000,
+                        help='bounded log queue size (default is 1000)')
+    parser.add_argument('--ghostscript', default='gs',
+                        help='Ghostscript executable for the native benchmark (default is gs)')
+    parser.add_argument('--gs-runs', type=int, default=10,
+                        help='how many times to run Ghostscript (default is 10)')
+    parser.add_argument('--dpi', type=int, default=203,
+                        help='label printer resolution (default is 203)')
+    parser.add_argument('--native-format', choices=sorted(main.NATIVE_CONVERSIONS), default='zpl',
+                        help='printer language to convert to (default is zpl)')
+    parser.add_argument('--label', default='tests/test_label.pdf',
+                        help='PDF label for the optimize benchmark, and to build the render corpus '
+                             'from (default is the sample label)')
+    parser.add_argument('--profile', type=render_profile, action='append',
+                        metavar='NAME=OPTIONS',
+                        help='Ghostscript options to time the render corpus under (may be '
+                             'repeated; default is a few)')
+    parser.add_argument('--device', default='pbmraw',
+                        help='Ghostscript file output device for the render benchmark (default '
+                             'is pbmraw)')
+    parser.add_argument('--model-out', default='render-cost.json',
+                        help='file to write the fitted render cost models to (default is '
+                             'render-cost.json)')
+    parser.add_argument('--printer',
+                        help='also time sending the converted label raw to this printer')
+    parser.add_argument('--capture',
+                        help='traffic captured by a print client with --capture, to replay')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='how many times faster than recorded to replay traffic (default is 1)')
+    parser.add_argument('--project', default='print-client-123456',
+                        help='emulator project to replay traffic to (default is '
+                             'print-client-123456)')
+    parser.add_argument('--topic', default='print_queue',
+                        help='topic to replay traffic to (default is print_queue)')
+    parser.add_argument('--reprint', action='store_true',
+                        help='mark replayed labels as reprints, so that labels printed by an '
+                             'earlier run are printed again')
+    parser.add_argument('--trace-file',
+                        help='trace file written by the print client, to report latencies from')
+    parser.add_argument('--settle', type=float, default=10,
+                        help='seconds to let the client finish printing before reading its '
+                             'traces (default is 10)')
+    parser.add_argument('--setting', type=subscriber_setting, action='append',
+                        metavar='NAME=VALUE[,NAME=VALUE...]',
+                        help='print client subscriber settings to benchmark, e.g. '
+                             'streams=2,compression=gzip (may be repeated; default is a few)')
+    parser.add_argument('--messages', type=int, default=500,
+                        help='messages to publish for each subscriber setting (default is 500)')
+    parser.add_argument('--reconnects', type=int, default=3,
+                        help='times to reconnect for each subscriber setting (default is 3)')
+    parser.add_argument('--work', type=float, default=0.01,
+                        help='seconds each message takes to handle in the subscriber benchmark '
+                             '(default is 0.01)')
+    parsed_args = parser.parse_args(args)
+    if parsed_args.benchmark == 'native':
+        try:
+            main.check_native_dpi(parsed_args.native_format, parsed_args.dpi)
+        except ValueError as exc:
+            parser.error(f"{exc}; see --dpi")
+    return parsed_args
+
+
+if __name__ == '__main__':  # pragma: no cover
+    ARGS = parse_command_line_args(sys.argv[1:])
+    BENCHMARKS[ARGS.benchmark](ARGS)
@@ -6,173 +6,2762 @@ GOOGLE_APPLICATION_CREDENTIALS -- the path to the service account JSON credentia
 """
 import argparse
 import base64
+import bisect
+import collections
+import concurrent.futures
+import contextlib
 import csv
+import ctypes
+import datetime
+import functools
+import gzip
+import hashlib
+import heapq
+import http.server
+import io
+import itertools
+import json
 import logging
+import logging.handlers
 import os
 import platform
+import queue
+import random
+import re
+import signal
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+import tracemalloc
+import urllib.parse
+import urllib.request
+import uuid
+import zlib
 
+import grpc
 from google import auth
 from google.cloud import firestore, pubsub_v1  # pylint: disable=no-name-in-module
 from google.cloud import logging as stackdriver_logging
+from google.cloud.logging.handlers.transports import BackgroundThreadTransport
+from google.cloud.pubsub_v1.gapic.transports import subscriber_grpc_transport
+from google.protobuf.timestamp_pb2 import Timestamp
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+try:
+    import win32print
+except ImportError:  # pragma: no cover
+    win32print = None
 
 
 ARGS = None
 
+# high-volume, per-message debug logging goes through this logger so it can be sampled separately
+MESSAGE_LOG = logging.getLogger("print_client.message")
+
+
+class Printers():
+    """ Singleton object that fetches list of printers (including default) using `wmic` command"""
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = cls._scan()
+        return cls._instance
+
+    @classmethod
+    def _scan(cls):
+        instance = super(Printers, cls).__new__(cls)
+        # Put any initialization here.
+        instance.printers = []
+        instance.default_printer = None
+        # pylint: disable=unexpected-keyword-arg
+        printer_list_csv = subprocess.check_output("wmic printer get name,default /format:csv",
+                                                   text=True)
+
+        reader = csv.DictReader(printer_list_csv.strip().splitlines(), delimiter=",")
+        for row in reader:
+            logging.debug("detected printer '%s' %s", row['Name'],
+                          "(default)" if row['Default'] == "TRUE" else "")
+            instance.printers.append(row['Name'])
+            # there should only be one default so no worries about overwriting here
+            if row['Default'] == "TRUE":
+                instance.default_printer = row["Name"]
+        return instance
+
+    @classmethod
+    def restore(cls, printers, default_printer):
+        """ seeds the singleton from a state snapshot rather than waiting on a `wmic` scan """
+        instance = super(Printers, cls).__new__(cls)
+        instance.printers = list(printers)
+        instance.default_printer = default_printer
+        cls._instance = instance
+        return instance
+
+    @classmethod
+    def refresh(cls):
+        """ rescans the printers using `wmic`, replacing the singleton """
+        cls._instance = cls._scan()
+        return cls._instance
+
+
+def valid_printer(name):
+    """ this checks to ensure that the printer specified exists
+
+    Arguments:
+    name -- the name of the printer requested
+    """
+    logging.debug("Testing to see if printer '%s' is a valid printer", name)
+    if name not in Printers().printers:  # pylint: disable=no-member
+        raise argparse.ArgumentTypeError(f"'{name}' is not a valid printer name on this system")
+    return name
+
+
+PrinterState = collections.namedtuple('PrinterState', ['online', 'error_state', 'queue_length'])
+
+
+class WmicPrinterBackend():
+    """ Reads spooler state and queue length for a printer using the `wmic` command """
+    @staticmethod
+    def _query(wmic_args):
+        # pylint: disable=unexpected-keyword-arg
+        output = subprocess.check_output(f"wmic {wmic_args} /format:csv", text=True)
+        return list(csv.DictReader(output.strip().splitlines(), delimiter=","))
+
+    def get_state(self, printer):
+        """ returns the PrinterState of the named printer, or None if it can not be found """
+        wql_name = printer.replace("\\", "\\\\").replace("'", "\\'")
+        rows = self._query(f"printer where \"Name='{wql_name}'\" "
+                           f"get Name,WorkOffline,DetectedErrorState")
+        if not rows:
+            return None
+
+        # print job names are of the form '<printer name>, <job id>'
+        jobs = self._query("path Win32_PrintJob get Name")
+        queue_length = len([job for job in jobs if job['Name'].rpartition(',')[0] == printer])
+
+        return PrinterState(online=rows[0]['WorkOffline'] != "TRUE",
+                            error_state=int(rows[0]['DetectedErrorState'] or 0),
+                            queue_length=queue_length)
+
+
+class PrinterReadinessMonitor():
+    """ Periodically checks whether a printer can accept another job.
+
+    While the printer is not ready, callbacks block in `wait_until_ready()` before doing any work.
+    As the subscription's flow control only allows a fixed number of outstanding messages, this
+    stops the client pulling new messages (their leases are extended rather than nacked) until the
+    printer recovers.
+    """
+    # Win32_Printer.DetectedErrorState values that mean a label cannot come out of the printer
+    # (no paper, no toner, door open, jammed, offline, service requested, output bin full)
+    BLOCKING_ERROR_STATES = frozenset([4, 6, 7, 8, 9, 10, 11])
+
+    def __init__(self, printer, backend, max_queue_length=3, interval=5):
+        self.printer = printer
+        self.backend = backend
+        self.max_queue_length = max_queue_length
+        self.interval = interval
+        self._ready = threading.Event()
+        self._ready.set()
+        self._stopped = threading.Event()
+
+    @property
+    def ready(self):
+        """ True if the printer was ready at the last check """
+        return self._ready.is_set()
+
+    def _reason_not_ready(self, state):
+        if not state.online:
+            return "printer is offline"
+        if state.error_state in self.BLOCKING_ERROR_STATES:
+            return f"printer reports error state {state.error_state}"
+        if state.queue_length >= self.max_queue_length:
+            return f"{state.queue_length} jobs are already in the spooler queue"
+        return None
+
+    def check(self):
+        """ polls the printer once, pausing or resuming intake if its readiness has changed """
+        try:
+            state = self.backend.get_state(self.printer)
+        except Exception as exc:  # pylint: disable=broad-except
+            # if we can't tell, don't stop printing; ghostscript will tell us soon enough
+            logging.warning("Could not determine state of printer '%s': %s", self.printer, exc)
+            state = None
+
+        reason = self._reason_not_ready(state) if state is not None else None
+        if reason is None and not self.ready:
+            logging.info("Printer '%s' is ready again; resuming printing", self.printer)
+            self._ready.set()
+        elif reason is not None and self.ready:
+            logging.warning("Pausing printing as printer '%s' is not ready: %s",
+                            self.printer, reason)
+            self._ready.clear()
+        return self.ready
+
+    def wait_until_ready(self, timeout=None):
+        """ blocks until the printer is ready; returns False if timeout seconds elapsed first """
+        return self._ready.wait(timeout)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def start(self):
+        """ checks the printer now and then every `interval` seconds on a background thread """
+        self.check()
+        threading.Thread(target=self._run, name="PrinterReadinessMonitor", daemon=True).start()
+
+    def stop(self):
+        """ stops the background checks and releases any callbacks waiting on the printer """
+        self._stopped.set()
+        self._ready.set()
+
+
+PRINTER_MONITOR = None
+
+
+class WeightedFairScheduler():
+    """ Shares the printer between several subscriptions in proportion to their weights.
+
+    Callbacks take one of `slots` print slots before printing. When a slot frees up it goes to
+    the subscription waiting with the smallest pass, and that subscription's pass then advances by
+    1 / weight (stride scheduling), so over any busy period each subscription gets printer time
+    in proportion to its weight, and a burst on one can't starve the others. A subscription that
+    has been idle starts again from the current pass rather than spending credit saved up while
+    it was idle.
+    """
+    def __init__(self, weights=None, slots=5):
+        self.weights = dict(weights or {})
+        self.slots = slots
+        self._busy = 0
+        self._pass = {}
+        self._virtual_time = 0.0
+        self._waiting = collections.defaultdict(collections.deque)
+        self._condition = threading.Condition()
+        self._waits = collections.defaultdict(lambda: [0, 0.0, 0.0])
+
+    def _next_ticket(self):
+        queue_name = min((name for name, tickets in self._waiting.items() if tickets),
+                         key=lambda name: (self._pass[name], name))
+        return self._waiting[queue_name][0]
+
+    @contextlib.contextmanager
+    def slot(self, queue_name, cost=1.0):
+        """ waits for the subscription's turn at the printer; yields how long that took
+
+        The subscription's pass advances by cost / weight, so with costs in (predicted) seconds
+        of printer time the printer's time is shared rather than its labels.
+        """
+        started = time.perf_counter()
+        ticket = object()
+        with self._condition:
+            if not self._waiting[queue_name]:
+                self._pass[queue_name] = max(self._pass.get(queue_name, 0.0), self._virtual_time)
+            self._waiting[queue_name].append(ticket)
+            self._condition.wait_for(
+                lambda: self._busy < self.slots and self._next_ticket() is ticket)
+            self._waiting[queue_name].popleft()
+            self._busy += 1
+            self._virtual_time = self._pass[queue_name]
+            self._pass[queue_name] += cost / self.weights.get(queue_name, 1.0)
+            waited = time.perf_counter() - started
+            waits = self._waits[queue_name]
+            waits[0] += 1
+            waits[1] += waited
+            waits[2] = max(waits[2], waited)
+            # the next in line may be able to take another free slot
+            self._condition.notify_all()
+        try:
+            yield waited
+        finally:
+            with self._condition:
+                self._busy -= 1
+                self._condition.notify_all()
+
+    def wait_stats(self):
+        """ returns {queue_name: (labels, mean seconds waited, longest seconds waited)} """
+        with self._condition:
+            return {queue_name: (count, total / count, longest)
+                    for queue_name, (count, total, longest) in self._waits.items()}
+
+
+SCHEDULER = WeightedFairScheduler()
+
+
+def log_sample(value):
+    """ parses a 'CATEGORY=RATE' log sampling specification from the command line
+
+    Arguments:
+    value -- string of the form 'print_client.message=0.1'
+    """
+    category, _, rate = value.partition("=")
+    try:
+        rate = float(rate)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is not of the form CATEGORY=RATE")
+    if not category or not 0.0 <= rate <= 1.0:
+        raise argparse.ArgumentTypeError(f"'{value}' must name a category and a rate in [0, 1]")
+    return category, rate
+
+
+def weighted_queue(value):
+    """ parses a 'SUBSCRIPTION[=WEIGHT]' specification from the command line
+
+    Arguments:
+    value -- string of the form 'kitchen=2'
+    """
+    name, _, weight = value.partition("=")
+    try:
+        weight = float(weight or 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is not of the form SUBSCRIPTION=WEIGHT")
+    if not name or weight <= 0:
+        raise argparse.ArgumentTypeError(f"'{value}' must name a subscription and a weight > 0")
+    return name, weight
+
+
+def order_range(value):
+    """ parses an inclusive 'FIRST-LAST' range of order numbers from the command line
+
+    Arguments:
+    value -- string of the form '100-250'
+    """
+    first, _, last = value.partition("-")
+    try:
+        orders = range(int(first), int(last or first) + 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is not of the form FIRST-LAST")
+    if not orders:
+        raise argparse.ArgumentTypeError(f"'{value}' does not contain any order numbers")
+    return orders
+
+
+def timestamp(value):
+    """ parses an ISO 8601 date/time from the command line; naive values are local time
+
+    Arguments:
+    value -- string of the form '2020-02-28T18:30'
+    """
+    try:
+        return datetime.datetime.fromisoformat(value).astimezone(datetime.timezone.utc)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is not an ISO 8601 date and time")
+
+
+class LogSampler(logging.Filter):
+    """ Filter that only passes a fraction of DEBUG records for each configured logger category.
+
+    Sampling is deterministic (every Nth record is kept) so that a rate of 0.1 keeps exactly one
+    record in ten; records above DEBUG level are never sampled away.
+    """
+    def __init__(self):
+        super().__init__()
+        self._keep_every = {}
+        self._counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def configure(self, samples):
+        """ sets the (category, rate) pairs to be sampled, replacing any previous configuration """
+        with self._lock:
+            self._keep_every = {category: (round(1 / rate) if rate else 0)
+                                for category, rate in samples}
+            self._counts.clear()
+
+    def _category(self, name):
+        """ returns the most specific configured category that the logger name falls under """
+        while name:
+            if name in self._keep_every:
+                return name
+            name = name.rpartition(".")[0]
+        return None
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or not self._keep_every:
+            return True
+        category = self._category(record.name)
+        if category is None:
+            return True
+        keep_every = self._keep_every[category]
+        if keep_every == 0:
+            return False
+        with self._lock:
+            count = self._counts[category]
+            self._counts[category] += 1
+        return count % keep_every == 0
+
+
+LOG_SAMPLER = LogSampler()
+
+
+class BoundedBackgroundThreadTransport(BackgroundThreadTransport):
+    """ Stackdriver transport that batches uploads on a background thread through a bounded queue.
+
+    The stock transport queues without limit, so a slow venue network grows memory until the
+    process falls over. Here, once `max_queue_size` entries are waiting the newest entry is dropped
+    (and counted) rather than blocking the thread that is printing labels. Drops are reported as a
+    warning at most every REPORT_INTERVAL seconds, and when the transport is flushed or stopped.
+    """
+    REPORT_INTERVAL = 60
+
+    def __init__(self, client, name, max_queue_size=1000, **kwargs):
+        super().__init__(client, name, **kwargs)
+        self.max_queue_size = max_queue_size
+        self.dropped = 0
+        self._reported = 0
+        self._report_at = 0.0
+        self._lock = threading.Lock()
+
+    def send(self, record, message, **kwargs):  # pylint: disable=arguments-differ
+        with self._lock:
+            # the worker's own queue stays unbounded so its shutdown sentinel can always be enqueued
+            if self.worker._queue.qsize() < self.max_queue_size:  # pylint: disable=protected-access
+                super().send(record, message, **kwargs)
+                return
+            self.dropped += 1
+            now = time.monotonic()
+            report = now >= self._report_at
+            if report:
+                self._report_at = now + self.REPORT_INTERVAL
+        if report:
+            # outside the lock, as the warning is itself sent through this transport
+            self.report_dropped()
+
+    def report_dropped(self):
+        """ logs a warning if entries have been dropped since the last report """
+        with self._lock:
+            dropped, total = self.dropped - self._reported, self.dropped
+            self._reported = total
+        if dropped:
+            logging.warning("Dropped %d log entries as the Stackdriver queue was full (%d in all)",
+                            dropped, total)
+
+    def flush(self):
+        self.report_dropped()
+        super().flush()
+
+
+def setup_logging(log_level):
+    """ configures console and Stackdriver logging according to ARGS
+
+    Arguments:
+    log_level -- the numeric logging level to emit at
+    """
+    logging.basicConfig(level=log_level)
+
+    # also log all messages at level to stackdriver, shipped in batches from a bounded queue
+    stackdriver_client = stackdriver_logging.Client()
+    transport = functools.partial(BoundedBackgroundThreadTransport,
+                                  max_queue_size=ARGS.log_queue_size,
+                                  batch_size=ARGS.log_batch_size)
+    stackdriver_client.setup_logging(log_level=log_level, transport=transport)
+
+    LOG_SAMPLER.configure(ARGS.log_sample)
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(LOG_SAMPLER)
+
+
+class MessageTrace():
+    """ The timeline of one delivery of a message, from being published to being acked or nacked.
+
+    The 'receive' span covers the time from publish until the callback is run; each later span is
+    started by step() and runs until the next step. Acking or nacking the wrapped message (via
+    the `message` attribute) records a final 'ack' or 'nack' span and ends the trace.
+    """
+    def __init__(self, message):
+        self.trace_id = uuid.uuid4().hex
+        self.message_id = str(message.message_id)
+        self.order_number = message.attributes.get("order_number")
+        self.event_date = message.attributes.get("event_date")
+        self.published = message.publish_time.timestamp()
+        self.outcome = None
+        # wall clock time is only read once; spans are timed with the monotonic counter
+        self._wall = time.time()
+        self._counter = time.perf_counter()
+        self.spans = [['receive', self.published, self._wall]]
+        self.message = _TracedMessage(message, self)
+
+    def _now(self):
+        return self._wall + time.perf_counter() - self._counter
+
+    def step(self, name):
+        """ ends the current span and starts the span for the named step """
+        now = self._now()
+        if self.spans[-1][2] is None:
+            self.spans[-1][2] = now
+        self.spans.append([name, now, None])
+
+    def finish(self, outcome=None):
+        """ ends the current span, and the trace with the given outcome if it has none yet """
+        if self.spans[-1][2] is None:
+            self.spans[-1][2] = self._now()
+        if self.outcome is None:
+            self.outcome = outcome
+
+    def to_dict(self):
+        """ returns the trace as a JSON serializable dict, with span times relative to publish """
+        return {
+            u'trace_id': self.trace_id,
+            u'message_id': self.message_id,
+            u'order_number': self.order_number,
+            u'event_date': self.event_date,
+            u'publish_time': datetime.datetime.fromtimestamp(
+                self.published, datetime.timezone.utc).isoformat(),
+            u'duration': round(self.spans[-1][2] - self.published, 6),
+            u'outcome': self.outcome or 'error',
+            u'spans': [{u'name': name, u'start': round(start - self.published, 6),
+                        u'duration': round(end - start, 6)} for name, start, end in self.spans],
+        }
+
+
+class _TracedMessage():
+    """ Wraps a message so that acking or nacking it ends its trace """
+    def __init__(self, message, trace):
+        self._message = message
+        self._trace = trace
+
+    def __getattr__(self, name):
+        return getattr(self._message, name)
+
+    def ack(self):
+        """ acks the message and ends the trace """
+        self._trace.step('ack')
+        self._message.ack()
+        self._trace.finish('ack')
+
+    def nack(self):
+        """ nacks the message and ends the trace """
+        self._trace.step('nack')
+        self._message.nack()
+        self._trace.finish('nack')
+
+
+class TraceFileExporter():
+    """ Appends traces as JSON lines to a file which is rotated once it reaches max_bytes """
+    BACKUPS = 5
+
+    def __init__(self, path, max_bytes):
+        self.handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes,
+                                                            backupCount=self.BACKUPS,
+                                                            encoding='utf-8', delay=True)
+
+    def export(self, trace):
+        """ writes the trace (as returned by MessageTrace.to_dict()) to the file """
+        self.handler.handle(logging.makeLogRecord({
+            'msg': json.dumps(trace, separators=(',', ':')),
+        }))
+
+    def stop(self):
+        """ closes the file """
+        self.handler.close()
+
+
+def _otlp_attributes(values):
+    return [{u'key': key, u'value': {u'stringValue': str(value)}}
+            for key, value in values.items() if value is not None]
+
+
+def otlp_payload(traces):
+    """ returns an OTLP/HTTP JSON request body holding a span tree for each trace """
+    spans = []
+    for trace in traces:
+        published = datetime.datetime.fromisoformat(trace[u'publish_time']).timestamp()
+        root_id = os.urandom(8).hex()
+        spans.append({
+            u'traceId': trace[u'trace_id'],
+            u'spanId': root_id,
+            u'name': 'print_message',
+            u'kind': 5,  # SPAN_KIND_CONSUMER
+            u'startTimeUnixNano': str(int(published * 10**9)),
+            u'endTimeUnixNano': str(int((published + trace[u'duration']) * 10**9)),
+            u'attributes': _otlp_attributes({
+                'messaging.message_id': trace[u'message_id'],
+                'order_number': trace[u'order_number'],
+                'event_date': trace[u'event_date'],
+                'outcome': trace[u'outcome'],
+            }),
+        })
+        for span in trace[u'spans']:
+            start = published + span[u'start']
+            spans.append({
+                u'traceId': trace[u'trace_id'],
+                u'spanId': os.urandom(8).hex(),
+                u'parentSpanId': root_id,
+                u'name': span[u'name'],
+                u'kind': 1,  # SPAN_KIND_INTERNAL
+                u'startTimeUnixNano': str(int(start * 10**9)),
+                u'endTimeUnixNano': str(int((start + span[u'duration']) * 10**9)),
+            })
+    return {u'resourceSpans': [{
+        u'resource': {u'attributes': _otlp_attributes({'service.name': 'print-client',
+                                                       'host.name': platform.node()})},
+        u'scopeSpans': [{u'scope': {u'name': 'print_client'}, u'spans': spans}],
+    }]}
+
+
+class OtlpTraceExporter():
+    """ Ships traces to an OpenTelemetry collector using OTLP/HTTP with JSON encoding.
+
+    Exporting only queues the trace; a background thread posts them in batches so that a slow or
+    unreachable collector never holds up printing. Traces are dropped while the queue is full.
+    """
+    MAX_QUEUE_SIZE = 1000
+    BATCH_SIZE = 100
+
+    def __init__(self, endpoint, timeout=5):
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=self.MAX_QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run, name="OtlpTraceExporter", daemon=True)
+        self._thread.start()
+
+    def export(self, trace):
+        """ queues the trace (as returned by MessageTrace.to_dict()) to be posted """
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        """ posts any queued traces, waiting up to the timeout for the collector """
+        try:
+            self._queue.put(None, timeout=self.timeout)
+        except queue.Full:
+            return
+        self._thread.join(self.timeout)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while batch[-1] is not None and len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            traces = [trace for trace in batch if trace is not None]
+            if traces:
+                self._post(traces)
+            if batch[-1] is None:
+                return
+
+    def _post(self, traces):
+        request = urllib.request.Request(self.endpoint,
+                                         data=json.dumps(otlp_payload(traces)).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout):
+                pass
+        except (OSError, ValueError) as exc:
+            logging.warning("Could not export %d traces to %s: %s", len(traces), self.endpoint,
+                            exc)
+
+
+class TrafficCapture():
+    """ Records the shape of the traffic a print client receives, to replay in load tests.
+
+    Each received message is written as a line of JSON to a gzipped file, holding the seconds since
+    the capture started (so inter-arrival times can be reproduced), the subscription, publish time,
+    attributes and payload size, and the payload itself if `payloads` is set.
+    """
+    VERSION = 1
+    FLUSH_INTERVAL = 100
+
+    def __init__(self, path, payloads=False):
+        self.payloads = payloads
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+        self._started = time.monotonic()
+        self._unflushed = 0
+        self._lock = threading.Lock()
+        self._write({u'version': self.VERSION,
+                     u'started': datetime.datetime.now(datetime.timezone.utc).isoformat()})
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def record(self, message, queue_name):
+        """ records the message's arrival """
+        record = {
+            u't': round(time.monotonic() - self._started, 6),
+            u'queue': queue_name,
+            u'publish_time': message.publish_time.isoformat(),
+            u'size': len(message.data),
+            u'attributes': dict(message.attributes),
+        }
+        if self.payloads:
+            record[u'data'] = base64.b64encode(message.data).decode('ascii')
+        with self._lock:
+            self._write(record)
+            self._unflushed += 1
+            if self._unflushed >= self.FLUSH_INTERVAL:
+                self._file.flush()
+                self._unflushed = 0
+
+    def stop(self):
+        """ finishes the capture file """
+        with self._lock:
+            self._file.close()
+
+
+def read_capture(path):
+    """ yields the messages recorded in a capture file, in the order they arrived
+
+    A capture whose client was killed before it could finish the file is read up to where it was
+    last flushed.
+    """
+    offset = arrived = 0.0
+    with gzip.open(path, 'rt', encoding='utf-8') as capture:
+        try:
+            for line in capture:
+                record = json.loads(line)
+                if u'version' in record:
+                    # each capture appended to the file starts its clock again; play them in turn
+                    offset = arrived
+                    continue
+                arrived = record[u't'] + offset
+                yield {**record, u't': arrived}
+        except (EOFError, OSError, ValueError):
+            return
+
+
+CAPTURE = None
+TRACE_EXPORTERS = []
+
+
+class StatusPublisher():
+    """ Publishes how far behind this client's printer is, so that producers can throttle or
+    reroute labels and front of house can show waiting times.
+
+    Every `interval` seconds a compact JSON status is published to the status topic, holding the
+    labels this client holds (in total and per subscription), the labels printed per second over
+    the last WINDOW seconds, when the printer should get through the labels it holds, and the
+    newest order number printed. A status with the same labels in hand is only republished every
+    HEARTBEAT intervals, so that idle clients are still seen to be alive.
+
+    Labels in hand are those being printed or waiting for the printer, which flow control caps at
+    --callback-threads per subscription. Labels still waiting in a subscription aren't counted
+    (that backlog is its num_undelivered_messages metric in Cloud Monitoring), so the ETA is only
+    for the labels in hand.
+    """
+    WINDOW = 60
+    HEARTBEAT = 6
+
+    def __init__(self, publisher, topic_path, interval=10):
+        self.publisher = publisher
+        self.topic_path = topic_path
+        self.interval = interval
+        self._started = time.monotonic()
+        self._in_hand = collections.Counter()
+        self._printed = collections.deque()
+        self._newest = None
+        self._last_published = None
+        self._unchanged = 0
+        self._stopped = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def received(self, queue_name):
+        """ counts a label that this client now holds """
+        with self._lock:
+            self._in_hand[queue_name] += 1
+
+    def done(self, queue_name):
+        """ counts a label that this client no longer holds, printed or not """
+        with self._lock:
+            self._in_hand[queue_name] -= 1
+
+    def printed(self, event_date, order_number):
+        """ notes a label that has been printed """
+        with self._lock:
+            self._printed.append(time.monotonic())
+            if self._newest is None or (event_date, order_number) > self._newest:
+                self._newest = (event_date, order_number)
+
+    def status(self):
+        """ returns the current status as a dict """
+        now = time.monotonic()
+        with self._lock:
+            while self._printed and self._printed[0] < now - self.WINDOW:
+                self._printed.popleft()
+            queues = {queue_name: count for queue_name, count in self._in_hand.items() if count}
+            rate = len(self._printed) / max(1.0, min(self.WINDOW, now - self._started))
+            newest = self._newest
+        in_hand = sum(queues.values())
+        eta = None
+        if in_hand == 0 or rate > 0:
+            eta = (datetime.datetime.now(datetime.timezone.utc) +
+                   datetime.timedelta(seconds=in_hand / rate if in_hand else 0)).isoformat()
+        return {
+            u'host': platform.node(),
+            u'printers': {str(ARGS.printer): {u'in_hand': in_hand, u'eta': eta}},
+            u'in_hand': in_hand,
+            u'queues': queues,
+            u'rate': round(rate, 2),
+            u'newest': {u'event_date': newest[0], u'order_number': newest[1]} if newest else None,
+        }
+
+    def publish(self, force=False):
+        """ publishes the status, unless it hasn't changed and a heartbeat isn't due """
+        status = self.status()
+        # the rate and ETA drift with time alone, so only what is in hand counts as a change
+        key = (status[u'queues'], status[u'newest'])
+        self._unchanged = 0 if key != self._last_published else self._unchanged + 1
+        if not force and self._unchanged and self._unchanged % self.HEARTBEAT:
+            return
+        self._last_published = key
+        data = json.dumps({**status, u'time': datetime.datetime.now(
+            datetime.timezone.utc).isoformat()}, separators=(',', ':')).encode()
+        future = self.publisher.publish(self.topic_path, data, host=status[u'host'])
+        future.add_done_callback(self._published)
+
+    def _published(self, future):
+        exc = future.exception()
+        if exc is not None:
+            logging.warning("Could not publish status to %s: %s", self.topic_path, exc)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.publish()
+            except Exception as exc:  # pylint: disable=broad-except
+                logging.warning("Could not publish status to %s: %s", self.topic_path, exc)
+
+    def start(self):
+        """ starts publishing the status in the background """
+        self._thread = threading.Thread(target=self._run, name="StatusPublisher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ stops publishing, after publishing a final status """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.publish(force=True)
+
+
+STATUS = None
+
+
+def setup_tracing():
+    """ sets up exporting per-message traces as requested by the --trace-* arguments """
+    stop_tracing()
+    if ARGS.trace_file:
+        TRACE_EXPORTERS.append(TraceFileExporter(ARGS.trace_file, ARGS.trace_file_bytes))
+    if ARGS.trace_endpoint:
+        TRACE_EXPORTERS.append(OtlpTraceExporter(ARGS.trace_endpoint))
+
+
+def stop_tracing():
+    """ flushes and removes all of the trace exporters """
+    while TRACE_EXPORTERS:
+        TRACE_EXPORTERS.pop().stop()
+
+
+def slowest_traces(path, count, since=None, until=None):
+    """ returns the count slowest traces in a trace file and its rotated backups
+
+    Arguments:
+    path -- the --trace-file the traces were exported to
+    count -- how many traces to return, slowest first
+    since, until -- if given, only consider messages published in this (UTC datetime) window
+    """
+    traces = []
+    paths = [path] + [f"{path}.{backup}" for backup in range(1, TraceFileExporter.BACKUPS + 1)]
+    for trace_path in paths:
+        try:
+            with open(trace_path, encoding='utf-8') as trace_file:
+                lines = trace_file.readlines()
+        except FileNotFoundError:
+            continue
+        for line in lines:
+            try:
+                trace = json.loads(line)
+            except ValueError:
+                continue  # a line being written when the client was killed
+            published = datetime.datetime.fromisoformat(trace[u'publish_time'])
+            if (since is None or published >= since) and (until is None or published < until):
+                traces.append(trace)
+    return heapq.nlargest(count, traces, key=lambda trace: trace[u'duration'])
+
+
+def print_slowest(path, count, since=None, until=None):
+    """ writes a table of the slowest traced labels, and where their time went, to stdout """
+    traces = slowest_traces(path, count, since, until)
+    print(f"{len(traces)} slowest labels traced in '{path}'")
+    for trace in traces:
+        spans = sorted(trace[u'spans'], key=lambda span: span[u'duration'], reverse=True)
+        breakdown = ", ".join(f"{span[u'name']} {span[u'duration']:.2f}s" for span in spans[:3])
+        print(f"  {trace[u'publish_time'][:19]}  #{trace[u'order_number']!s:<8} "
+              f"{trace[u'duration']:>8.2f}s  {trace[u'outcome']:<5}  {trace[u'message_id']}  "
+              f"({breakdown})")
+    return traces
+
+
+def parse_command_line_args(args):
+    """ parses arguments specified on the command line when program is run """
+    parser = argparse.ArgumentParser(description='Connect to GCP pub/sub to print labels')
+    parser.add_argument('-p', '--printer', type=valid_printer, default=Printers().default_printer,
+                        help='name of printer to print to (otherwise default printer is used)')
+    parser.add_argument('-n', '--number', choices=['odd', 'even', 'shard', 'all'], default='all',
+                        help='which order numbers to print; shard splits them across all running '
+                             'print clients (default is all)')
+    parser.add_argument('-q', '--queue', dest='queues', type=weighted_queue, action='append',
+                        default=[], metavar='SUBSCRIPTION[=WEIGHT]',
+                        help='subscription to print labels from, and its share of the printer '
+                             'when other subscriptions are busy (may be repeated; default is '
+                             'print_queue=1)')
+    parser.add_argument('--print-slots', type=int, default=5,
+                        help='how many labels may be printing at once (default is 5)')
+    parser.add_argument('--callback-threads', type=int,
+                        help='threads handling labels from each subscription, shared between its '
+                             'streaming pulls; each holds at most one label (default is '
+                             '--print-slots)')
+    parser.add_argument('--streams', type=int, default=1,
+                        help='parallel streaming pulls to open on each subscription (default is 1)')
+    parser.add_argument('--keepalive', type=float, default=30,
+                        help='seconds between gRPC keepalive pings, so that a dropped connection '
+                             'is noticed and reopened (default is 30)')
+    parser.add_argument('--keepalive-timeout', type=float, default=10,
+                        help='seconds to wait for a keepalive ping to be answered before treating '
+                             'the connection as dropped (default is 10)')
+    parser.add_argument('--compression', choices=sorted(GRPC_COMPRESSION), default='none',
+                        help='compression for the gRPC channel to Pub/Sub (default is none)')
+    parser.add_argument('--max-message-bytes', type=int, default=0,
+                        help='largest gRPC message to send or receive (default is no limit)')
+    parser.add_argument('-l', '--log',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                        default='INFO', help='log level for messages to print to console')
+    parser.add_argument('--log-sample', type=log_sample, action='append', default=[],
+                        metavar='CATEGORY=RATE',
+                        help='only ship this fraction of DEBUG messages from a logger category, '
+                             'e.g. print_client.message=0.1 (may be repeated)')
+    parser.add_argument('--log-queue-size', type=int, default=1000,
+                        help='maximum log entries waiting to be shipped to Stackdriver before '
+                             'new entries are dropped (default is 1000)')
+    parser.add_argument('--log-batch-size', type=int, default=50,
+                        help='maximum log entries shipped to Stackdriver per request '
+                             '(default is 50)')
+    parser.add_argument('--readiness-interval', type=float, default=5,
+                        help='seconds between printer readiness checks; 0 disables pausing '
+                             'intake while the printer is not ready (default is 5)')
+    parser.add_argument('--max-spool-queue', type=int, default=3,
+                        help='pause intake while this many jobs are waiting in the spooler '
+                             'queue for the printer (default is 3)')
+    parser.add_argument('--heartbeat-interval', type=float, default=10,
+                        help='seconds between renewing this client\'s shard lease (default is 10)')
+    parser.add_argument('--lease-ttl', type=float, default=30,
+                        help='seconds without a heartbeat before a print client\'s shard is '
+                             'handed to the others (default is 30)')
+    parser.add_argument('--counter-shards', type=int, default=5,
+                        help='number of Firestore documents each printer\'s print counter is '
+                             'spread over (default is 5)')
+    parser.add_argument('--template-dir', default='templates',
+                        help='directory of <template_id>.json label templates (default is '
+                             'templates)')
+    parser.add_argument('--state-file', default=DEFAULT_STATE_FILE,
+                        help='where to snapshot state on shutdown and warm start from on startup; '
+                             'an empty string disables snapshots (default is %(default)s)')
+    parser.add_argument('--drain-timeout', type=float, default=10,
+                        help='seconds to wait for queued log entries to be shipped when shutting '
+                             'down (default is 10)')
+    parser.add_argument('--trace-file', default='',
+                        help='append a JSON trace of the time spent on each step of printing '
+                             'every label to this file (default is not to)')
+    parser.add_argument('--trace-file-bytes', type=int, default=10 * 1024 * 1024,
+                        help='rotate the trace file once it reaches this many bytes, keeping %d '
+                             'old files (default is 10 MiB)' % TraceFileExporter.BACKUPS)
+    parser.add_argument('--trace-endpoint', default='',
+                        help='also export traces to this OTLP/HTTP collector URL, e.g. '
+                             'http://localhost:4318/v1/traces (default is not to)')
+    parser.add_argument('--print-timeout', type=float, default=30,
+                        help='seconds to allow Ghostscript for a label before killing it and '
+                             'retrying the label, plus --print-timeout-per-page for each page; '
+                             'native labels are sent straight to the printer within it '
+                             '(default is 30)')
+    parser.add_argument('--print-timeout-per-page', type=float, default=10,
+                        help='additional seconds to allow Ghostscript per page of the label, '
+                             'unless there is a --cost-model (default is 10)')
+    parser.add_argument('--max-print-attempts', type=int, default=5,
+                        help='quarantine a label once it has failed to print this many times on '
+                             'a ready printer (default is 5)')
+    parser.add_argument('--quarantine-dir', default='quarantine',
+                        help='directory quarantined labels are kept in (default is quarantine)')
+    parser.add_argument('--dead-letter-topic',
+                        help='also publish quarantined labels to this topic (default is not to)')
+    parser.add_argument('--native-format', choices=sorted(NATIVE_CONVERSIONS),
+                        help='convert PDF labels to this printer language once, and send them '
+                             'raw to the printer rather than rasterizing each one with '
+                             'Ghostscript (default is not to)')
+    parser.add_argument('--native-dpi', type=int, default=203,
+                        help='resolution to convert PDF labels at; pcl needs 300 or 600 (default '
+                             'is 203)')
+    parser.add_argument('--native-cache-dir', default='native-cache',
+                        help='directory to cache converted labels in (default is native-cache)')
+    parser.add_argument('--native-cache-size', type=int, default=500,
+                        help='maximum converted labels to cache (default is 500)')
+    parser.add_argument('--cost-model',
+                        help='render cost model written by `python benchmark.py render`, to '
+                             'predict how long each label takes to print when setting timeouts '
+                             'and sharing the printer (default is none)')
+    parser.add_argument('--cost-profile',
+                        help='Ghostscript profile from the cost model to print with (default is '
+                             'the fastest)')
+    parser.add_argument('--optimize', action='store_true',
+                        help='before printing a PDF label with Ghostscript, downsample its images '
+                             'to the printer resolution, subset its fonts and flatten it, caching '
+                             'the result')
+    parser.add_argument('--optimize-dpi', type=int, default=203,
+                        help='printer resolution to downsample images to (default is 203)')
+    parser.add_argument('--optimize-cache-dir', default='optimized-cache',
+                        help='directory to cache optimized labels in (default is optimized-cache)')
+    parser.add_argument('--optimize-cache-size', type=int, default=500,
+                        help='maximum optimized labels to cache (default is 500)')
+    parser.add_argument('--capture', default='',
+                        help='record the timing, attributes and size of every message received '
+                             'to this gzipped file, for replaying as a load test (default is not '
+                             'to)')
+    parser.add_argument('--capture-payloads', action='store_true',
+                        help='also record message payloads in the capture file')
+    parser.add_argument('--watchdog-interval', type=float, default=60,
+                        help='seconds between logging memory, handle and temp file use, and '
+                             'checking them against the limits below (default is 60; 0 is never)')
+    parser.add_argument('--max-rss-mb', type=float, default=0,
+                        help='drain and exit, to be restarted, once using more than this much '
+                             'memory (default is no limit)')
+    parser.add_argument('--max-handles', type=int, default=0,
+                        help='drain and exit, to be restarted, once more than this many handles '
+                             'are open (default is no limit)')
+    parser.add_argument('--max-temp-files', type=int, default=0,
+                        help='drain and exit, to be restarted, once more than this many temp '
+                             'files could not be deleted (default is no limit)')
+    parser.add_argument('--trace-memory', type=int, default=0, metavar='FRAMES',
+                        help='trace Python allocations with tracemalloc, keeping this many stack '
+                             'frames, and log where they grew at each check (default is not to)')
+    parser.add_argument('--status-topic',
+                        help='publish how far behind the printer is to this topic (default is '
+                             'not to)')
+    parser.add_argument('--status-interval', type=float, default=10,
+                        help='seconds between publishing status (default is 10)')
+    parser.add_argument('--fake-printer', type=float, metavar='SECONDS',
+                        help='for load tests: pretend each label takes this long to print, '
+                             'rather than printing it')
+    parser.add_argument('--config', default='',
+                        help='file of command line arguments, one per line, which is reloaded '
+                             'between labels whenever it changes (default is none)')
+    parser.add_argument('--config-interval', type=float, default=2,
+                        help='seconds between checking the config file for changes (default is 2)')
+    parser.add_argument('--admin-port', type=int, default=0,
+                        help='serve GET and POST /config on this port on 127.0.0.1 to inspect '
+                             'and change settings (default is not to)')
+    parser.add_argument('--hot-folder', default='',
+                        help='also print jobs dropped in this folder, as a label file and a '
+                             'JSON file of its attributes (default is none)')
+    parser.add_argument('--hot-folder-interval', type=float, default=0.2,
+                        help='seconds between checking the hot folder for jobs (default is 0.2)')
+    parser.add_argument('--intake-port', type=int, default=0,
+                        help='also print jobs POSTed to /print on this port on 127.0.0.1 '
+                             '(default is not to)')
+    parser.add_argument('--no-preflight', dest='preflight', action='store_false',
+                        help='send labels to ghostscript without first checking they are a '
+                             'complete PDF within the limits below')
+    parser.add_argument('--max-pdf-bytes', type=int, default=5 * 1024 * 1024,
+                        help='discard labels larger than this many bytes (default is 5 MiB)')
+    parser.add_argument('--max-pages', type=int, default=10,
+                        help='discard labels with more than this many pages (default is 10)')
+    parser.add_argument('--max-image-pixels', type=int, default=20000000,
+                        help='discard labels embedding an image with more than this many pixels '
+                             '(default is 20000000)')
+
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND',
+                                       help='run COMMAND instead of listening for labels')
+    replay = subparsers.add_parser('replay', help='reprint labels published since a time or in '
+                                                  'a range of order numbers, then exit')
+    replay.add_argument('--since', type=timestamp,
+                        help='seek the subscription back to this ISO 8601 time (default is as '
+                             'far back as the subscription retains messages)')
+    replay.add_argument('--orders', type=order_range, metavar='FIRST-LAST',
+                        help='only replay this inclusive range of order numbers')
+    replay.add_argument('--reprint', action='store_true',
+                        help='print replayed labels even if they were recorded as printed')
+    replay.add_argument('--rate', type=float, default=1.0,
+                        help='maximum replayed labels to print per second (default is 1)')
+    replay.add_argument('--idle-timeout', type=float, default=15,
+                        help='finish once no messages have arrived for this many seconds '
+                             '(default is 15)')
+    replay.add_argument('--subscription', default='print_queue',
+                        help='subscription to seek and replay; seeking print_queue redelivers '
+                             'to every running print client, so a dedicated subscription with '
+                             'retained acked messages is preferable (default is print_queue)')
+
+    summary = subparsers.add_parser('summary', help='show how many labels have been printed for '
+                                                    'an event by printer and host, then exit')
+    summary.add_argument('event_date', help='the event_date attribute of the labels to summarize')
+
+    slowest = subparsers.add_parser('slowest', help='list the labels that took longest from '
+                                                    'publish to print in --trace-file, then exit')
+    slowest.add_argument('-c', '--count', type=int, default=10,
+                         help='how many labels to list (default is 10)')
+    slowest.add_argument('--since', type=timestamp,
+                         help='only list labels published at or after this ISO 8601 time')
+    slowest.add_argument('--until', type=timestamp,
+                         help='only list labels published before this ISO 8601 time')
+
+    quarantine = subparsers.add_parser('quarantine', help='list, requeue or discard labels '
+                                                          'quarantined after failing to print '
+                                                          'too many times, then exit')
+    quarantine.add_argument('action', nargs='?', choices=['list', 'requeue', 'discard'],
+                            default='list', help='what to do with the labels (default is list)')
+    quarantine.add_argument('message_ids', nargs='*', metavar='MESSAGE_ID',
+                            help='quarantined messages to act on (default is all of them)')
+    quarantine.add_argument('--topic', default='print_queue',
+                            help='topic to requeue labels to (default is print_queue)')
+
+    parsed_args = parser.parse_args(args)
+    parsed_args.queues = parsed_args.queues or [('print_queue', 1.0)]
+    if parsed_args.command == 'slowest' and not parsed_args.trace_file:
+        parser.error("slowest requires --trace-file")
+    if parsed_args.command == 'replay' and parsed_args.since is None and \
+       parsed_args.orders is None:
+        parser.error("replay requires --since and/or --orders")
+    if parsed_args.native_format is not None:
+        try:
+            check_native_dpi(parsed_args.native_format, parsed_args.native_dpi)
+        except ValueError as exc:
+            parser.error(f"{exc}; see --native-dpi")
+    return parsed_args
+
+
+class Config():
+    """ The print client's settings, which can be replaced while it is running.
+
+    Settings are read as attributes, as from the argparse namespace it wraps. A job (one call of
+    the subscription callback) pins the settings current when it starts, so that a replacement
+    takes effect between jobs rather than part way through one.
+    """
+    # settings that can take effect without reconnecting; anything else needs a restart, including
+    # --readiness-interval and a switch to or from --number shard, which decide the monitors
+    # started at startup
+    RELOADABLE = frozenset([
+        'printer', 'number', 'log', 'log_sample', 'max_spool_queue', 'template_dir',
+        'print_timeout', 'print_timeout_per_page', 'max_print_attempts', 'preflight',
+        'max_pdf_bytes', 'max_pages', 'max_image_pixels', 'native_format', 'native_dpi',
+        'optimize', 'optimize_dpi', 'fake_printer',
+    ])
+
+    def __init__(self, args):
+        self._args = args
+        self._pinned = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(getattr(self._pinned, 'args', None) or self._args, name)
+
+    @contextlib.contextmanager
+    def job(self):
+        """ pins the current settings for the calling thread until the job is done """
+        self._pinned.args = self._args
+        try:
+            yield
+        finally:
+            self._pinned.args = None
+
+    def replace(self, args):
+        """ swaps in new settings, keeping the current value of any that can't be reloaded
+
+        Returns the names of the settings that changed.
+        """
+        current = vars(self._args)
+        changed = {name for name, value in vars(args).items() if current.get(name) != value}
+        restart = changed - self.RELOADABLE
+        if 'number' in changed and 'shard' in (current.get('number'), args.number):
+            restart.add('number')  # ShardMembership is only started or stopped at startup
+        for name in restart:
+            logging.warning("Ignoring change to setting '%s' until the next restart", name)
+            setattr(args, name, current.get(name))
+        self._args = args
+        return changed - restart
+
+    def to_dict(self):
+        """ returns the current settings as a JSON serializable dict """
+        plain = (str, int, float, bool, type(None))
+        return {name: value if isinstance(value, plain) else str(value)
+                for name, value in vars(self._args).items()}
+
+
+def apply_config(args):
+    """ replaces the running client's settings with args, between jobs
+
+    Returns the names of the settings that changed.
+    """
+    changed = ARGS.replace(args)
+    if changed:
+        logging.info("Reloaded settings: %s", ", ".join(sorted(changed)))
+    if 'log' in changed:
+        logging.getLogger().setLevel(getattr(logging, ARGS.log))
+    if 'log_sample' in changed:
+        LOG_SAMPLER.configure(ARGS.log_sample)
+    if PRINTER_MONITOR is not None:
+        PRINTER_MONITOR.printer = ARGS.printer
+        PRINTER_MONITOR.max_queue_length = ARGS.max_spool_queue
+        if changed & {'printer', 'max_spool_queue'}:
+            PRINTER_MONITOR.check()
+    return changed
+
+
+class ConfigReloader():
+    """ Reloads settings from a config file whenever it changes, and from a local admin endpoint.
+
+    The config file holds command line arguments, one per line (e.g. `--printer=Zebra ZT410`),
+    which override those the client was started with. `GET /config` on the admin endpoint returns
+    the current settings, and `POST /config` with a JSON list of arguments overrides those from the
+    command line and config file until the next restart.
+    """
+    def __init__(self, base_args, path='', interval=2, admin_port=0):
+        self.base_args = list(base_args)
+        self.path = path
+        self.interval = interval
+        self.admin_port = admin_port
+        self.overrides = []
+        self._mtime = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._server = None
+
+    def _file_args(self):
+        if not self.path:
+            return []
+        try:
+            with open(self.path, encoding='utf-8') as config_file:
+                return [line.strip() for line in config_file if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def reload(self, overrides=None):
+        """ re-reads the config file and applies it, with any new admin overrides
+
+        Returns the names of the settings that changed; raises ValueError if they are invalid.
+        """
+        with self._lock:
+            overrides = self.overrides if overrides is None else list(overrides)
+            file_args = self._file_args()
+            errors = io.StringIO()
+            try:
+                # --help and --version write to stdout, which shouldn't go to the console either
+                with contextlib.redirect_stderr(errors), contextlib.redirect_stdout(io.StringIO()):
+                    args = parse_command_line_args(self.base_args + file_args + overrides)
+            except SystemExit:
+                # argparse has written usage and then the error itself to stderr, if anything
+                lines = errors.getvalue().strip().splitlines()
+                raise ValueError(lines[-1] if lines else "invalid arguments")
+            self.overrides = overrides
+            return apply_config(args)
+
+    def _mtime_changed(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        changed, self._mtime = mtime != self._mtime, mtime
+        return changed
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            if self._mtime_changed():
+                try:
+                    self.reload()
+                except ValueError as exc:
+                    logging.error("Not reloading invalid config file '%s': %s", self.path, exc)
+                except OSError as exc:
+                    # e.g. locked by an editor part way through saving it; try again next time
+                    logging.warning("Could not read config file '%s': %s", self.path, exc)
+                    self._mtime = None
+                except Exception as exc:  # pylint: disable=broad-except
+                    logging.error("Could not reload config file '%s': %s", self.path, exc)
+
+    def start(self):
+        """ watches the config file, and serves the admin endpoint, on background threads """
+        if self.path:
+            self._mtime_changed()
+            threading.Thread(target=self._run, name="ConfigReloader", daemon=True).start()
+        if self.admin_port:
+            self._server = http.server.ThreadingHTTPServer(('127.0.0.1', self.admin_port),
+                                                           _admin_handler(self))
+            threading.Thread(target=self._server.serve_forever, name="AdminEndpoint",
+                             daemon=True).start()
+            logging.info("Admin endpoint listening on http://127.0.0.1:%d/config",
+                         self._server.server_address[1])
+
+    def stop(self):
+        """ stops watching and serving """
+        self._stopped.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def _admin_handler(reloader):
+    """ returns a request handler class for the reloader's admin endpoint """
+    class AdminHandler(http.server.BaseHTTPRequestHandler):
+        """ serves GET and POST /config """
+        def _respond(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            """ returns the current settings """
+            if self.path != '/config':
+                return self._respond(404, {u'error': 'not found'})
+            return self._respond(200, ARGS.to_dict())
+
+        def do_POST(self):  # pylint: disable=invalid-name
+            """ overrides settings with a JSON list of command line arguments """
+            if self.path != '/config':
+                return self._respond(404, {u'error': 'not found'})
+            try:
+                overrides = json.loads(self.rfile.read(int(self.headers['Content-Length'] or 0)))
+                if not isinstance(overrides, list):
+                    raise ValueError("expected a JSON list of arguments")
+                changed = reloader.reload([str(arg) for arg in overrides])
+            except ValueError as exc:
+                return self._respond(400, {u'error': str(exc)})
+            except Exception as exc:  # pylint: disable=broad-except
+                logging.error("Could not apply settings from the admin endpoint: %s", exc)
+                return self._respond(500, {u'error': str(exc)})
+            return self._respond(200, {u'changed': sorted(changed)})
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            logging.debug("Admin endpoint: " + format, *args)
+
+    return AdminHandler
+
+
+CONFIG_RELOADER = None
+
+# the scheduler queue for jobs taken locally rather than from a subscription
+LOCAL_QUEUE = 'local'
+
+
+class LocalMessage():
+    """ A print job taken locally, which quacks enough like a Pub/Sub message to be printed by
+    received_message_to_print(). Acking or nacking it records the outcome.
+    """
+    def __init__(self, data, attributes, message_id=None):
+        self.data = data
+        self.attributes = {str(name): str(value) for name, value in attributes.items()}
+        self.message_id = message_id or f"local-{uuid.uuid4().hex}"
+        self.publish_time = datetime.datetime.now(datetime.timezone.utc)
+        self.size = len(data)
+        self.outcome = None
+
+    def ack(self):
+        """ records that the job is done with (printed, a duplicate or unprintable) """
+        self.outcome = 'ack'
+
+    def nack(self):
+        """ records that the job should be tried again """
+        self.outcome = 'nack'
+
+
+class LocalIntake():
+    """ Takes print jobs from a hot folder and a loopback HTTP endpoint, alongside Pub/Sub.
+
+    Local jobs carry the same attributes as print messages and go through the same validation,
+    dedup, printing and recording, but skip the round trip to Pub/Sub, so a reprint asked for at
+    the counter prints straight away, even while the internet is down. Their label data is taken
+    as is unless a content_encoding attribute says otherwise.
+
+    A hot folder job is a label file (e.g. `1234.pdf`) and a JSON object of its attributes beside
+    it, named after it (`1234.pdf.json`) and written once the label is complete; any other `.json`
+    file, such as a template's fields, is left alone. Both are deleted once the job is done with; a
+    job that should be retried is left for a later poll. The endpoint takes `POST /print` with the
+    label as the body and its attributes as the query string, and responds once the job is done
+    with. A job for an order number this client doesn't print (see --number) is rejected: its
+    attributes file is renamed `.invalid`, or the endpoint responds 422.
+    """
+    RETRY_DELAY = 3
+
+    def __init__(self, hot_folder='', interval=0.2, port=0):
+        self.hot_folder = hot_folder
+        self.interval = interval
+        self.port = port
+        self._stopped = threading.Event()
+        self._executor = None
+        self._server = None
+        self._active = set()
+        self._retry_at = {}
+        self._lock = threading.Lock()
+
+    def _poll(self):
+        """ starts printing any jobs that have appeared in the hot folder """
+        try:
+            names = os.listdir(self.hot_folder)
+        except OSError as exc:
+            logging.warning("Could not list hot folder '%s': %s", self.hot_folder, exc)
+            return
+        now = time.monotonic()
+        with self._lock:
+            if self._stopped.is_set():
+                return
+            labels = set(names)
+            for name in sorted(names):
+                # a .json file is only a job's attributes beside its label; others, such as a
+                # template's fields, are left alone
+                if not name.endswith('.json') or name[:-len('.json')] not in labels or \
+                   name in self._active or self._retry_at.get(name, 0) > now:
+                    continue
+                self._active.add(name)
+                self._executor.submit(self._print_file, name)
+
+    def _print_file(self, name):
+        """ prints the hot folder job whose attributes are in the file called name """
+        attributes_path = os.path.join(self.hot_folder, name)
+        label_path = attributes_path[:-len('.json')]
+        message_id = f"hot-folder-{os.path.basename(label_path)}"
+        try:
+            try:
+                with open(attributes_path, encoding='utf-8') as attributes_file:
+                    attributes = json.load(attributes_file)
+                if not isinstance(attributes, dict):
+                    raise ValueError("expected a JSON object of attributes")
+                with open(label_path, 'rb') as label_file:
+                    data = label_file.read()
+            except (OSError, ValueError) as exc:
+                # set it aside, rather than trying it again on every poll
+                logging.error("Could not read hot folder job '%s': %s", attributes_path, exc)
+                os.replace(attributes_path, f"{attributes_path}.invalid")
+                PRINT_FAILURES.forget(message_id)
+                return
+            attributes.setdefault('content_encoding', 'binary')
+            message = LocalMessage(data, attributes, message_id=message_id)
+            misdirected = _misdirected(message)
+            if misdirected:
+                # no later poll would print it either
+                logging.error("Setting aside hot folder job '%s': %s", attributes_path,
+                              misdirected)
+                os.replace(attributes_path, f"{attributes_path}.invalid")
+                PRINT_FAILURES.forget(message_id)
+                return
+            received_message_to_print(message, queue_name=LOCAL_QUEUE)
+            if message.outcome == 'ack':
+                for path in (attributes_path, label_path):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.unlink(path)
+                self._retry_at.pop(name, None)
+                # a later job dropped with the same file name starts counting failures afresh
+                PRINT_FAILURES.forget(message_id)
+            else:
+                self._retry_at[name] = time.monotonic() + self.RETRY_DELAY
+        except Exception as exc:  # pylint: disable=broad-except
+            logging.error("Unexpected error printing hot folder job '%s': %s", attributes_path,
+                          exc)
+            self._retry_at[name] = time.monotonic() + self.RETRY_DELAY
+        finally:
+            with self._lock:
+                self._active.discard(name)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._poll()
+
+    def start(self):
+        """ watches the hot folder, and serves the endpoint, on background threads """
+        if self.hot_folder:
+            os.makedirs(self.hot_folder, exist_ok=True)
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=ARGS.callback_threads or ARGS.print_slots,
+                thread_name_prefix="HotFolder")
+            threading.Thread(target=self._run, name="HotFolderWatcher", daemon=True).start()
+            logging.info("Printing jobs dropped in hot folder '%s'", self.hot_folder)
+        if self.port:
+            self._server = http.server.ThreadingHTTPServer(('127.0.0.1', self.port),
+                                                           _intake_handler())
+            threading.Thread(target=self._server.serve_forever, name="IntakeEndpoint",
+                             daemon=True).start()
+            logging.info("Intake endpoint listening on http://127.0.0.1:%d/print",
+                         self._server.server_address[1])
+
+    def stop(self):
+        """ stops taking jobs, and waits for those being printed to finish """
+        with self._lock:
+            self._stopped.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+
+def _misdirected(message):
+    """ returns why a local job is not this client's to print, or None if it is
+
+    Pub/Sub redelivers a nack'd message to another client, but a local job would only come back
+    here, so it is rejected rather than retried.
+    """
+    try:
+        order_number = int(message.attributes.get("order_number"))
+    except (TypeError, ValueError):
+        return None  # rejected by validation instead
+    if is_our_order_number(order_number):
+        return None
+    return (f"order number {order_number} is not this client's order; "
+            f"it only prints {ARGS.number} numbers")
+
+
+def _intake_handler():
+    """ returns a request handler class for the local intake endpoint """
+    class IntakeHandler(http.server.BaseHTTPRequestHandler):
+        """ serves POST /print """
+        def _respond(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):  # pylint: disable=invalid-name
+            """ prints the label in the body, with the attributes in the query string """
+            path, _, query = self.path.partition('?')
+            if path != '/print':
+                return self._respond(404, {u'error': 'not found'})
+            attributes = dict(urllib.parse.parse_qsl(query))
+            attributes.setdefault('content_encoding', 'binary')
+            message = LocalMessage(self.rfile.read(int(self.headers['Content-Length'] or 0)),
+                                   attributes)
+            try:
+                validate_message_attributes(message)
+            except (TypeError, ValueError) as exc:
+                return self._respond(400, {u'error': str(exc) or 'invalid attributes'})
+            misdirected = _misdirected(message)
+            if misdirected:
+                return self._respond(422, {u'error': misdirected})
+            received_message_to_print(message, queue_name=LOCAL_QUEUE)
+            # a job that wasn't done with can be sent again, as with a nack'd message
+            return self._respond(200 if message.outcome == 'ack' else 503,
+                                 {u'message_id': message.message_id, u'outcome': message.outcome})
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            logging.debug("Intake endpoint: " + format, *args)
+
+    return IntakeHandler
+
+
+LOCAL_INTAKE = None
+DEFAULT_STATE_FILE = 'print-client-state.json.gz'
+STATE_VERSION = 2
+
+# set when the client has been asked to stop; callbacks release their message rather than print
+SHUTDOWN = threading.Event()
+
+
+def state_file_from(args):
+    """ returns the --state-file given in args, which is needed before they can be fully parsed """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--state-file', default=DEFAULT_STATE_FILE)
+    return parser.parse_known_args(args)[0].state_file
+
+
+def save_state(path, subscription_paths):
+    """ writes a compact (gzipped JSON) snapshot of what the client has learned while running
+
+    This holds the printer list, the subscriptions that were verified to exist, the order numbers
+    printed for recent events, and preflight results, so that a restarted client can start
+    printing without rediscovering them.
+    """
+    printers = Printers()
+    with _PREFLIGHT_LOCK:
+        preflight = [[digest.hex(), *limits, problem]
+                     for (digest, *limits), problem in _PREFLIGHT_CACHE.items()]
+    state = {
+        u'version': STATE_VERSION,
+        u'saved_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        u'printers': {u'printers': list(printers.printers),
+                      u'default_printer': printers.default_printer},
+        u'subscriptions': sorted(subscription_paths),
+        u'printed_orders': PRINTED_ORDERS.to_dict(),
+        u'preflight': preflight,
+    }
+    temp_path = f"{path}.tmp"
+    with gzip.open(temp_path, 'wt', encoding='utf-8') as state_file:
+        json.dump(state, state_file, separators=(',', ':'))
+    os.replace(temp_path, path)
+    logging.info("Saved state snapshot to '%s'", path)
+
+
+def load_state(path):
+    """ returns the state snapshot saved at path, or None if there is no usable snapshot """
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as state_file:
+            state = json.load(state_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, ValueError) as exc:
+        logging.warning("Ignoring unreadable state snapshot '%s': %s", path, exc)
+        return None
+    if not isinstance(state, dict) or state.get(u'version') != STATE_VERSION:
+        logging.warning("Ignoring state snapshot '%s' from another version", path)
+        return None
+    return state
+
+
+def restore_state(state):
+    """ warms the client's caches from a snapshot returned by load_state() """
+    global PRINTED_ORDERS  # pylint: disable=global-statement
+    Printers.restore(**state[u'printers'])
+    PRINTED_ORDERS = PrintedOrders(state[u'printed_orders'])
+    with _PREFLIGHT_LOCK:
+        for digest, max_bytes, max_pages, max_image_pixels, problem in state[u'preflight']:
+            _PREFLIGHT_CACHE[(bytes.fromhex(digest), max_bytes, max_pages,
+                              max_image_pixels)] = problem
+
+
+def validate_state(subscriber, gcp_project, subscription_paths):
+    """ checks, in the background, what was assumed from a state snapshot at startup
+
+    If a subscription has since been deleted we shut down, as we would have at startup; if the
+    printer has gone we keep trying, as printing will fail (and be retried) until it comes back.
+    """
+    try:
+        if ARGS.printer not in Printers.refresh().printers:
+            logging.error("Printer '%s' is no longer installed on this system", ARGS.printer)
+        subscriptions = subscriber.list_subscriptions("projects/%s" % gcp_project)
+        missing = set(subscription_paths) - {x.name for x in subscriptions}
+        if missing:
+            logging.error("Subscriptions %s do not exist; shutting down", sorted(missing))
+            SHUTDOWN.set()
+    except Exception as exc:  # pylint: disable=broad-except
+        logging.warning("Could not validate state snapshot: %s", exc)
+
+
+def request_shutdown(signum, _frame):
+    """ signal handler that asks the main loop to drain and exit """
+    logging.info("Received signal %d; shutting down once in-flight labels are done", signum)
+    SHUTDOWN.set()
+
+
+def install_signal_handlers():
+    """ routes SIGINT, SIGTERM and (on Windows) CTRL_BREAK to request_shutdown()
+
+    Returns the previous handlers, to be passed to restore_signal_handlers().
+    """
+    signals = [signal.SIGINT, signal.SIGTERM, getattr(signal, 'SIGBREAK', None)]
+    return {signum: signal.signal(signum, request_shutdown) for signum in signals if signum}
+
+
+def restore_signal_handlers(previous):
+    """ puts back the handlers returned by install_signal_handlers() """
+    for signum, handler in previous.items():
+        signal.signal(signum, handler)
+
+
+# the exit code after recycling, so that `docker run --restart on-failure` starts a fresh client
+RECYCLE_EXIT_CODE = 75
+RECYCLE = threading.Event()
+
+
+def request_recycle(reason):
+    """ asks the main loop to drain and exit, for the client to be restarted afresh """
+    logging.warning("Recycling the print client once in-flight labels are done: %s", reason)
+    RECYCLE.set()
+    SHUTDOWN.set()
+
+
+if os.name == 'nt':
+    class _ProcessMemoryCounters(ctypes.Structure):
+        # pylint: disable=too-few-public-methods
+        """ PROCESS_MEMORY_COUNTERS, as filled in by GetProcessMemoryInfo() """
+        _fields_ = [('cb', ctypes.c_ulong), ('PageFaultCount', ctypes.c_ulong)] + \
+                   [(name, ctypes.c_size_t) for name in (
+                       'PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage',
+                       'QuotaPagedPoolUsage', 'QuotaPeakNonPagedPoolUsage',
+                       'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage')]
+
+
+def process_usage():
+    """ returns (resident memory in bytes, open handles) for this process; either is None where
+        it can't be measured
+    """
+    if os.name == 'nt':
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        counters = _ProcessMemoryCounters(cb=ctypes.sizeof(_ProcessMemoryCounters))
+        handles = ctypes.c_ulong()
+        rss = counters.WorkingSetSize if ctypes.windll.psapi.GetProcessMemoryInfo(
+            process, ctypes.byref(counters), counters.cb) else None
+        return rss, handles.value if ctypes.windll.kernel32.GetProcessHandleCount(
+            process, ctypes.byref(handles)) else None
+    try:
+        with open('/proc/self/statm') as statm:
+            rss = int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        return rss, len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None, None
+
+
+class MemoryWatchdog():
+    """ Keeps an eye on resources that could build up over a weekend of unattended printing.
+
+    Every `interval` seconds the resident memory, open handles and temp files left behind are
+    logged, with their growth since the client started, and left-behind temp files are deleted
+    if they can be. With `trace_frames`, tracemalloc also traces Python allocations, and the
+    lines whose allocations grew the most since the last check are logged. Once any of the
+    (non-zero) limits is crossed, the client drains and exits to be restarted afresh.
+    """
+    TOP_LINES = 10
+
+    def __init__(self, interval=60, max_rss_mb=0, max_handles=0, max_temp_files=0,
+                 trace_frames=0):
+        self.interval = interval
+        self.max_rss_mb = max_rss_mb
+        self.max_handles = max_handles
+        self.max_temp_files = max_temp_files
+        self.trace_frames = trace_frames
+        self.baseline = None
+        self._snapshot = None
+        self._stopped = threading.Event()
+
+    def check(self):
+        """ logs resource usage, and asks for a recycle if it is over a limit
+
+        Returns (resident memory in bytes, open handles, temp files left behind).
+        """
+        left_behind = WinNamedTempFile.left_behind()
+        for path in left_behind:
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+        temp_files = len(WinNamedTempFile.left_behind())
+        rss, handles = process_usage()
+        if self.baseline is None:
+            self.baseline = (rss, handles)
+        mb = 1024 * 1024
+        logging.info("Using %s MB of memory (%+.1f MB since starting), %s handles (%+d), and %d "
+                     "temp files left behind", f"{rss / mb:.1f}" if rss else "?",
+                     (rss - self.baseline[0]) / mb if rss else 0.0, handles or "?",
+                     handles - self.baseline[1] if handles else 0, temp_files)
+
+        if self.trace_frames and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            if self._snapshot is not None:
+                for stat in snapshot.compare_to(self._snapshot, 'lineno')[:self.TOP_LINES]:
+                    logging.info("Allocations grew: %s", stat)
+            self._snapshot = snapshot
+
+        for value, limit, description in ((rss and rss / mb, self.max_rss_mb, "MB of memory"),
+                                          (handles, self.max_handles, "open handles"),
+                                          (temp_files, self.max_temp_files, "temp files")):
+            if limit and value and value > limit:
+                request_recycle(f"{value:.0f} {description} is over the limit of {limit}")
+                break
+        return rss, handles, temp_files
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception as exc:  # pylint: disable=broad-except
+                logging.warning("Could not check memory use: %s", exc)
+
+    def start(self):
+        """ starts checking in the background """
+        if self.trace_frames:
+            tracemalloc.start(self.trace_frames)
+        self.check()
+        threading.Thread(target=self._run, name="MemoryWatchdog", daemon=True).start()
+
+    def stop(self):
+        """ stops checking """
+        self._stopped.set()
+        if self.trace_frames:
+            tracemalloc.stop()
+
+
+WATCHDOG = None
+
+
+GRPC_COMPRESSION = {
+    'none': grpc.Compression.NoCompression,
+    'gzip': grpc.Compression.Gzip,
+    'deflate': grpc.Compression.Deflate,
+}
+
+
+def subscriber_client(credentials=None):
+    """ returns a subscriber client whose gRPC channel uses the keepalive, compression and message
+        size settings
+    """
+    max_message_bytes = ARGS.max_message_bytes or -1
+    options = [
+        ('grpc.max_send_message_length', max_message_bytes),
+        ('grpc.max_receive_message_length', max_message_bytes),
+        ('grpc.keepalive_time_ms', int(ARGS.keepalive * 1000)),
+        ('grpc.keepalive_timeout_ms', int(ARGS.keepalive_timeout * 1000)),
+    ]
+    compression = GRPC_COMPRESSION[ARGS.compression]
+    emulator_host = os.environ.get('PUBSUB_EMULATOR_HOST')
+    if emulator_host:
+        channel = grpc.insecure_channel(emulator_host, options=options, compression=compression)
+    else:
+        channel = subscriber_grpc_transport.SubscriberGrpcTransport.create_channel(
+            credentials=credentials, options=options, compression=compression)
+    # passing a transport stops the client library replacing the channel with its own
+    return pubsub_v1.SubscriberClient(
+        transport=subscriber_grpc_transport.SubscriberGrpcTransport(channel=channel))
+
+
+def subscribe(subscriber, subscription_path, callback):
+    """ opens --streams streaming pulls on the subscription, with --callback-threads between them
+
+    Each streaming pull gets its own bounded thread pool, and leases no more messages than it has
+    threads, so labels are not held by this client while no thread is free to print them.
+
+    Returns the streaming pull futures.
+    """
+    threads = ARGS.callback_threads or ARGS.print_slots
+    streams = max(1, min(ARGS.streams, threads))
+    futures = []
+    for stream in range(streams):
+        # share the threads out, giving any remainder to the first streams
+        stream_threads = threads // streams + (stream < threads % streams)
+        name = subscription_path.rsplit('/', 1)[-1]
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=stream_threads, thread_name_prefix=f"PrintCallback-{name}-{stream}")
+        futures.append(subscriber.subscribe(
+            subscription_path, callback=callback,
+            flow_control=pubsub_v1.types.FlowControl(max_messages=stream_threads),
+            scheduler=pubsub_v1.subscriber.scheduler.ThreadScheduler(executor)))
+    return futures
+
+
+def drain(streaming_pull_futures, state_file, subscription_paths):
+    """ stops intake, finishes or releases in-flight labels, flushes writes and snapshots state """
+    logging.info("Draining in-flight labels before shutting down")
+    SHUTDOWN.set()
+    if CONFIG_RELOADER is not None:
+        CONFIG_RELOADER.stop()
+    # callbacks waiting on the printer will now nack their message for another client to print
+    if PRINTER_MONITOR is not None:
+        PRINTER_MONITOR.stop()
+    # stops pulling, drops callbacks that have not started (their messages will be redelivered)
+    # and waits for the ones that are printing to finish
+    for streaming_pull_future in streaming_pull_futures:
+        streaming_pull_future.cancel()
+    if LOCAL_INTAKE is not None:
+        LOCAL_INTAKE.stop()
+    if WATCHDOG is not None:
+        WATCHDOG.stop()
+    if STATUS is not None:
+        # lets producers know this client has nothing left in hand
+        STATUS.stop()
+    stop_tracing()
+    if CAPTURE is not None:
+        CAPTURE.stop()
+    if SHARD_MEMBERSHIP is not None:
+        SHARD_MEMBERSHIP.stop()
+    for queue_name, (count, mean, longest) in sorted(SCHEDULER.wait_stats().items()):
+        logging.info("Labels from %s waited %.2fs on average (%.2fs at most) for the printer, "
+                     "over %d labels", queue_name, mean, longest, count)
+
+    if state_file:
+        try:
+            save_state(state_file, subscription_paths)
+        except OSError as exc:
+            logging.warning("Could not save state snapshot to '%s': %s", state_file, exc)
+
+    for handler in logging.getLogger().handlers:
+        transport = getattr(handler, 'transport', None)
+        if isinstance(transport, BoundedBackgroundThreadTransport):
+            transport.report_dropped()
+        if transport is not None:
+            transport.worker.stop(grace_period=ARGS.drain_timeout)
+        handler.flush()
+
+
+def main(args):
+    """ main program flow """
+
+    assert ('Windows' in platform.system()), "This program only runs on Windows!"
+
+    if os.environ.get('GOOGLE_APPLICATION_CREDENTIALS', None) is None:
+        raise RuntimeError("GOOGLE_APPLICATION_CREDENTIALS environment variable not set")
+
+    credentials, gcp_project = auth.default()
+
+    SHUTDOWN.clear()
+    RECYCLE.clear()
+    state = load_state(state_file_from(args))
+    if state is not None:
+        restore_state(state)
+
+    global ARGS  # pylint: disable=global-statement
+    ARGS = Config(parse_command_line_args(args))
+
+    setup_logging(getattr(logging, ARGS.log, None))
+
+    if ARGS.command == 'summary':
+        return print_summary(ARGS.event_date)
+    if ARGS.command == 'slowest':
+        return print_slowest(ARGS.trace_file, ARGS.count, ARGS.since, ARGS.until)
+
+    if ARGS.command == 'quarantine':
+        publisher = topic_path = None
+        if ARGS.action == 'requeue':
+            publisher = pubsub_v1.PublisherClient()
+            topic_path = publisher.topic_path(gcp_project, ARGS.topic)
+        return manage_quarantine(ARGS.action, ARGS.message_ids, publisher, topic_path)
+
+    setup_tracing()
+    global COST_MODEL  # pylint: disable=global-statement
+    COST_MODEL = None
+    if ARGS.cost_model:
+        try:
+            COST_MODEL = RenderCostModel.load(ARGS.cost_model, ARGS.cost_profile)
+        except (OSError, ValueError, KeyError) as exc:
+            logging.warning("Not using render cost model '%s': %s", ARGS.cost_model, exc)
+    global CAPTURE  # pylint: disable=global-statement
+    # opened once the client is set up, so that failing to start doesn't leave the capture open
+    CAPTURE = None
+
+    queues = dict([(ARGS.subscription, 1.0)] if ARGS.command == 'replay' else ARGS.queues)
+    subscriber = subscriber_client(credentials)
+    subscription_paths = {name: subscriber.subscription_path(gcp_project, name) for name in queues}
+
+    if state is not None and state[u'subscriptions'] == sorted(subscription_paths.values()):
+        # start printing straight away, and check what the snapshot told us in the background
+        threading.Thread(target=validate_state,
+                         args=(subscriber, gcp_project, list(subscription_paths.values())),
+                         name="ValidateState", daemon=True).start()
+    else:
+        subscriptions = [x.name for x in
+                         subscriber.list_subscriptions("projects/%s" % gcp_project)]
+        for subscription_name, subscription_path in subscription_paths.items():
+            if subscription_path not in subscriptions:
+                logging.error("The subscription named '%s' in GCP Project '%s' must exist before "
+                              "this program can be run!", subscription_name, gcp_project)
+                raise RuntimeError("Subscription %s does not exist" % subscription_path)
+
+    global SCHEDULER  # pylint: disable=global-statement
+    SCHEDULER = WeightedFairScheduler(queues, slots=ARGS.print_slots)
+
+    global PRINTER_MONITOR  # pylint: disable=global-statement
+    if PRINTER_MONITOR is not None:
+        PRINTER_MONITOR.stop()
+    PRINTER_MONITOR = None
+    if ARGS.readiness_interval > 0 and ARGS.fake_printer is None:
+        PRINTER_MONITOR = PrinterReadinessMonitor(ARGS.printer, WmicPrinterBackend(),
+                                                  max_queue_length=ARGS.max_spool_queue,
+                                                  interval=ARGS.readiness_interval)
+        PRINTER_MONITOR.start()
+
+    global DEAD_LETTER  # pylint: disable=global-statement
+    DEAD_LETTER = None
+    if ARGS.dead_letter_topic:
+        publisher = pubsub_v1.PublisherClient()
+        DEAD_LETTER = (publisher, publisher.topic_path(gcp_project, ARGS.dead_letter_topic))
+
+    if ARGS.command == 'replay':
+        replay = Replay(orders=ARGS.orders, reprint=ARGS.reprint, rate=ARGS.rate,
+                        idle_timeout=ARGS.idle_timeout)
+        CAPTURE = TrafficCapture(ARGS.capture, ARGS.capture_payloads) if ARGS.capture else None
+        try:
+            return replay.run(subscriber, subscription_paths[ARGS.subscription], ARGS.since)
+        finally:
+            stop_tracing()
+            if CAPTURE is not None:
+                CAPTURE.stop()
+
+    global SHARD_MEMBERSHIP  # pylint: disable=global-statement
+    if SHARD_MEMBERSHIP is not None:
+        SHARD_MEMBERSHIP.stop()
+    SHARD_MEMBERSHIP = None
+    if ARGS.number == 'shard':
+        SHARD_MEMBERSHIP = ShardMembership(f"{platform.node()}-{uuid.uuid4().hex[:8]}",
+                                           ARGS.printer, lease_ttl=ARGS.lease_ttl,
+                                           interval=ARGS.heartbeat_interval)
+        SHARD_MEMBERSHIP.start()
+
+    global CONFIG_RELOADER  # pylint: disable=global-statement
+    if CONFIG_RELOADER is not None:
+        CONFIG_RELOADER.stop()
+    CONFIG_RELOADER = ConfigReloader(args, ARGS.config, ARGS.config_interval, ARGS.admin_port)
+    CONFIG_RELOADER.start()
+
+    global STATUS  # pylint: disable=global-statement
+    if STATUS is not None:
+        STATUS.stop()
+    STATUS = None
+    if ARGS.status_topic:
+        publisher = pubsub_v1.PublisherClient()
+        STATUS = StatusPublisher(publisher, publisher.topic_path(gcp_project, ARGS.status_topic),
+                                 interval=ARGS.status_interval)
+        STATUS.start()
+
+    global WATCHDOG  # pylint: disable=global-statement
+    if WATCHDOG is not None:
+        WATCHDOG.stop()
+    WATCHDOG = None
+    if ARGS.watchdog_interval > 0:
+        WATCHDOG = MemoryWatchdog(ARGS.watchdog_interval, ARGS.max_rss_mb, ARGS.max_handles,
+                                  ARGS.max_temp_files, ARGS.trace_memory)
+        WATCHDOG.start()
+
+    global LOCAL_INTAKE  # pylint: disable=global-statement
+    if LOCAL_INTAKE is not None:
+        LOCAL_INTAKE.stop()
+    LOCAL_INTAKE = LocalIntake(ARGS.hot_folder, ARGS.hot_folder_interval, ARGS.intake_port)
+    LOCAL_INTAKE.start()
+
+    logging.info("Listening for %s messages on %s", ARGS.number,
+                 ", ".join(subscription_paths.values()))
+
+    CAPTURE = TrafficCapture(ARGS.capture, ARGS.capture_payloads) if ARGS.capture else None
+    # flow control bounds the labels held by each subscription; the scheduler shares the printer
+    futures = [future for subscription_name, subscription_path in subscription_paths.items()
+               for future in subscribe(subscriber, subscription_path,
+                                       functools.partial(received_message_to_print,
+                                                         queue_name=subscription_name))]
+
+    previous_handlers = install_signal_handlers()
+    try:
+        while not SHUTDOWN.is_set() and block():
+            pass  # pragma: no cover
+    finally:
+        restore_signal_handlers(previous_handlers)
+        drain(futures, ARGS.state_file, subscription_paths.values())
+    if RECYCLE.is_set():
+        raise SystemExit(RECYCLE_EXIT_CODE)
+
+
+def block():  # pragma: no cover
+    """ function to implement 'while true' logic but stubbed out so we can mock it """
+    # sleep briefly so that a shutdown signal is acted on promptly
+    time.sleep(1)
+    return True
+
+
+class WinNamedTempFile():
+    """This class creates a NamedTemporaryFile that persists after the file is flushed to disk.
+
+    We need this class on Windows as the default behavior to flush the writes to disk only
+    happens when the file is explicitly closed, and we need to be able to pass the file name
+    into the print command.
+    """
+    # names this process's temp files, so that MemoryWatchdog can find any left behind
+    PREFIX = f"print-client-{os.getpid()}-"
+    _in_use = set()
+    _lock = threading.Lock()
+
+    def __init__(self, file=None):
+        self.file = file
+
+    def __enter__(self):
+        # created under the lock, so that left_behind() never sees it before it is in use
+        with self._lock:
+            self.file = tempfile.NamedTemporaryFile(delete=False, prefix=self.PREFIX)
+            self._in_use.add(self.file.name)
+        return self.file
+
+    def __exit__(self, *_):
+        with self._lock:
+            self._in_use.discard(self.file.name)
+        if not self.file.closed:
+            self.file.close()
+        try:
+            os.unlink(self.file.name)
+        except OSError as exc:
+            # e.g. a killed Ghostscript still has it open; MemoryWatchdog will try again later
+            logging.warning("Could not delete temp file '%s': %s", self.file.name, exc)
+
+    @classmethod
+    def left_behind(cls):
+        """ returns the paths of this process's temp files that are no longer in use """
+        with cls._lock:
+            return [entry.path for entry in os.scandir(tempfile.gettempdir())
+                    if entry.name.startswith(cls.PREFIX) and entry.path not in cls._in_use]
+
+
+def validate_message_attributes(message):
+    """ validates that the message taken from the subscription has sufficient and valid attributes
+        to be successfully processed.
+
+        Throws an exception if the message fails validation
+    """
+    if not message.attributes:
+        # msg is malformed, by nack'ing this we may end up in a loop on it
+        error_msg = "Received message with no message attributes; discarding"
+        logging.warning(error_msg)
+        raise ValueError(error_msg)
+
+    if message.attributes.get("event_date") is None:
+        # msg doesn't have event date, by nack'ing this we may end up in a loop on it
+        error_msg = "Received message without event date; discarding"
+        logging.warning(error_msg)
+        raise ValueError(error_msg)
+
+    try:
+        _ = int(message.attributes.get("order_number", None))
+    except TypeError as type_error:
+        # msg does not have order number, by nack'ing this we may end up in a loop on it
+        logging.warning("Received message with no order number; discarding")
+        raise type_error
+    except ValueError as value_error:
+        # msg doesn't have integer order number, by nack'ing this we may end up in a loop on it
+        logging.warning("Received message with invalid order number; discarding")
+        raise value_error
+
+    label_format = message.attributes.get("format", "pdf")
+    if label_format not in LABEL_FORMATS or \
+       (label_format != "pdf" and message.attributes.get("template_id") is not None):
+        # msg data can't be printed, by nack'ing this we may end up in a loop on it
+        error_msg = "Received message with unsupported label format; discarding"
+        logging.warning(error_msg)
+        raise ValueError(error_msg)
+
+    if message.attributes.get("content_encoding", "base64") not in CONTENT_ENCODINGS:
+        # msg data can't be decoded, by nack'ing this we may end up in a loop on it
+        error_msg = "Received message with unsupported content encoding; discarding"
+        logging.warning(error_msg)
+        raise ValueError(error_msg)
+
+
+CONTENT_ENCODINGS = ('base64', 'binary', 'gzip', 'zstd')
+
+_DECODE_ERRORS = (base64.binascii.Error, OSError, EOFError, zlib.error) + \
+    ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+class PayloadError(ValueError):
+    """ raised when message data can not be decoded according to its content_encoding """
+
+
+def _read_bounded(stream, max_bytes):
+    """ reads a decompressing stream, giving up as soon as it produces more than max_bytes """
+    data = stream.read(max_bytes + 1)
+    if len(data) > max_bytes:
+        raise PayloadError(f"decompressed label is larger than {max_bytes} bytes")
+    return data
+
+
+def decode_payload(data, content_encoding, max_bytes):
+    """ returns the PDF carried in message data encoded as per the content_encoding attribute
+
+    Compressed payloads are decompressed as a stream, so a corrupt or malicious payload is
+    abandoned as soon as it exceeds max_bytes rather than after it has been inflated in full.
+
+    Arguments:
+    data -- the message data
+    content_encoding -- one of CONTENT_ENCODINGS
+    max_bytes -- the largest decoded PDF that will be accepted
+    """
+    try:
+        if content_encoding == 'base64':
+            return base64.b64decode(data)
+        if content_encoding == 'binary':
+            return data
+        if content_encoding == 'gzip':
+            with gzip.GzipFile(fileobj=io.BytesIO(data)) as stream:
+                return _read_bounded(stream, max_bytes)
+        if content_encoding == 'zstd':
+            if zstandard is None:
+                raise PayloadError("zstd content encoding requires the zstandard package")
+            with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)) as stream:
+                return _read_bounded(stream, max_bytes)
+    except _DECODE_ERRORS as exc:
+        raise PayloadError(f"could not {content_encoding} decode data: {exc}")
+    raise PayloadError(f"unsupported content encoding '{content_encoding}'")
+
+
+class PreflightError(ValueError):
+    """ raised when a label payload is clearly not a PDF that can be printed """
+
+
+PREFLIGHT_CACHE_SIZE = 256
+_PREFLIGHT_CACHE = collections.OrderedDict()
+_PREFLIGHT_LOCK = threading.Lock()
+
+_PDF_PAGE = re.compile(rb'/Type\s*/Page\b(?!s)')
+_PDF_IMAGE = re.compile(rb'/Subtype\s*/Image\b')
+_PDF_OBJECT_STREAM = re.compile(rb'/Type\s*/ObjStm\b')
+# the stream keyword after an object stream's dictionary, which may hold nested dictionaries
+_PDF_STREAM_START = re.compile(rb'\bstream\r?\n')
+_PDF_STREAM_DICT_MAX = 1024
+_PDF_STARTXREF = re.compile(rb'startxref\s+(\d+)\s+%%EOF$')
+# writers may pad the file after %%EOF
+_PDF_PADDING = b' \t\r\n\f\x00'
+_PDF_XREF_AT = re.compile(rb'\s*(xref\b|\d+\s+\d+\s+obj\b)')
+
+
+def _object_streams(data):
+    """ yields the inflated contents of compressed object streams, which may hold page objects """
+    for match in _PDF_OBJECT_STREAM.finditer(data):
+        start = _PDF_STREAM_START.search(data, match.end(), match.end() + _PDF_STREAM_DICT_MAX)
+        if start is None:
+            continue
+        end = data.find(b'endstream', start.end())
+        try:
+            yield zlib.decompress(data[start.end():end])
+        except zlib.error:
+            continue
+
+
+def _image_pixels(data):
+    """ yields the width * height of each image XObject found in the (uncompressed) PDF objects """
+    for match in _PDF_IMAGE.finditer(data):
+        start = data.rfind(b'obj', 0, match.start())
+        end = data.find(b'stream', match.end())
+        header = data[start:end if end != -1 else match.end() + 512]
+        width = re.search(rb'/Width\s+(\d+)', header)
+        height = re.search(rb'/Height\s+(\d+)', header)
+        if width and height:
+            yield int(width.group(1)) * int(height.group(1))
+
+
+def count_pages(data):
+    """ returns the number of pages in the PDF, including those in compressed object streams """
+    return len(_PDF_PAGE.findall(data)) + \
+        sum(len(_PDF_PAGE.findall(stream)) for stream in _object_streams(data))
+
+
+def _preflight_problem(data, max_bytes, max_pages, max_image_pixels):
+    """ returns a description of why data can not be printed, or '' if it looks printable """
+    if len(data) > max_bytes:
+        return f"PDF is {len(data)} bytes; the limit is {max_bytes}"
+    if b'%PDF-' not in data[:1024]:
+        return "data does not start with a PDF header"
+
+    end = len(data)
+    while end and data[end - 1] in _PDF_PADDING:
+        end -= 1
+    startxref = _PDF_STARTXREF.search(data, max(0, end - 1024), end)
+    if startxref is None:
+        return "PDF is truncated; there is no startxref/%%EOF trailer"
+    offset = int(startxref.group(1))
+    if offset >= len(data) or not _PDF_XREF_AT.match(data, offset):
+        return f"PDF startxref offset {offset} does not point at a cross-reference table"
+
+    pages = count_pages(data)
+    if pages == 0:
+        return "PDF has no pages"
+    if pages > max_pages:
+        return f"PDF has {pages} pages; the limit is {max_pages}"
+
+    largest_image = max(_image_pixels(data), default=0)
+    if largest_image > max_image_pixels:
+        return f"PDF embeds a {largest_image} pixel image; the limit is {max_image_pixels}"
+    return ''
+
+
+def preflight_pdf(data, max_bytes, max_pages, max_image_pixels):
+    """ cheaply checks that data is a complete PDF within our limits before ghostscript is run
+
+    This checks the header, trailer and cross-reference table, counts pages and bounds the
+    pixel dimensions of embedded images. Results are cached by content hash, as the same label is
+    often published more than once (e.g. reprints and redeliveries).
+
+    Raises PreflightError if the data can not or should not be printed.
+    """
+    key = (hashlib.sha256(data).digest(), max_bytes, max_pages, max_image_pixels)
+    with _PREFLIGHT_LOCK:
+        problem = _PREFLIGHT_CACHE.get(key)
+        if problem is not None:
+            _PREFLIGHT_CACHE.move_to_end(key)
+
+    if problem is None:
+        problem = _preflight_problem(data, max_bytes, max_pages, max_image_pixels)
+        with _PREFLIGHT_LOCK:
+            _PREFLIGHT_CACHE[key] = problem
+            if len(_PREFLIGHT_CACHE) > PREFLIGHT_CACHE_SIZE:
+                _PREFLIGHT_CACHE.popitem(last=False)
+
+    if problem:
+        raise PreflightError(problem)
+
+
+def pdf_features(data):
+    """ returns the cheap-to-measure features of a PDF label that RenderCostModel predicts from """
+    return {
+        u'pages': max(count_pages(data), 1),
+        u'megapixels': sum(_image_pixels(data)) / 10**6,
+    }
+
+
+class RenderCostModel():
+    """ Predicts how long Ghostscript takes to print a PDF label, from its pdf_features().
+
+    The model is linear (a fixed cost plus a cost per page and per megapixel of images), fitted to
+    timings of a corpus of labels by `python benchmark.py render` for each of a set of Ghostscript
+    profiles (extra command line options). Its file holds a model per profile, and names the one
+    that printed the corpus fastest.
+    """
+    FEATURES = (u'pages', u'megapixels')
+    # the least a label is predicted to cost; a label that cost nothing would never advance its
+    # queue's turn in the WeightedFairScheduler, starving the other queues
+    MIN_SECONDS = 0.01
+
+    def __init__(self, intercept, coefficients, options=''):
+        self.intercept = intercept
+        self.coefficients = coefficients
+        self.options = options
+
+    @classmethod
+    def fit(cls, samples, options=''):
+        """ returns the least squares fit to samples, a list of (pdf_features(), seconds) """
+        rows = [[1.0] + [features[name] for name in cls.FEATURES] for features, _ in samples]
+        size = len(cls.FEATURES) + 1
+        # solve the normal equations by Gauss-Jordan elimination; a touch of ridge keeps them
+        # solvable when the corpus doesn't vary a feature
+        matrix = [[sum(row[i] * row[j] for row in rows) + (1e-9 if i == j else 0.0)
+                   for j in range(size)] + [sum(row[i] * seconds
+                                                for row, (_, seconds) in zip(rows, samples))]
+                  for i in range(size)]
+        for column in range(size):
+            pivot = max(range(column, size), key=lambda row: abs(matrix[row][column]))
+            matrix[column], matrix[pivot] = matrix[pivot], matrix[column]
+            for row in range(size):
+                if row != column:
+                    factor = matrix[row][column] / matrix[column][column]
+                    matrix[row] = [a - factor * b for a, b in zip(matrix[row], matrix[column])]
+        solution = [matrix[i][size] / matrix[i][i] for i in range(size)]
+        return cls(solution[0], dict(zip(cls.FEATURES, solution[1:])), options)
+
+    @classmethod
+    def load(cls, path, profile=None):
+        """ returns the model for profile (by default the fastest) from a file written by
+            `python benchmark.py render`
+        """
+        with open(path, encoding='utf-8') as model_file:
+            models = json.load(model_file)
+        model = models[u'profiles'][profile or models[u'fastest']]
+        return cls(model[u'intercept'], model[u'coefficients'], model[u'options'])
+
+    def to_dict(self):
+        """ returns the model as stored in a model file """
+        return {u'intercept': self.intercept, u'coefficients': self.coefficients,
+                u'options': self.options}
+
+    def predict(self, data):
+        """ returns the predicted seconds to print the PDF label data """
+        return self.predict_features(pdf_features(data))
+
+    def predict_features(self, features):
+        """ returns the predicted seconds to print a PDF label with the given pdf_features() """
+        return max(self.MIN_SECONDS,
+                   self.intercept + sum(coefficient * features[name]
+                                        for name, coefficient in self.coefficients.items()))
+
+
+COST_MODEL = None
+
+
+BASE14_FONTS = frozenset([
+    'Courier', 'Courier-Bold', 'Courier-Oblique', 'Courier-BoldOblique',
+    'Helvetica', 'Helvetica-Bold', 'Helvetica-Oblique', 'Helvetica-BoldOblique',
+    'Times-Roman', 'Times-Bold', 'Times-Italic', 'Times-BoldItalic', 'Symbol', 'ZapfDingbats',
+])
+
+
+class TemplateError(ValueError):
+    """ raised when a template or the fields sent to fill it in are invalid """
+
+
+class TemplateNotFound(TemplateError):
+    """ raised when a message names a template that is not installed on this print client """
+
+
+class _BlankMissing(dict):
+    """ field map that renders fields missing from a message as blank rather than failing """
+    def __missing__(self, key):
+        return ''
+
+
+def _pdf_string(text):
+    """ escapes text for use as a PDF string literal in a WinAnsi-encoded base 14 font """
+    text = text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    return text.encode('cp1252', 'replace')
+
+
+class LabelTemplate():
+    """ A label layout that is parsed once and then rendered to a PDF for each message's fields.
+
+    Templates are JSON documents giving the page size in points and a list of text elements:
+
+        {"width": 162, "height": 90,
+         "elements": [{"text": "#{order_number}", "x": 8, "y": 64, "size": 20,
+                       "font": "Helvetica-Bold"},
+                      {"text": "{items}", "x": 8, "y": 44, "size": 8, "leading": 9}]}
+
+    Text is a str.format() pattern over the message attributes and fields; list values are put
+    on separate lines. Only the standard base 14 fonts are used, so nothing needs to be embedded
+    and everything except the page's content stream is generated when the template is parsed.
+    """
+    def __init__(self, spec):
+        try:
+            fonts = []
+            self._elements = []
+            for element in spec['elements']:
+                font = element.get('font', 'Helvetica')
+                if font not in BASE14_FONTS:
+                    raise TemplateError(f"'{font}' is not a base 14 font")
+                if font not in fonts:
+                    fonts.append(font)
+                size = float(element.get('size', 10))
+                operators = f"/F{fonts.index(font) + 1} {size:g} Tf " \
+                            f"{float(element.get('leading', size * 1.2)):g} TL " \
+                            f"{float(element['x']):g} {float(element['y']):g} Td "
+                self._elements.append((operators.encode(), str(element['text'])))
+            media_box = f"[0 0 {float(spec['width']):g} {float(spec['height']):g}]"
+        except (KeyError, TypeError, ValueError) as exc:
+            raise TemplateError(f"invalid template: {exc!r}")
+
+        font_refs = " ".join(f"/F{number} {number + 4} 0 R" for number in range(1, len(fonts) + 1))
+        # objects 1-3 are fixed, 4 is the page content and 5 onwards are the fonts
+        self._head = [
+            b"<< /Type /Catalog /Pages 2 0 R >>",
+            b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+            f"<< /Type /Page /Parent 2 0 R /MediaBox {media_box} /Contents 4 0 R "
+            f"/Resources << /Font << {font_refs} >> >> >>".encode(),
+        ]
+        self._fonts = [f"<< /Type /Font /Subtype /Type1 /BaseFont /{font} "
+                       f"/Encoding /WinAnsiEncoding >>".encode() for font in fonts]
+
+    def render(self, fields):
+        """ returns the PDF for this template filled in with fields """
+        fields = _BlankMissing({key: "\n".join(map(str, value)) if isinstance(value, list)
+                                else value for key, value in fields.items()})
+        content = []
+        for operators, text in self._elements:
+            try:
+                lines = text.format_map(fields).split("\n")
+            except (AttributeError, IndexError, ValueError) as exc:
+                raise TemplateError(f"could not fill in '{text}': {exc!r}")
+            content.append(b"BT " + operators +
+                           b" T* ".join(b"(" + _pdf_string(line) + b") Tj" for line in lines) +
+                           b" ET")
+        content = b"\n".join(content)
 
-class Printers():
-    # pylint: disable=too-few-public-methods
-    """ Singleton object that fetches list of printers (including default) using `wmic` command"""
-    _instance = None
+        objects = self._head + \
+            [b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content)] + self._fonts
+        pdf = bytearray(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, 1):
+            offsets.append(len(pdf))
+            pdf += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+        startxref = len(pdf)
+        pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+        pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+        pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % \
+            (len(objects) + 1, startxref)
+        return bytes(pdf)
 
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super(Printers, cls).__new__(cls)
-            # Put any initialization here.
-            cls._instance.printers = []
-            cls._instance.default_printer = None
-            # pylint: disable=unexpected-keyword-arg
-            printer_list_csv = subprocess.check_output("wmic printer get name,default /format:csv",
-                                                       text=True)
-
-            reader = csv.DictReader(printer_list_csv.strip().splitlines(), delimiter=",")
-            for row in reader:
-                logging.debug("detected printer '%s' %s", row['Name'],
-                              "(default)" if row['Default'] == "TRUE" else "")
-                cls._instance.printers.append(row['Name'])
-                # there should only be one default so no worries about overwriting here
-                if row['Default'] == "TRUE":
-                    cls._instance.default_printer = row["Name"]
-        return cls._instance
 
+_TEMPLATE_CACHE = {}
+_TEMPLATE_LOCK = threading.Lock()
 
-def valid_printer(name):
-    """ this checks to ensure that the printer specified exists
+
+def load_template(template_dir, template_id):
+    """ returns the parsed LabelTemplate for template_id, re-parsing it only if its file changed
 
     Arguments:
-    name -- the name of the printer requested
+    template_dir -- the directory holding '<template_id>.json' files
+    template_id -- the template_id attribute of the message
     """
-    logging.debug(f"Testing to see if printer '{name}' is a valid printer")
-    if name not in Printers().printers:  # pylint: disable=no-member
-        raise argparse.ArgumentTypeError(f"'{name}' is not a valid printer name on this system")
-    return name
+    if not re.fullmatch(r'\w[\w.-]*', template_id):
+        raise TemplateError(f"'{template_id}' is not a valid template id")
+    path = os.path.join(template_dir, f"{template_id}.json")
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        raise TemplateNotFound(f"template '{template_id}' is not installed in '{template_dir}'")
 
+    with _TEMPLATE_LOCK:
+        cached = _TEMPLATE_CACHE.get(path)
+        if cached is None or cached[0] != mtime:
+            try:
+                with open(path, encoding='utf-8') as template_file:
+                    cached = (mtime, LabelTemplate(json.load(template_file)))
+            except ValueError as exc:  # includes JSONDecodeError
+                raise TemplateError(f"template '{template_id}' is invalid: {exc}")
+            _TEMPLATE_CACHE[path] = cached
+    return cached[1]
 
-def parse_command_line_args(args):
-    """ parses arguments specified on the command line when program is run """
-    parser = argparse.ArgumentParser(description='Connect to GCP pub/sub to print labels')
-    parser.add_argument('-p', '--printer', type=valid_printer, default=Printers().default_printer,
-                        help='name of printer to print to (otherwise default printer is used)')
-    parser.add_argument('-n', '--number', choices=['odd', 'even', 'all'], default='all',
-                        help='which order numbers to print (default is all)')
-    parser.add_argument('-l', '--log',
-                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
-                        default='INFO', help='log level for messages to print to console')
 
-    return parser.parse_args(args)
+def render_label(template_id, data, attributes):
+    """ renders the PDF for a template message whose data is a JSON object of fields """
+    try:
+        fields = json.loads(data.decode('utf-8')) if data else {}
+    except ValueError as exc:  # includes UnicodeDecodeError and JSONDecodeError
+        raise TemplateError(f"fields are not valid JSON: {exc}")
+    if not isinstance(fields, dict):
+        raise TemplateError("fields must be a JSON object")
+    return load_template(ARGS.template_dir, template_id).render({**attributes, **fields})
 
 
-def main(args):
-    """ main program flow """
+def kill_process_tree(process):
+    """ kills the process and every process it has started """
+    try:
+        if os.name == 'nt':
+            subprocess.run(f"taskkill /F /T /PID {process.pid}", shell=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            os.killpg(process.pid, signal.SIGKILL)  # pylint: disable=no-member
+    except OSError as exc:
+        logging.warning("Could not kill process %s: %s", process.pid, exc)
+    process.kill()
 
-    assert ('Windows' in platform.system()), "This program only runs on Windows!"
 
-    if os.environ.get('GOOGLE_APPLICATION_CREDENTIALS', None) is None:
-        raise RuntimeError("GOOGLE_APPLICATION_CREDENTIALS environment variable not set")
+# how many stuck print workers (Ghostscript process trees or raw sends) have been given up on
+_RECYCLED_WORKERS = itertools.count(1)
 
-    credentials, gcp_project = auth.default()
 
-    global ARGS  # pylint: disable=global-statement
-    ARGS = parse_command_line_args(args)
+def worker_recycled(worker, timeout):
+    """ logs, and counts, a print worker being killed or abandoned as it has hung """
+    logging.error("Recycled print worker %s as it had not finished after %s seconds "
+                  "(%d recycled since starting)", worker, timeout, next(_RECYCLED_WORKERS))
 
-    log_level = getattr(logging, ARGS.log, None)
-    logging.basicConfig(level=log_level)
 
-    # log all messages at level to stdout
-    # stdout_handler = logging.StreamHandler(sys.stdout)
-    # stdout_handler.setLevel(log_level)
-    # logging.getLogger().addHandler(stdout_handler)
+def run_watched(command, timeout, capture_output=False):
+    """ runs a shell command like subprocess.run(command, shell=True, check=True)
 
-    # also log all messages at level to stackdriver
-    stackdriver_client = stackdriver_logging.Client()
-    stackdriver_client.setup_logging(log_level=log_level)
+    If the command hasn't finished after timeout seconds it is killed, along with everything it
+    started, and subprocess.TimeoutExpired is raised. subprocess.run's own timeout only kills the
+    shell, which would leave a hung Ghostscript (and the driver it is blocked on) behind.
 
-    subscriber = pubsub_v1.SubscriberClient()
-    subscription_path = subscriber.subscription_path(gcp_project, 'print_queue')
+    Returns the command's output if capture_output, otherwise None.
+    """
+    process = subprocess.Popen(command, shell=True, start_new_session=True,
+                               stdout=subprocess.PIPE if capture_output else None)
+    try:
+        output, _ = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        worker_recycled(f"'{command}'", timeout)
+        kill_process_tree(process)
+        process.communicate()
+        raise
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command, output)
+    return output
 
-    subscriptions = subscriber.list_subscriptions("projects/%s" % gcp_project)
-    if subscription_path not in [x.name for x in subscriptions]:
-        logging.error(f"The subscription named 'print_queue' in GCP Project '{gcp_project}' "
-                      f"must exist before this program can be run!")
-        raise RuntimeError("Subscription %s does not exist" % subscription_path)
 
-    logging.info(f"Listening for {ARGS.number} messages on {subscription_path}")
+# how many times its predicted duration a label is allowed, on top of --print-timeout, when there
+# is a render cost model; the model is usually fitted on a different machine than the client's
+COST_TIMEOUT_FACTOR = 5
 
-    # there is no way to print more than one document at a time so no need to parallelize
-    subscriber.subscribe(subscription_path, callback=received_message_to_print,
-                         flow_control=pubsub_v1.types.FlowControl(max_messages=5))
 
-    while block():
-        pass  # pragma: no cover
+def print_timeout(pdf):
+    """ returns how many seconds to allow Ghostscript to print or convert the PDF label """
+    if COST_MODEL is not None:
+        return ARGS.print_timeout + COST_TIMEOUT_FACTOR * COST_MODEL.predict(pdf)
+    return ARGS.print_timeout + ARGS.print_timeout_per_page * max(count_pages(pdf), 1)
 
 
-def block():  # pragma: no cover
-    """ function to implement 'while true' logic but stubbed out so we can mock it """
-    time.sleep(60)
-    return True
+LABEL_FORMATS = ('pdf', 'zpl', 'pcl')
 
+# we need spaces around the executable given the space in 'Program Files'
+GHOSTSCRIPT = '"c:\\\\Program Files\\gs\\gs9.50\\bin\\gswin64c.exe"'
 
-class WinNamedTempFile():
-    """This class creates a NamedTemporaryFile that persists after the file is flushed to disk.
 
-    We need this class on Windows as the default behavior to flush the writes to disk only
-    happens when the file is explicitly closed, and we need to be able to pass the file name
-    into the print command.
+class RawPrintError(Exception):
+    """ raised when printer-native data could not be sent to the printer """
+
+
+def send_raw(printer, data, document_name, timeout=None):
+    """ sends printer-native (ZPL or PCL) data straight to the printer, bypassing its driver
+
+    If the spooler hasn't taken the data after timeout seconds, subprocess.TimeoutExpired is
+    raised like run_watched. A call blocked in the spooler can't be interrupted, so the thread
+    making it is abandoned and the next label is sent from a new one.
     """
-    def __init__(self, file=None):
-        self.file = file
+    if win32print is None:
+        raise RawPrintError("printing native labels requires the pywin32 package")
+    errors = []
 
-    def __enter__(self):
-        self.file = tempfile.NamedTemporaryFile(delete=False)
-        return self.file
+    def send():
+        try:
+            handle = win32print.OpenPrinter(printer)
+            try:
+                win32print.StartDocPrinter(handle, 1, (document_name, None, "RAW"))
+                try:
+                    win32print.StartPagePrinter(handle)
+                    win32print.WritePrinter(handle, data)
+                    win32print.EndPagePrinter(handle)
+                finally:
+                    win32print.EndDocPrinter(handle)
+            finally:
+                win32print.ClosePrinter(handle)
+        except Exception as exc:  # pylint: disable=broad-except
+            errors.append(exc)  # pywintypes.error is only importable on Windows
 
-    def __exit__(self, *_):
-        if not self.file.closed:
-            self.file.close()
-        os.unlink(self.file.name)
+    sender = threading.Thread(target=send, name="RawPrint", daemon=True)
+    sender.start()
+    sender.join(timeout)
+    if sender.is_alive():
+        worker_recycled(f"sending '{document_name}' to '{printer}'", timeout)
+        raise subprocess.TimeoutExpired(document_name, timeout)
+    if errors:
+        raise RawPrintError(str(errors[0])) from errors[0]
 
 
-def validate_message_attributes(message):
-    """ validates that the message taken from the subscription has sufficient and valid attributes
-        to be successfully processed.
+_PBM_TOKEN = re.compile(rb'(?:\s|#[^\n]*\n)*(\S+)')
 
-        Throws an exception if the message fails validation
+
+def pbm_to_zpl(pbm):
+    """ encodes each page of a raw (P4) PBM bitmap as a ZPL label holding a single graphic field
+
+    PBM and ZPL's ^GF command both pack 8 dots per byte, most significant bit first, with a set bit
+    printed black, so rows are copied across as they are (in ASCII hex).
     """
-    if not message.attributes:
-        # msg is malformed, by nack'ing this we may end up in a loop on it
-        error_msg = "Received message with no message attributes; discarding"
-        logging.warning(error_msg)
-        raise ValueError(error_msg)
+    labels = []
+    offset = 0
+    while offset < len(pbm) and pbm[offset:].strip():
+        header = []
+        while len(header) < 3:
+            token = _PBM_TOKEN.match(pbm, offset)
+            if token is None:
+                raise ValueError("truncated PBM header")
+            header.append(token.group(1))
+            offset = token.end()
+        if header[0] != b'P4':
+            raise ValueError("not a raw PBM bitmap")
+        width, height = int(header[1]), int(header[2])
+        row_bytes = (width + 7) // 8
+        offset += 1  # the single whitespace character after the height
+        raster = pbm[offset:offset + row_bytes * height]
+        if len(raster) != row_bytes * height:
+            raise ValueError("truncated PBM raster")
+        offset += len(raster)
+        labels.append(f"^XA^FO0,0^GFA,{len(raster)},{len(raster)},{row_bytes},"
+                      f"{raster.hex().upper()}^FS^XZ\n".encode('ascii'))
+    return b''.join(labels)
 
-    if message.attributes.get("event_date") is None:
-        # msg doesn't have event date, by nack'ing this we may end up in a loop on it
-        error_msg = "Received message without event date; discarding"
-        logging.warning(error_msg)
-        raise ValueError(error_msg)
 
+# the Ghostscript device rendering a PDF for each native format, how its output is encoded, and
+# the resolutions the device can render at (None for any)
+NATIVE_CONVERSIONS = {
+    'zpl': ('pbmraw', pbm_to_zpl, None),
+    'pcl': ('ljet4', lambda pcl: pcl, (300, 600)),
+}
+
+
+def check_native_dpi(native_format, dpi):
+    """ raises ValueError if labels can't be converted to native_format at dpi """
+    resolutions = NATIVE_CONVERSIONS[native_format][2]
+    if resolutions is not None and dpi not in resolutions:
+        raise ValueError(f"{native_format} labels can only be converted at "
+                         f"{' or '.join(map(str, resolutions))} dpi, not {dpi}")
+
+
+def convert_pdf(pdf, native_format, dpi, cache_dir, cache_size):
+    """ returns the PDF label converted to printer-native commands, converting it only once
+
+    Conversions are cached as files in cache_dir, named by the PDF's hash, so that redelivered
+    and reprinted labels (including after a restart) go straight to the printer; the least
+    recently used files are removed once there are more than cache_size.
+    """
+    check_native_dpi(native_format, dpi)
+    device, encode, _ = NATIVE_CONVERSIONS[native_format]
+
+    def _convert():
+        with WinNamedTempFile() as temp_file:
+            temp_file.write(pdf)
+            temp_file.close()
+            convert_cmd = f'{GHOSTSCRIPT} -dBATCH -dNOPAUSE -dSAFER -q -r{dpi} ' \
+                          f'-sDEVICE={device} -sOutputFile=- "{temp_file.name}"'
+            return encode(run_watched(convert_cmd, print_timeout(pdf), capture_output=True))
+
+    return _cached(cache_dir, f"{hashlib.sha256(pdf).hexdigest()}-{dpi}.{native_format}",
+                   cache_size, _convert)
+
+
+def _cached(cache_dir, name, cache_size, convert):
+    """ returns the contents of the file called name in cache_dir, first writing it with the
+        result of convert() if it isn't there; the least recently used files are removed once
+        there are more than cache_size
+    """
+    cache_path = os.path.join(cache_dir, name)
     try:
-        _ = int(message.attributes.get("order_number", None))
-    except TypeError as type_error:
-        # msg does not have order number, by nack'ing this we may end up in a loop on it
-        logging.warning("Received message with no order number; discarding")
-        raise type_error
-    except ValueError as value_error:
-        # msg doesn't have integer order number, by nack'ing this we may end up in a loop on it
-        logging.warning("Received message with invalid order number; discarding")
-        raise value_error
+        with open(cache_path, 'rb') as cached:
+            converted = cached.read()
+        with contextlib.suppress(FileNotFoundError):  # evicted by another job since
+            os.utime(cache_path)
+        return converted
+    except FileNotFoundError:
+        pass
+
+    converted = convert()
+    os.makedirs(cache_dir, exist_ok=True)
+    # other jobs may be writing the same file, so each writes its own temporary file
+    handle, temp_path = tempfile.mkstemp(prefix=f"{name}.", suffix='.tmp', dir=cache_dir)
+    try:
+        with os.fdopen(handle, 'wb') as cached:
+            cached.write(converted)
+        os.replace(temp_path, cache_path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+
+    def _last_used(path):
+        try:
+            return os.path.getmtime(path)
+        except FileNotFoundError:
+            return 0  # already evicted by another job
+
+    cached_paths = [entry.path for entry in os.scandir(cache_dir)
+                    if entry.is_file() and not entry.name.endswith('.tmp')]
+    if len(cached_paths) > cache_size:
+        cached_paths.sort(key=_last_used)
+        for stale_path in cached_paths[:len(cached_paths) - cache_size]:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(stale_path)
+    return converted
+
+
+# how optimize_pdf() rewrites labels; bump OPTIMIZE_PROFILE when changing it, so that labels
+# optimized the old way are not taken from the cache
+OPTIMIZE_PROFILE = 1
+OPTIMIZE_OPTIONS = ' '.join([
+    '-dCompatibilityLevel=1.4',
+    # downsample every image with more detail than the printer can print
+    *(f'-dDownsample{kind}Images=true -d{kind}ImageDownsampleType=/Bicubic '
+      f'-d{kind}ImageDownsampleThreshold=1.0 -d{kind}ImageResolution={{dpi}}'
+      for kind in ('Color', 'Gray', 'Mono')),
+    # thermal label printers only print black, so there's no need to keep colour
+    '-sColorConversionStrategy=Gray -dProcessColorModel=/DeviceGray',
+    '-dEmbedAllFonts=true -dSubsetFonts=true -dCompressFonts=true',
+    # draw annotations and form fields into the page content
+    '-dPreserveAnnots=false',
+])
+
+
+def optimize_pdf(pdf, dpi, cache_dir, cache_size):
+    """ returns the PDF label rewritten to be quicker to print, rewriting it only once
+
+    Images are downsampled to the printer's resolution and converted to grayscale, fonts are
+    subset and annotations are flattened into the page, so Ghostscript doesn't decode and scale
+    600 DPI photos on every print. Optimized labels are cached as files in cache_dir, named by the
+    PDF's hash and the printer profile, so labels from the same template only pay this once.
+    """
+    def _optimize():
+        with WinNamedTempFile() as temp_file, WinNamedTempFile() as optimized_file:
+            temp_file.write(pdf)
+            temp_file.close()
+            optimized_file.close()
+            # pdfwrite needs to seek in its output, so it can't be written to stdout
+            optimize_cmd = f'{GHOSTSCRIPT} -dBATCH -dNOPAUSE -dSAFER -q -sDEVICE=pdfwrite ' \
+                           f'{OPTIMIZE_OPTIONS.format(dpi=dpi)} ' \
+                           f'-sOutputFile="{optimized_file.name}" "{temp_file.name}"'
+            run_watched(optimize_cmd, print_timeout(pdf))
+            with open(optimized_file.name, 'rb') as optimized:
+                return optimized.read()
+
+    return _cached(cache_dir, f"{hashlib.sha256(pdf).hexdigest()}-{dpi}-v{OPTIMIZE_PROFILE}.pdf",
+                   cache_size, _optimize)
 
 
 def get_database_connection(event_date):
@@ -181,13 +2770,534 @@ def get_database_connection(event_date):
     return db_ref.collection(f'events/{event_date}/print_queue')
 
 
-def received_message_to_print(message):
+class ConsistentHashRing():
+    """ Maps order numbers onto a set of hosts.
+
+    Each host is placed at many pseudo-random points on a ring, and an order number belongs to the
+    host at the first point after its own hash. Adding or removing a host therefore only moves
+    the order numbers that hash next to that host's points; everything else stays where it was.
+    """
+    def __init__(self, hosts=(), replicas=64):
+        points = sorted((self._hash(f"{host}#{replica}"), host)
+                        for host in hosts for replica in range(replicas))
+        self._keys = [key for key, _ in points]
+        self._hosts = [host for _, host in points]
+        self.hosts = sorted(set(hosts))
+
+    @staticmethod
+    def _hash(key):
+        # python's hash() is salted per process, so it can't be used to agree across hosts
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+    def owner(self, order_number):
+        """ returns the host responsible for the order number, or None if there are no hosts """
+        if not self._keys:
+            return None
+        index = bisect.bisect(self._keys, self._hash(order_number)) % len(self._keys)
+        return self._hosts[index]
+
+
+class ShardMembership():
+    """ Registers this client in Firestore with a heartbeat lease and tracks the live clients.
+
+    Each client writes `print_clients/{host_id}` every `interval` seconds with a lease that expires
+    `lease_ttl` seconds later. Clients whose lease has expired are dropped from the hash ring, so
+    their order numbers are rebalanced onto the remaining clients (nacked messages are then
+    redelivered to, and printed by, their new owner).
+    """
+    COLLECTION = 'print_clients'
+
+    def __init__(self, host_id, printer, lease_ttl=30, interval=10):
+        self.host_id = host_id
+        self.printer = printer
+        self.lease_ttl = lease_ttl
+        self.interval = interval
+        self.ring = ConsistentHashRing([host_id])
+        self._collection_ref = None
+        self._stopped = threading.Event()
+
+    def _collection(self):
+        if self._collection_ref is None:
+            self._collection_ref = firestore.Client().collection(self.COLLECTION)
+        return self._collection_ref
+
+    def heartbeat(self):
+        """ renews our lease and rebuilds the hash ring from the clients holding a live lease """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            collection = self._collection()
+            collection.document(self.host_id).set({
+                u'hostname': str(platform.node()),
+                u'printer_name': str(self.printer),
+                u'heartbeat': firestore.SERVER_TIMESTAMP,
+                u'lease_expires': now + datetime.timedelta(seconds=self.lease_ttl),
+            })
+            live = {doc.id for doc in collection.where(u'lease_expires', u'>', now).stream()}
+        except Exception as exc:  # pylint: disable=broad-except
+            # keep using the last ring we saw; a short outage shouldn't reshuffle every order
+            logging.warning("Could not renew print client lease; keeping current shards: %s", exc)
+            return
+
+        live.add(self.host_id)
+        if sorted(live) != self.ring.hosts:
+            logging.info("Rebalancing order numbers across %d print clients: %s",
+                         len(live), ", ".join(sorted(live)))
+            self.ring = ConsistentHashRing(live)
+
+    def owns(self, order_number):
+        """ True if this client is responsible for printing the order number """
+        return self.ring.owner(order_number) == self.host_id
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.heartbeat()
+
+    def start(self):
+        """ registers now and then renews the lease every `interval` seconds in the background """
+        self.heartbeat()
+        threading.Thread(target=self._run, name="ShardMembership", daemon=True).start()
+
+    def stop(self):
+        """ stops renewing the lease and deregisters so other clients pick up our shards at once """
+        self._stopped.set()
+        try:
+            self._collection().document(self.host_id).delete()
+        except Exception as exc:  # pylint: disable=broad-except
+            logging.warning("Could not deregister print client; its lease will expire: %s", exc)
+
+
+SHARD_MEMBERSHIP = None
+
+
+def is_our_order_number(order_number):
+    """ returns True if this client should print the order number, according to ARGS.number """
+    if ARGS.number == 'all':
+        return True
+    if ARGS.number == 'shard':
+        return SHARD_MEMBERSHIP is None or SHARD_MEMBERSHIP.owns(order_number)
+    return (order_number % 2 == 0) == (ARGS.number == 'even')
+
+
+def get_counters_connection(print_queue_ref):
+    """ returns the collection of print counter shards that sits alongside the print queue """
+    return print_queue_ref.parent.collection(u'print_counters')
+
+
+def record_print(print_queue_ref, record):
+    """ adds the print record and increments a print counter shard in a single batched write
+
+    Counters are split by printer and hostname, and each of those is split again into
+    ARGS.counter_shards documents chosen at random, so that busy printers don't exceed
+    Firestore's sustained write rate on a single document.
+    """
+    counter_ref, counter = _counter_shard(print_queue_ref, record['printer_name'],
+                                          record['hostname'])
+
+    batch = firestore.Client().batch()
+    batch.set(print_queue_ref.document(), record)
+    counter[u'count'] = firestore.Increment(1)
+    if u'subscription' in record:
+        # how long labels from each subscription waited for the printer, to check it is shared
+        counter[u'queues'] = {record[u'subscription']: {
+            u'count': firestore.Increment(1),
+            u'wait_seconds': firestore.Increment(record[u'queue_wait_seconds']),
+        }}
+    batch.set(counter_ref, counter, merge=True)
+    batch.commit()
+
+
+def record_hang(print_queue_ref):
+    """ increments the count of print jobs on this printer and host that had to be killed """
+    counter_ref, counter = _counter_shard(print_queue_ref, str(ARGS.printer), str(platform.node()))
+    counter_ref.set({**counter, u'hangs': firestore.Increment(1)}, merge=True)
+
+
+def _counter_shard(print_queue_ref, printer_name, hostname):
+    """ returns a random counter shard for the printer and host, and its identifying fields """
+    shard = random.randrange(ARGS.counter_shards)
+    counter_key = hashlib.sha1(f"{printer_name}|{hostname}".encode())
+    counter_ref = get_counters_connection(print_queue_ref).document(
+        f"{counter_key.hexdigest()[:16]}-{shard}")
+    return counter_ref, {u'printer_name': printer_name, u'hostname': hostname, u'shard': shard}
+
+
+def summarize_prints(event_date):
+    """ returns a Counter of labels printed for the event keyed by (printer name, hostname)
+
+    This reads only the counter shards, so its cost does not grow with the number of labels.
+    """
+    return summarize_counters(event_date)[0]
+
+
+def summarize_counters(event_date):
+    """ returns Counters of labels printed, and of print jobs that hung, for the event, each keyed
+    by (printer name, hostname), and of labels printed and seconds waited for the printer keyed by
+    subscription
+    """
+    totals, hangs, queues = collections.Counter(), collections.Counter(), {}
+    for doc in get_counters_connection(get_database_connection(event_date)).stream():
+        counter = doc.to_dict()
+        key = (counter.get(u'printer_name'), counter.get(u'hostname'))
+        totals[key] += counter.get(u'count', 0)
+        hangs[key] += counter.get(u'hangs', 0)
+        for queue_name, waits in counter.get(u'queues', {}).items():
+            queues.setdefault(queue_name, collections.Counter()).update(waits)
+    return totals, hangs, queues
+
+
+def print_summary(event_date):
+    """ writes a table of labels printed for the event by printer and host to stdout """
+    totals, hangs, queues = summarize_counters(event_date)
+    print(f"{sum(totals.values())} labels printed for event {event_date}")
+    if totals or hangs:
+        width = max(len(str(printer)) for printer, _ in totals | hangs)
+        for (printer, hostname), count in sorted((totals | hangs).items(), key=str):
+            hung = f"  ({hangs[(printer, hostname)]} hung)" if hangs[(printer, hostname)] else ""
+            print(f"  {printer!s:<{width}}  {hostname!s:<15}  {totals[(printer, hostname)]:>6}"
+                  f"{hung}")
+    for queue_name, waits in sorted(queues.items()):
+        mean_wait = waits[u'wait_seconds'] / waits[u'count'] if waits[u'count'] else 0
+        print(f"  from {queue_name}: {waits[u'count']} labels, waiting {mean_wait:.2f}s on average "
+              f"for the printer")
+    return totals
+
+
+class PrintedOrders():
+    """ The order numbers this client has printed for the most recent events.
+
+    These are checked before asking Firestore whether a label is a duplicate, and are kept in the
+    state snapshot so that a restarted client still knows what it printed.
+    """
+    MAX_EVENTS = 3
+
+    def __init__(self, orders=None):
+        self._orders = collections.OrderedDict((event_date, set(order_numbers))
+                                               for event_date, order_numbers
+                                               in (orders or {}).items())
+        self._lock = threading.Lock()
+
+    def add(self, event_date, order_number):
+        """ remembers that the order number has been printed for the event """
+        with self._lock:
+            self._orders.setdefault(event_date, set()).add(order_number)
+            self._orders.move_to_end(event_date)
+            while len(self._orders) > self.MAX_EVENTS:
+                self._orders.popitem(last=False)
+
+    def __contains__(self, event_order):
+        event_date, order_number = event_order
+        with self._lock:
+            return order_number in self._orders.get(event_date, ())
+
+    def to_dict(self):
+        """ returns {event_date: [order numbers]} """
+        with self._lock:
+            return {event_date: sorted(order_numbers)
+                    for event_date, order_numbers in self._orders.items()}
+
+
+PRINTED_ORDERS = PrintedOrders()
+
+
+def already_printed(print_queue_ref, event_date, order_number):
+    """ returns True if this client printed the order number, or a print record exists for it """
+    if (event_date, order_number) in PRINTED_ORDERS:
+        return True
+    query = print_queue_ref.where(u'order_number', u'==', order_number).stream()
+    return len(list(query)) > 0
+
+
+class BulkDedup():
+    """ Answers `already_printed` for a range of order numbers from a single query per event.
+
+    Replaying hundreds of labels would otherwise cost one Firestore query per label. Order numbers
+    outside the range fall back to the usual per-message query. With `reprint` set, order numbers
+    in the range are never treated as duplicates.
+    """
+    def __init__(self, orders=None, reprint=False):
+        self.orders = orders
+        self.reprint = reprint
+        self._printed = {}
+        self._lock = threading.Lock()
+
+    def _in_range(self, order_number):
+        return self.orders is None or order_number in self.orders
+
+    def __call__(self, print_queue_ref, event_date, order_number):
+        if not self._in_range(order_number):
+            return already_printed(print_queue_ref, event_date, order_number)
+        if self.reprint:
+            return False
+        # the cached query predates anything printed since, including earlier copies in this replay
+        if (event_date, order_number) in PRINTED_ORDERS:
+            return True
+
+        with self._lock:
+            if event_date not in self._printed:
+                query = print_queue_ref
+                if self.orders is not None:
+                    query = query.where(u'order_number', u'>=', self.orders.start) \
+                                 .where(u'order_number', u'<=', self.orders.stop - 1)
+                self._printed[event_date] = {doc.get(u'order_number') for doc in
+                                             query.select([u'order_number']).stream()}
+            return order_number in self._printed[event_date]
+
+
+class RateLimiter():
+    # pylint: disable=too-few-public-methods
+    """ Spaces out calls to `wait()` so that they return at most `rate` times per second """
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """ blocks until the next slot is available """
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        time.sleep(slot - now)
+
+
+class Replay():
+    """ Seeks a subscription back in time and streams the redelivered labels through the normal
+    print path, rate limited, with bulk duplicate checks, reporting progress as it goes.
+
+    Messages for order numbers outside the requested range were delivered before the seek, so
+    they are acked without printing them again.
+    """
+    PROGRESS_INTERVAL = 10
+
+    def __init__(self, orders=None, reprint=False, rate=1.0, idle_timeout=15):
+        self.orders = orders
+        self.idle_timeout = idle_timeout
+        self.dedup = BulkDedup(orders, reprint)
+        self.limiter = RateLimiter(rate)
+        self.replayed = 0
+        self.skipped = 0
+        self.queue_name = None
+        self._last_message = time.monotonic()
+
+    def callback(self, message):
+        """ subscription callback; rate limits replayed labels before the normal print path """
+        try:
+            order_number = int(message.attributes.get("order_number"))
+        except (TypeError, ValueError):
+            order_number = None
+
+        if self.orders is not None and order_number not in self.orders:
+            logging.debug("Skipping replayed message for order number '%s' outside of the range",
+                          message.attributes.get("order_number"))
+            self.skipped += 1
+            message.ack()
+        else:
+            self.limiter.wait()
+            self.replayed += 1
+            received_message_to_print(message, dedup=self.dedup, queue_name=self.queue_name)
+        self._last_message = time.monotonic()
+
+    def _log_progress(self, started):
+        elapsed = time.monotonic() - started
+        logging.info("Replayed %d labels (skipped %d others) in %.0f seconds; %.2f labels/sec",
+                     self.replayed, self.skipped, elapsed,
+                     self.replayed / elapsed if elapsed else 0.0)
+
+    def run(self, subscriber, subscription_path, since=None):
+        """ replays messages published since `since` until the subscription goes quiet """
+        if since is None:
+            # pub/sub never retains messages for longer than 7 days
+            since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=7)
+        seek_time = Timestamp()
+        seek_time.FromDatetime(since.astimezone(datetime.timezone.utc).replace(tzinfo=None))
+        logging.info("Replaying %s published since %s on %s",
+                     f"orders {self.orders.start}-{self.orders.stop - 1}" if self.orders
+                     else "all orders", since.isoformat(), subscription_path)
+        subscriber.seek(subscription_path, time=seek_time)
+        self.queue_name = subscription_path.rsplit('/', 1)[-1]
+
+        started = self._last_message = time.monotonic()
+        futures = subscribe(subscriber, subscription_path, self.callback)
+        while time.monotonic() - self._last_message < self.idle_timeout:
+            time.sleep(min(self.PROGRESS_INTERVAL, self.idle_timeout))
+            self._log_progress(started)
+        for future in futures:
+            future.cancel()
+        self._log_progress(started)
+        return self.replayed
+
+
+class PrintFailures():
+    """ Counts how many times each message has failed to print.
+
+    Pub/Sub counts deliveries itself (as message.delivery_attempt) when the subscription has a
+    dead-letter policy and the client library supports it; otherwise failures are counted here,
+    for the most recent MAX_MESSAGES messages.
+    """
+    MAX_MESSAGES = 10000
+
+    def __init__(self):
+        self._failures = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, message):
+        """ counts a failure to print the message; returns how many attempts have now failed """
+        delivery_attempt = getattr(message, 'delivery_attempt', None)
+        if delivery_attempt:
+            return delivery_attempt
+        with self._lock:
+            failures = self._failures.pop(message.message_id, 0) + 1
+            self._failures[message.message_id] = failures
+            while len(self._failures) > self.MAX_MESSAGES:
+                self._failures.popitem(last=False)
+        return failures
+
+    def forget(self, message_id):
+        """ forgets the failures counted for the message, as when its ID is to be reused """
+        with self._lock:
+            self._failures.pop(message_id, None)
+
+
+PRINT_FAILURES = PrintFailures()
+
+# (publisher client, topic path) that quarantined labels are also published to, if any
+DEAD_LETTER = None
+
+
+_UNSAFE_FILENAME = re.compile(r'[^A-Za-z0-9._-]')
+
+
+def _quarantine_path(message_id):
+    """ returns where the label with message_id is kept in ARGS.quarantine_dir """
+    return os.path.join(ARGS.quarantine_dir, f"{_UNSAFE_FILENAME.sub('_', message_id)}.json")
+
+
+def quarantine_message(message, reason, attempts):
+    """ stores a label that keeps failing to print in ARGS.quarantine_dir, so that it can be
+    inspected and requeued later, and publishes it to the dead-letter topic if there is one
+    """
+    entry = {
+        u'message_id': str(message.message_id),
+        u'attributes': dict(message.attributes),
+        u'data': base64.b64encode(message.data).decode('ascii'),
+        u'reason': reason,
+        u'attempts': attempts,
+        u'printer_name': str(ARGS.printer),
+        u'hostname': str(platform.node()),
+        u'quarantined_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+    os.makedirs(ARGS.quarantine_dir, exist_ok=True)
+    path = _quarantine_path(entry[u'message_id'])
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as quarantined:
+        json.dump(entry, quarantined, indent=2)
+    os.replace(f"{path}.tmp", path)
+    logging.error("Quarantined label for order number #%s after %d failed attempts to print it",
+                  message.attributes.get("order_number"), attempts)
+
+    if DEAD_LETTER is not None:
+        publisher, topic_path = DEAD_LETTER
+        try:
+            # a requeued label that is quarantined again already has a quarantine_reason
+            publisher.publish(topic_path, message.data,
+                              **{**message.attributes, 'quarantine_reason': reason}
+                              ).result(timeout=30)
+        except Exception as exc:  # pylint: disable=broad-except
+            logging.warning("Could not publish quarantined label to %s: %s", topic_path, exc)
+
+
+def quarantined_labels(quarantine_dir):
+    """ returns the labels in the quarantine directory, oldest first """
+    labels = []
+    try:
+        entries = list(os.scandir(quarantine_dir))
+    except FileNotFoundError:
+        return labels
+    for entry in entries:
+        if entry.name.endswith('.json'):
+            with open(entry.path, encoding='utf-8') as quarantined:
+                labels.append(json.load(quarantined))
+    return sorted(labels, key=lambda label: label[u'quarantined_at'])
+
+
+def manage_quarantine(action, message_ids, publisher=None, topic_path=None):
+    """ lists quarantined labels, or requeues them to topic_path or discards them
+
+    Arguments:
+    action -- 'list', 'requeue' or 'discard'
+    message_ids -- the quarantined messages to act on; all of them if empty
+    """
+    labels = [label for label in quarantined_labels(ARGS.quarantine_dir)
+              if not message_ids or label[u'message_id'] in message_ids]
+    for label in labels:
+        attributes = label[u'attributes']
+        print(f"  {label[u'quarantined_at'][:19]}  #{attributes.get('order_number')!s:<8} "
+              f"{attributes.get('event_date')!s:<10}  {label[u'message_id']}  "
+              f"{label[u'attempts']} attempts on {label[u'printer_name']}: {label[u'reason']}")
+        if action == 'list':
+            continue
+        if action == 'requeue':
+            publisher.publish(topic_path, base64.b64decode(label[u'data']),
+                              **attributes).result(timeout=30)
+        os.remove(_quarantine_path(label[u'message_id']))
+    past_tense = {'list': 'quarantined', 'requeue': 'requeued', 'discard': 'discarded'}
+    print(f"{len(labels)} labels {past_tense[action]}")
+    return labels
+
+
+def print_pdf(printer, pdf):
+    """ rasterizes the PDF label with Ghostscript and prints it via the printer's driver """
+    with WinNamedTempFile() as temp_file:
+        # write content
+        temp_file.write(pdf)
+
+        # flush file to disk
+        temp_file.close()  # this does not delete file; this will happen when we exit with clause
+
+        # as it is a possibility that the printer name and path to temp_file would have spaces in
+        # them, we wrap them in quotes
+        profile = f'{COST_MODEL.options} ' if COST_MODEL is not None and COST_MODEL.options else ''
+        print_cmd = f'{GHOSTSCRIPT} -dPrinted -dBATCH -dNOPAUSE -dNOSAFER -q -dNumCopies=1 ' \
+                    f'-dPDFFitPage {profile}-sDEVICE=mswinpr2 -dNoCancel ' \
+                    f'-sOutputFile="%printer%{printer}" "{temp_file.name}"'
+        run_watched(print_cmd, print_timeout(pdf))
+
+
+def received_message_to_print(message, dedup=already_printed, queue_name='print_queue'):
     """ Callback for processing a message received over subscription.
 
     Note: message.ack() is not guaranteed so this method needs to be idempotent
+
+    Arguments:
+    message -- the received pub/sub message
+    dedup -- callable(print_queue_ref, event_date, order_number) returning True if the label has
+             already been printed
+    queue_name -- the name of the subscription the message was received on
     """
-    logging.debug(f'Received message id: {message.message_id}; size {message.size}')
+    if CAPTURE is not None:
+        CAPTURE.record(message, queue_name)
+    status = STATUS
+    if status is not None:
+        status.received(queue_name)
+    trace = MessageTrace(message)
+    # settings reloaded while this label prints apply from the next one
+    with ARGS.job():
+        try:
+            return _print_message(trace.message, dedup, trace, queue_name)
+        finally:
+            trace.finish()
+            if TRACE_EXPORTERS:
+                exported = trace.to_dict()
+                for exporter in TRACE_EXPORTERS:
+                    exporter.export(exported)
+            if status is not None:
+                status.done(queue_name)
 
+
+def _print_message(message, dedup, trace, queue_name):
+    """ prints the message's label, recording each step in trace """
+    MESSAGE_LOG.debug('Received message id: %s; size %s', message.message_id, message.size)
+
+    trace.step('validate')
     try:
         validate_message_attributes(message)
     except Exception:  # pylint: disable=broad-except
@@ -196,81 +3306,159 @@ def received_message_to_print(message):
 
     event_date = message.attributes.get("event_date")
     order_number = int(message.attributes.get("order_number"))
-    logging.debug(f"Received print message with attributes '{message.attributes}'")
+    MESSAGE_LOG.debug("Received print message with attributes '%s'", message.attributes)
+
+    if not is_our_order_number(order_number):
+        logging.warning("Skipping print message for order number '%s' as we "
+                        "are only printing %s numbers", order_number, ARGS.number)
+        return message.nack()
+
+    trace.step('wait')
+    # hold on to the message (without pulling any more) until the printer can take another job
+    if PRINTER_MONITOR is not None:
+        PRINTER_MONITOR.wait_until_ready()
 
-    if ARGS.number != 'all':
-        if (order_number % 2 == 0 and ARGS.number != 'even') or \
-           (order_number % 2 == 1 and ARGS.number != 'odd'):
-            logging.warning(f"Skipping print message for order number '{order_number}' as we "
-                            f"are only printing {ARGS.number} numbers")
-            return message.nack()
+    if SHUTDOWN.is_set():
+        # we're shutting down, so release this for another (or the restarted) client to print
+        return message.nack()
 
+    trace.step('dedup')
     print_queue_ref = None
     try:
         print_queue_ref = get_database_connection(event_date)
 
         # if reprint flag is not set, check to see if this label has been printed already
         if message.attributes.get("reprint", None) is None:
-            query = print_queue_ref.where(u'order_number', u'==', order_number).stream()
-            # if more than one document is returned, then we should assume this is a duplicate
+            # if the label has been printed before, then we should assume this is a duplicate
             # message and we should quietly squelch this
-            if len(list(query)) > 0:
-                logging.warning(f"Received duplicate print message for order number "
-                                f"'{order_number}' without reprint attribute set; squelching")
+            if dedup(print_queue_ref, event_date, order_number):
+                logging.warning("Received duplicate print message for order number "
+                                "'%s' without reprint attribute set; squelching", order_number)
                 return message.ack()
     except Exception as exc:  # pylint: disable=broad-except
         logging.warning("Exception raised while checking to see if we've printed this label before:"
                         " %s", exc)
 
+    trace.step('decode')
     # if we're here, we should try printing the file
-    with WinNamedTempFile() as temp_file:
-        # write content
-        try:
-            temp_file.write(base64.b64decode(message.data))
-        except base64.binascii.Error as exc:
-            logging.error(f"Could not base64 decode data: {exc}")
-            message.ack()
-            return
-
-        # flush file to disk
-        temp_file.close()  # this does not delete file; this will happen when we exit with clause
+    try:
+        pdf = decode_payload(message.data, message.attributes.get("content_encoding", "base64"),
+                             ARGS.max_pdf_bytes)
+    except PayloadError as exc:
+        logging.error("Could not decode data: %s", exc)
+        message.ack()
+        return
 
+    label_format = message.attributes.get("format", "pdf")
+    template_id = message.attributes.get("template_id")
+    if template_id is not None:
+        trace.step('render')
         try:
-            logging.info(f"Printing label for order number #{order_number} to printer "
-                         f"'{ARGS.printer}'...")
-            # we need spaces around the executable given the space in 'Program Files', and as it is
-            # a possibility that the printer name and path to temp_file would have spaces in them as
-            # well, we wrap them in quotes too
-            print_cmd = '"c:\\\\Program Files\\gs\\gs9.50\\bin\\gswin64c.exe" -dPrinted -dBATCH ' \
-                        '-dNOPAUSE -dNOSAFER -q -dNumCopies=1 -dPDFFitPage -sDEVICE=mswinpr2 ' \
-                        '-dNoCancel ' \
-                        '-sOutputFile="%printer%{}" "{}"'.format(ARGS.printer, temp_file.name)
-            subprocess.run(print_cmd, shell=True, check=True)
-        except subprocess.CalledProcessError as ex:
-            logging.error(f"Unexpected printing error: {ex}")
-            # we failed to print, we nack() to retry
+            pdf = render_label(template_id, pdf, dict(message.attributes))
+        except TemplateNotFound as exc:
+            # another print client may have the template installed, so give it a chance to
+            logging.error("Could not render label for order number #%s: %s", order_number, exc)
             message.nack()
-            # sleep 3 seconds as to not overwhelm client
             time.sleep(3)
             return
+        except TemplateError as exc:
+            logging.error("Could not render label for order number #%s: %s", order_number, exc)
+            return message.ack()
 
+    if ARGS.preflight and label_format == 'pdf':
+        trace.step('preflight')
         try:
-            if print_queue_ref is None:
-                print_queue_ref = get_database_connection(event_date)
+            preflight_pdf(pdf, ARGS.max_pdf_bytes, ARGS.max_pages, ARGS.max_image_pixels)
+        except PreflightError as exc:
+            # this will never print, so by nack'ing this we would end up in a loop on it
+            logging.error("Discarding label for order number #%s: %s", order_number, exc)
+            return message.ack()
 
-            print_queue_ref.add({
-                u'order_number': order_number,
-                u'printer_name': str(ARGS.printer),
-                u'hostname': str(platform.node()),
-                u'message_attributes': dict(message.attributes),
-                u'message_id': str(message.message_id),
-                u'message_publish_time': str(message.publish_time),
-                u'print_timestamp': firestore.SERVER_TIMESTAMP,
-            })
-        except Exception as exc:  # pylint: disable=broad-except
-            logging.warning(f"Error raised while adding doc to firestore after printing: {exc}")
-        finally:
-            message.ack()
+    native = pdf if label_format != 'pdf' else None
+    if native is None and ARGS.native_format is not None:
+        trace.step('convert')
+        try:
+            native = convert_pdf(pdf, ARGS.native_format, ARGS.native_dpi, ARGS.native_cache_dir,
+                                 ARGS.native_cache_size)
+        except (subprocess.SubprocessError, ValueError, OSError) as exc:
+            logging.warning("Could not convert label for order number #%s to %s; printing it "
+                            "with Ghostscript instead: %s", order_number, ARGS.native_format, exc)
+
+    if native is None and ARGS.optimize:
+        trace.step('optimize')
+        try:
+            pdf = optimize_pdf(pdf, ARGS.optimize_dpi, ARGS.optimize_cache_dir,
+                               ARGS.optimize_cache_size)
+        except (subprocess.SubprocessError, OSError) as exc:
+            logging.warning("Could not optimize label for order number #%s; printing it as it "
+                            "is: %s", order_number, exc)
+
+    trace.step('schedule')
+    # with a cost model, queues share the printer by its predicted time rather than by label
+    cost = COST_MODEL.predict(pdf) if COST_MODEL is not None else 1.0
+    try:
+        with SCHEDULER.slot(queue_name, cost) as waited:
+            if SHUTDOWN.is_set():
+                # shutdown was requested while we waited our turn; leaving the slot releases it
+                return message.nack()
+            trace.step('spool')
+            logging.info("Printing label for order number #%s to printer '%s'...",
+                         order_number, ARGS.printer)
+            if ARGS.fake_printer is not None:
+                time.sleep(ARGS.fake_printer)
+            elif native is not None:
+                send_raw(ARGS.printer, native, f"Order #{order_number}", ARGS.print_timeout)
+            else:
+                print_pdf(ARGS.printer, pdf)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, RawPrintError) as ex:
+        logging.error("Unexpected printing error: %s", ex)
+        if isinstance(ex, subprocess.TimeoutExpired):
+            try:
+                record_hang(print_queue_ref or get_database_connection(event_date))
+            except Exception as exc:  # pylint: disable=broad-except
+                logging.warning("Error raised while counting hung print job: %s", exc)
+        # the printer may have just gone offline; find out now rather than at the next poll
+        printer_ready = PRINTER_MONITOR is None or PRINTER_MONITOR.check()
+        # if the printer is fine, the label itself may be what is failing; stop retrying it
+        # once it has failed too many times, so that it doesn't hold up the labels behind it
+        attempts = PRINT_FAILURES.record(message) if printer_ready else 0
+        if attempts >= ARGS.max_print_attempts:
+            try:
+                quarantine_message(message, str(ex), attempts)
+            except OSError as exc:
+                logging.error("Could not quarantine label for order number #%s: %s",
+                              order_number, exc)
+            else:
+                return message.ack()
+        # we failed to print, we nack() to retry
+        message.nack()
+        # sleep 3 seconds as to not overwhelm client
+        time.sleep(3)
+        return
+
+    PRINTED_ORDERS.add(event_date, order_number)
+    if STATUS is not None:
+        STATUS.printed(event_date, order_number)
+    trace.step('record')
+    try:
+        if print_queue_ref is None:
+            print_queue_ref = get_database_connection(event_date)
+
+        record_print(print_queue_ref, {
+            u'order_number': order_number,
+            u'printer_name': str(ARGS.printer),
+            u'hostname': str(platform.node()),
+            u'message_attributes': dict(message.attributes),
+            u'message_id': str(message.message_id),
+            u'message_publish_time': str(message.publish_time),
+            u'print_timestamp': firestore.SERVER_TIMESTAMP,
+            u'subscription': queue_name,
+            u'queue_wait_seconds': waited,
+        })
+    except Exception as exc:  # pylint: disable=broad-except
+        logging.warning("Error raised while adding doc to firestore after printing: %s", exc)
+    finally:
+        message.ack()
 
 
 if __name__ == '__main__':  # pragma: no cover
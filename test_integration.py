@@ -1,10 +1,12 @@
 # pylint: disable=redefined-outer-name
 """Unit tests for print-client"""
 
-from argparse import Namespace
 import base64
+import datetime
+import os
 import platform
 import subprocess
+import threading
 import time
 from unittest import mock
 
@@ -18,13 +20,19 @@ import main
 
 
 @pytest.fixture(autouse=True)
-def default_mocker_patches(mocker, monkeypatch):
+def default_mocker_patches(mocker, monkeypatch, tmp_path):
     """ Common mocks across all of the integration tests in this file
 
         - ensure that the program exits after 2 seconds
         - ensure that default values are passed in for printers
     """
     mocker.patch.object(platform, "system", return_value="Windows")
+    monkeypatch.setattr(main, "DEFAULT_STATE_FILE", str(tmp_path / "state.json.gz"))
+    monkeypatch.setattr(main, "PRINTED_ORDERS", main.PrintedOrders())
+    monkeypatch.setattr(main, "PRINT_FAILURES", main.PrintFailures())
+    monkeypatch.setattr(main, "SCHEDULER", main.WeightedFairScheduler())
+    monkeypatch.setattr(main, "SHUTDOWN", threading.Event())
+    monkeypatch.setattr(main, "RECYCLE", threading.Event())
 
     mocker.patch('google.cloud.logging.Client')
     monkeypatch.setenv("GOOGLE_APPLICATION_CREDENTIALS", "some.json")
@@ -34,7 +42,9 @@ def default_mocker_patches(mocker, monkeypatch):
     mock_printers = mocker.patch.object(main.Printers, "_instance")
     mock_printers.default_printer = "default_printer"
     mock_printers.printers = ["default_printer", "good_printer"]
-    mocker.patch.object(main, "ARGS", Namespace(printer="default_printer", number="all"))
+    mocker.patch.object(main, "ARGS", main.Config(main.parse_command_line_args([])))
+    mocker.patch.object(main.WmicPrinterBackend, "get_state",
+                        return_value=main.PrinterState(online=True, error_state=2, queue_length=0))
 
 
 TEST_EVENT_DATE = '1900-01-01'
@@ -103,9 +113,10 @@ def gen_mock_firestore_client(*_args, **_kwargs):
     client = firestore.Client()
 
     # we need to iterate through the relevant collection and delete all documents
-    docs = client.collection(f'events/{TEST_EVENT_DATE}/print_queue').stream()
-    for doc in docs:
-        doc.reference.delete()
+    for collection in ('print_queue', 'print_counters'):
+        docs = client.collection(f'events/{TEST_EVENT_DATE}/{collection}').stream()
+        for doc in docs:
+            doc.reference.delete()
 
     return client
 
@@ -115,7 +126,7 @@ def test_no_message_attributes(mocker, publisher_client, add_label_to_print):
         will be squelched
     """
     mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
-    mock_print = mocker.patch('subprocess.run')
+    mock_print = mocker.patch.object(main, 'run_watched')
     order_number = None
     event_date = TEST_EVENT_DATE
     add_label_to_print("tests/test_label.pdf", publisher_client, order_number, event_date)
@@ -133,7 +144,7 @@ def test_no_odd_messages_printed(mocker, publisher_client, add_label_to_print):
     """
     mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
     mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
-    mock_print = mocker.patch('subprocess.run')
+    mock_print = mocker.patch.object(main, 'run_watched')
     order_number = 1
     event_date = TEST_EVENT_DATE
     add_label_to_print("tests/test_label.pdf", publisher_client, order_number, event_date)
@@ -152,7 +163,7 @@ def test_no_even_messages_printed(mocker, publisher_client, add_label_to_print):
     """
     mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
     mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
-    mock_print = mocker.patch('subprocess.run')
+    mock_print = mocker.patch.object(main, 'run_watched')
     order_number = 2
     event_date = TEST_EVENT_DATE
     add_label_to_print("tests/test_label.pdf", publisher_client, order_number, event_date)
@@ -170,7 +181,7 @@ def test_invalid_order_number(mocker, publisher_client, add_label_to_print):
         appropriately squelched
     """
     mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
-    mock_print = mocker.patch('subprocess.run')
+    mock_print = mocker.patch.object(main, 'run_watched')
     order_number = "not_a_number"
     event_date = TEST_EVENT_DATE
     add_label_to_print("tests/test_label.pdf", publisher_client, order_number, event_date)
@@ -187,7 +198,7 @@ def test_other_attributes_but_no_order_number(mocker, publisher_client, add_labe
         number) will be squelched
     """
     mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
-    mock_print = mocker.patch('subprocess.run')
+    mock_print = mocker.patch.object(main, 'run_watched')
     order_number = None
     event_date = TEST_EVENT_DATE
     attributes = {"a": "1"}
@@ -207,9 +218,9 @@ def test_printer_failure(mocker, publisher_client, add_label_to_print, gen_mock_
     mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
     mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
     mocker.patch('google.cloud.firestore.Client', return_value=gen_mock_firestore_client)
-    mock_print = mocker.patch('subprocess.run',
-                              side_effect=subprocess.CalledProcessError(cmd="gswin64.exe",
-                                                                        returncode=1))
+    mock_print = mocker.patch.object(main, 'run_watched',
+                                     side_effect=subprocess.CalledProcessError(
+                                         cmd="gswin64.exe", returncode=1))
     order_number = 1
     event_date = TEST_EVENT_DATE
     add_label_to_print("tests/test_label.pdf", publisher_client, order_number, event_date)
@@ -227,7 +238,7 @@ def test_print_success(mocker, publisher_client, add_label_to_print, gen_mock_fi
     mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
     mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
     mocker.patch('google.cloud.firestore.Client', return_value=gen_mock_firestore_client)
-    mock_print = mocker.patch('subprocess.run')
+    mock_print = mocker.patch.object(main, 'run_watched')
 
     order_number = 1
     event_date = TEST_EVENT_DATE
@@ -251,7 +262,7 @@ def test_reprint_label(mocker, publisher_client, add_label_to_print, gen_mock_fi
     mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
     mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
     mocker.patch('google.cloud.firestore.Client', return_value=gen_mock_firestore_client)
-    mock_print = mocker.patch('subprocess.run')
+    mock_print = mocker.patch.object(main, 'run_watched')
     order_number = 1
     event_date = TEST_EVENT_DATE
     attributes = {"reprint": "True"}
@@ -274,7 +285,7 @@ def test_idempotent_print(mocker, publisher_client, add_label_to_print, gen_mock
     mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
     mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
     mocker.patch('google.cloud.firestore.Client', return_value=gen_mock_firestore_client)
-    mock_print = mocker.patch('subprocess.run')
+    mock_print = mocker.patch.object(main, 'run_watched')
 
     order_number = 1
     # put an entry into the DB denoting that the label has already been printed
@@ -308,7 +319,7 @@ def test_database_error_before_print(mocker, publisher_client, add_label_to_prin
     mocker.patch('google.cloud.firestore.Client', return_value=gen_mock_firestore_client)
     mocker.patch('google.cloud.firestore.Client.collection.where',
                  side_effect=RuntimeError("Error!"))
-    mock_print = mocker.patch('subprocess.run')
+    mock_print = mocker.patch.object(main, 'run_watched')
 
     order_number = 1
     event_date = TEST_EVENT_DATE
@@ -328,7 +339,7 @@ def test_database_error_before_and_after_print(mocker, publisher_client, add_lab
     mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
     mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
     mocker.patch('google.cloud.firestore.Client', side_effect=RuntimeError("Connection failed"))
-    mock_print = mocker.patch('subprocess.run')
+    mock_print = mocker.patch.object(main, 'run_watched')
 
     order_number = 1
     event_date = TEST_EVENT_DATE
@@ -349,8 +360,9 @@ def test_database_error_after_print(mocker, publisher_client, add_label_to_print
     mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
     mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
     mocker.patch('google.cloud.firestore.Client', return_value=gen_mock_firestore_client)
-    mocker.patch('google.cloud.firestore.Client.collection.add', side_effect=RuntimeError("Error!"))
-    mock_print = mocker.patch('subprocess.run')
+    mocker.patch('google.cloud.firestore_v1.batch.WriteBatch.commit',
+                 side_effect=RuntimeError("Error!"))
+    mock_print = mocker.patch.object(main, 'run_watched')
 
     order_number = 1
     event_date = TEST_EVENT_DATE
@@ -361,3 +373,106 @@ def test_database_error_after_print(mocker, publisher_client, add_label_to_print
     mock_ack.assert_called_once()
     mock_nack.assert_not_called()
     mock_print.assert_called_once()
+
+
+def test_shards_rebalance_across_clients(gen_mock_firestore_client):
+    """ Tests that several print clients registered against the emulator split the order numbers
+        between them, and that the survivors take over a client's shard once it stops
+    """
+    for doc in gen_mock_firestore_client.collection(main.ShardMembership.COLLECTION).stream():
+        doc.reference.delete()
+
+    clients = [main.ShardMembership(f"host-{i}", "default_printer") for i in range(3)]
+    for client in clients:
+        client.heartbeat()
+    # the first clients registered before the others existed, so they need to look again
+    for client in clients:
+        client.heartbeat()
+
+    for order_number in range(300):
+        assert [client.owns(order_number) for client in clients].count(True) == 1
+
+    clients[2].stop()
+    for client in clients[:2]:
+        client.heartbeat()
+
+    for order_number in range(300):
+        assert [client.owns(order_number) for client in clients[:2]].count(True) == 1
+
+    for client in clients[:2]:
+        client.stop()
+
+
+def test_replay_reprints_range(mocker, publisher_client, add_label_to_print,
+                               gen_mock_firestore_client):
+    """ Tests that the replay command seeks back and reprints labels already recorded as printed
+        in the requested range, while other labels take the normal print path
+    """
+    mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
+    mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
+    mocker.patch('google.cloud.firestore.Client', return_value=gen_mock_firestore_client)
+    mock_print = mocker.patch.object(main, 'run_watched')
+
+    since = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    for order_number in (1, 2, 3):
+        add_label_to_print("tests/test_label.pdf", publisher_client, order_number, TEST_EVENT_DATE)
+        gen_mock_firestore_client.collection(f'events/{TEST_EVENT_DATE}/print_queue').add({
+            u'order_number': order_number,
+            u'print_timestamp': firestore.SERVER_TIMESTAMP
+        })
+
+    main.main(["replay", "--since", since, "--orders", "1-2", "--reprint", "--rate", "100",
+               "--idle-timeout", "3"])
+
+    # orders 1 and 2 are reprinted; order 3 was already printed so is squelched
+    assert mock_print.call_count == 2
+    assert mock_ack.call_count == 3
+    mock_nack.assert_not_called()
+
+
+def test_print_counted(mocker, publisher_client, add_label_to_print, gen_mock_firestore_client):
+    """ Tests that printed labels are counted by printer and host in the counter shards """
+    mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
+    mocker.patch('google.cloud.firestore.Client', return_value=gen_mock_firestore_client)
+    mocker.patch.object(main, 'run_watched')
+
+    for order_number in (1, 2):
+        add_label_to_print("tests/test_label.pdf", publisher_client, order_number, TEST_EVENT_DATE)
+    # use default printer and all order numbers
+    main.main([])
+
+    assert main.summarize_prints(TEST_EVENT_DATE) == {("default_printer", platform.node()): 2}
+
+
+@pytest.mark.soak
+@pytest.mark.skipif(not os.environ.get("SOAK_SECONDS"),
+                    reason="set SOAK_SECONDS to run the soak test for that long")
+def test_memory_stays_flat(mocker, publisher_client, add_label_to_print,
+                           gen_mock_firestore_client):
+    """ Soak test: prints a steady stream of labels for SOAK_SECONDS, and checks that memory,
+        handles and temp files stop growing once the client has warmed up
+    """
+    mocker.patch('google.cloud.firestore.Client', return_value=gen_mock_firestore_client)
+    mocker.patch.object(main, 'run_watched')
+    soak_seconds = float(os.environ["SOAK_SECONDS"])
+    deadline = time.monotonic() + soak_seconds
+    samples = []
+    order_numbers = iter(range(1, 10**9))
+
+    def _block():
+        time.sleep(1)
+        for _ in range(5):
+            add_label_to_print("tests/test_label.pdf", publisher_client, next(order_numbers),
+                               TEST_EVENT_DATE, {"reprint": "true"})
+        samples.append(main.process_usage() + (len(main.WinNamedTempFile.left_behind()),))
+        return time.monotonic() < deadline
+
+    mocker.patch('main.block', side_effect=_block)
+    main.main(["--watchdog-interval", str(max(1.0, soak_seconds / 20)), "--trace-memory", "1"])
+
+    # compare the last quarter of the run with the end of the first quarter, once warmed up
+    warmed_up = samples[len(samples) // 4]
+    growth = max(rss for rss, _, _ in samples[-len(samples) // 4:]) - warmed_up[0]
+    assert growth / (1024 * 1024) < float(os.environ.get("SOAK_MAX_GROWTH_MB", 20))
+    assert max(handles for _, handles, _ in samples[-len(samples) // 4:]) <= warmed_up[1] + 10
+    assert samples[-1][2] == 0
@@ -3,16 +3,25 @@
 
 import argparse
 import base64
+import contextlib
 import datetime
+import gzip
+import json
 import os
 import platform
 import queue
+import socket
 import subprocess
+import threading
 import time
+import urllib.error
+import urllib.request
+import zlib
 from unittest import mock
 
 import pytest
 import pytz
+import zstandard
 
 from google.auth import credentials
 from google.api_core import datetime_helpers
@@ -23,6 +32,8 @@ from google.protobuf.timestamp_pb2 import Timestamp
 import main
 
 TEST_EVENT_DATE = '1900-01-01'
+with open(os.path.join(os.path.dirname(__file__), "tests", "test_label.pdf"), "rb") as test_pdf:
+    TEST_LABEL = test_pdf.read()
 
 
 WMIC_OUTPUT_ONE_DEFAULT = """
@@ -55,7 +66,7 @@ def delete_printer_singleton(monkeypatch):
 
 
 @pytest.fixture(autouse=True)
-def default_mocker_patches(request, mocker, monkeypatch):
+def default_mocker_patches(request, mocker, monkeypatch, tmp_path):
     """ Common mocks across most of the unit tests in this file; will not be applied if the custom
         pytest mark named 'noprintermark' is denoted on the test case
 
@@ -63,6 +74,12 @@ def default_mocker_patches(request, mocker, monkeypatch):
         also sets the default order numbers to be processed as 'all'
     """
     mocker.patch.object(platform, 'system', return_value="Windows")
+    monkeypatch.setattr(main, "DEFAULT_STATE_FILE", str(tmp_path / "state.json.gz"))
+    monkeypatch.setattr(main, "PRINTED_ORDERS", main.PrintedOrders())
+    monkeypatch.setattr(main, "PRINT_FAILURES", main.PrintFailures())
+    monkeypatch.setattr(main, "SCHEDULER", main.WeightedFairScheduler())
+    monkeypatch.setattr(main, "SHUTDOWN", threading.Event())
+    monkeypatch.setattr(main, "RECYCLE", threading.Event())
     mocker.patch('google.cloud.logging.Client')
     monkeypatch.setenv("GOOGLE_APPLICATION_CREDENTIALS", "path.json")
     mocker.patch('google.auth.default', return_value=(mock.Mock(spec=credentials.Credentials),
@@ -71,8 +88,7 @@ def default_mocker_patches(request, mocker, monkeypatch):
         mock_printers = mocker.patch.object(main.Printers, "_instance")
         mock_printers.default_printer = "default_printer"
         mock_printers.printers = ["default_printer", "good_printer"]
-        mocker.patch.object(main, "ARGS", argparse.Namespace(printer="default_printer",
-                                                             number="all"))
+        mocker.patch.object(main, "ARGS", main.Config(main.parse_command_line_args([])))
 
 
 RECEIVED = datetime.datetime(2012, 4, 21, 15, 0, tzinfo=pytz.utc)
@@ -247,6 +263,17 @@ def test_invalid_number_filter():
     assert system_exit_e.value.code == 2
 
 
+def test_invalid_native_dpi():
+    """ Tests that a resolution the native format's Ghostscript device can't render at is rejected
+        on the command line
+    """
+    with pytest.raises(SystemExit) as system_exit_e:
+        main.parse_command_line_args(["--native-format", "pcl"])
+    assert system_exit_e.value.code == 2
+    assert main.parse_command_line_args(["--native-format", "pcl",
+                                         "--native-dpi", "300"]).native_dpi == 300
+
+
 def test_invalid_log_level():
     """ Tests that if an invalid log level is specified on the command line, the program exits
         appropriately
@@ -257,13 +284,61 @@ def test_invalid_log_level():
     assert system_exit_e.value.code == 2
 
 
+@pytest.mark.parametrize("value", ["print_client.message", "=0.5", "a=2", "a=-1", "a=lots"])
+def test_invalid_log_sample(value):
+    """ Tests that malformed or out of range log sampling specifications are rejected """
+    with pytest.raises(argparse.ArgumentTypeError):
+        main.log_sample(value)
+
+
+def test_log_sampler_keeps_fraction_of_debug_records():
+    """ Tests that DEBUG records in a sampled category (and its children) are thinned to the
+        configured rate, while other categories and higher levels pass untouched
+    """
+    sampler = main.LogSampler()
+    sampler.configure([main.log_sample("print_client.message=0.25"),
+                       main.log_sample("noisy=0")])
+
+    def _record(name, level=main.logging.DEBUG):
+        return main.logging.LogRecord(name, level, __file__, 1, "msg", None, None)
+
+    kept = [sampler.filter(_record("print_client.message.child")) for _ in range(8)]
+    assert kept.count(True) == 2
+    assert sampler.filter(_record("print_client.message", main.logging.WARNING))
+    assert sampler.filter(_record("print_client"))
+    assert not sampler.filter(_record("noisy"))
+
+
+def test_log_transport_drops_when_queue_full(mocker, caplog):
+    """ Tests that the Stackdriver transport drops (and counts) entries instead of blocking when
+        its bounded queue is full, and reports how many it dropped
+    """
+    mocker.patch('google.cloud.logging.handlers.transports.background_thread._Worker.start')
+    transport = main.BoundedBackgroundThreadTransport(mock.Mock(), "python", max_queue_size=2)
+    mocker.patch.object(transport.worker, "flush")
+    record = main.logging.LogRecord("python", main.logging.INFO, __file__, 1, "msg", None, None)
+
+    for _ in range(5):
+        transport.send(record, "msg")
+
+    assert transport.worker._queue.qsize() == 2  # pylint: disable=protected-access
+    assert transport.dropped == 3
+    # the first drop is reported straight away, and later ones within the interval on flush
+    transport.flush()
+    transport.flush()
+    assert [r.getMessage() for r in caplog.records if "Dropped" in r.getMessage()] == [
+        "Dropped 1 log entries as the Stackdriver queue was full (1 in all)",
+        "Dropped 2 log entries as the Stackdriver queue was full (3 in all)",
+    ]
+
+
 def test_non_base64_data(mocker, receive_messsage_unit_test_fixture):
     """ Tests good path for a valid message that should be sent to the printer """
     mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
     mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
     mock_client = mocker.patch('google.cloud.firestore.Client')
     mock_client.return_value.collection.return_value.where.return_value.stream.return_value = []
-    mock_print = mocker.patch('subprocess.run')
+    mock_print = mocker.patch.object(main, 'run_watched')
 
     data = b'%234'  # % is not a valid character in a base64 string, so this should fail
     attributes = {"order_number": "1234", "event_date": TEST_EVENT_DATE}
@@ -282,9 +357,9 @@ def test_successful_print(mocker, receive_messsage_unit_test_fixture):
     mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
     mock_client = mocker.patch('google.cloud.firestore.Client')
     mock_client.return_value.collection.return_value.where.return_value.stream.return_value = []
-    mock_print = mocker.patch('subprocess.run')
+    mock_print = mocker.patch.object(main, 'run_watched')
 
-    data = base64.b64encode(b'1234')
+    data = base64.b64encode(TEST_LABEL)
     attributes = {"order_number": "1234", "event_date": TEST_EVENT_DATE}
     msg = receive_messsage_unit_test_fixture(data, attributes)
 
@@ -300,9 +375,9 @@ def test_successful_reprint(mocker, receive_messsage_unit_test_fixture):
     mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
     mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
     mocker.patch('google.cloud.firestore.Client')
-    mock_print = mocker.patch('subprocess.run')
+    mock_print = mocker.patch.object(main, 'run_watched')
 
-    data = base64.b64encode(b'1234')
+    data = base64.b64encode(TEST_LABEL)
     attributes = {"order_number": "1234", "event_date": TEST_EVENT_DATE, "reprint": "True"}
     msg = receive_messsage_unit_test_fixture(data, attributes)
 
@@ -321,9 +396,9 @@ def test_idempotent_impl(mocker, receive_messsage_unit_test_fixture):
     mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
     mock_client = mocker.patch('google.cloud.firestore.Client')
     mock_client.return_value.collection.return_value.where.return_value.stream.return_value = ['1']
-    mock_print = mocker.patch('subprocess.run')
+    mock_print = mocker.patch.object(main, 'run_watched')
 
-    data = base64.b64encode(b'1234')
+    data = base64.b64encode(TEST_LABEL)
     attributes = {"order_number": "1234", "event_date": TEST_EVENT_DATE}  # reprint not specified here
     msg = receive_messsage_unit_test_fixture(data, attributes)
 
@@ -340,9 +415,9 @@ def test_no_message_attributes(mocker, receive_messsage_unit_test_fixture):
     """
     mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
     mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
-    mock_print = mocker.patch('subprocess.run')
+    mock_print = mocker.patch.object(main, 'run_watched')
 
-    data = base64.b64encode(b'1234')
+    data = base64.b64encode(TEST_LABEL)
     attributes = {}
     msg = receive_messsage_unit_test_fixture(data, attributes)
 
@@ -359,9 +434,9 @@ def test_no_even_messages_printed(mocker, receive_messsage_unit_test_fixture):
     """
     mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
     mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
-    mock_print = mocker.patch('subprocess.run')
+    mock_print = mocker.patch.object(main, 'run_watched')
 
-    data = base64.b64encode(b'1234')
+    data = base64.b64encode(TEST_LABEL)
     attributes = {"order_number": "5678", "event_date": TEST_EVENT_DATE}
     msg = receive_messsage_unit_test_fixture(data, attributes)
 
@@ -379,9 +454,9 @@ def test_no_odd_messages_printed(mocker, receive_messsage_unit_test_fixture):
     """
     mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
     mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
-    mock_print = mocker.patch('subprocess.run')
+    mock_print = mocker.patch.object(main, 'run_watched')
 
-    data = base64.b64encode(b'1234')
+    data = base64.b64encode(TEST_LABEL)
     attributes = {"order_number": "5679", "event_date": TEST_EVENT_DATE}
     msg = receive_messsage_unit_test_fixture(data, attributes)
 
@@ -399,9 +474,9 @@ def test_invalid_order_number(mocker, receive_messsage_unit_test_fixture):
     """
     mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
     mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
-    mock_print = mocker.patch('subprocess.run')
+    mock_print = mocker.patch.object(main, 'run_watched')
 
-    data = base64.b64encode(b'1234')
+    data = base64.b64encode(TEST_LABEL)
     attributes = {"order_number": "not_a_number", "event_date": TEST_EVENT_DATE}
     msg = receive_messsage_unit_test_fixture(data, attributes)
 
@@ -418,9 +493,9 @@ def test_missing_event_date(mocker, receive_messsage_unit_test_fixture):
     """
     mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
     mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
-    mock_print = mocker.patch('subprocess.run')
+    mock_print = mocker.patch.object(main, 'run_watched')
 
-    data = base64.b64encode(b'1234')
+    data = base64.b64encode(TEST_LABEL)
     attributes = {"order_number": "1234"}
     msg = receive_messsage_unit_test_fixture(data, attributes)
 
@@ -437,9 +512,9 @@ def test_other_attributes_but_no_order_number(mocker, receive_messsage_unit_test
     """
     mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
     mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
-    mock_print = mocker.patch('subprocess.run')
+    mock_print = mocker.patch.object(main, 'run_watched')
 
-    data = base64.b64encode(b'1234')
+    data = base64.b64encode(TEST_LABEL)
     attributes = {"another_attr": "abc123", "event_date": TEST_EVENT_DATE}
     msg = receive_messsage_unit_test_fixture(data, attributes)
 
@@ -458,11 +533,11 @@ def test_printer_failure(mocker, receive_messsage_unit_test_fixture):
     mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
     mock_client = mocker.patch('google.cloud.firestore.Client')
     mock_client.return_value.collection.return_value.where.return_value.stream.return_value = []
-    mock_shell_execute = mocker.patch('subprocess.run',
-                                      side_effect=subprocess.CalledProcessError(cmd="gswin64.exe",
-                                                                                returncode=1))
+    mock_shell_execute = mocker.patch.object(main, 'run_watched',
+                                             side_effect=subprocess.CalledProcessError(
+                                                 cmd="gswin64.exe", returncode=1))
 
-    data = base64.b64encode(b'1234')
+    data = base64.b64encode(TEST_LABEL)
     attributes = {"order_number": "123", "event_date": TEST_EVENT_DATE}
     msg = receive_messsage_unit_test_fixture(data, attributes)
 
@@ -474,19 +549,23 @@ def test_printer_failure(mocker, receive_messsage_unit_test_fixture):
     mock_nack.assert_called_once()
 
 
-def test_missing_subscription(mocker):
+def test_missing_subscription(mocker, tmp_path):
     """ Tests that if the subscription for 'print_queue' does not exist before the program is run,
-        the program exits with a relevant exception
+        the program exits with a relevant exception, without having started a traffic capture
     """
     mock_sc = mocker.patch('google.cloud.pubsub_v1.SubscriberClient')
     mock_sc.return_value.subscription_path.return_value = "projects/%s/subscriptions/%s" % \
                                                           ("print-client-123456", "print_queue")
     mock_sc.return_value.list_subscriptions.return_value = []
 
+    capture_path = tmp_path / "capture.jsonl.gz"
+
     with pytest.raises(Exception) as exc:
-        main.main([])
+        main.main(["--capture", str(capture_path)])
     assert str(exc.value) == "Subscription projects/print-client-123456/subscriptions/print_queue "\
                              "does not exist"
+    assert main.CAPTURE is None
+    assert not capture_path.exists()
 
 
 def test_database_error_before_print(mocker, receive_messsage_unit_test_fixture):
@@ -497,9 +576,9 @@ def test_database_error_before_print(mocker, receive_messsage_unit_test_fixture)
     mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
     mock_client = mocker.patch('google.cloud.firestore.Client')
     mock_client.return_value.collection.return_value.where.side_effect = RuntimeError("Error!")
-    mock_print = mocker.patch('subprocess.run')
+    mock_print = mocker.patch.object(main, 'run_watched')
 
-    data = base64.b64encode(b'1234')
+    data = base64.b64encode(TEST_LABEL)
     attributes = {"order_number": "1234", "event_date": TEST_EVENT_DATE}
     msg = receive_messsage_unit_test_fixture(data, attributes)
 
@@ -517,9 +596,9 @@ def test_database_error_before_and_after_print(mocker, receive_messsage_unit_tes
     mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
     mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
     mocker.patch('google.cloud.firestore.Client', side_effect=RuntimeError("Connection failed"))
-    mock_print = mocker.patch('subprocess.run')
+    mock_print = mocker.patch.object(main, 'run_watched')
 
-    data = base64.b64encode(b'1234')
+    data = base64.b64encode(TEST_LABEL)
     attributes = {"order_number": "1234", "event_date": TEST_EVENT_DATE}
     msg = receive_messsage_unit_test_fixture(data, attributes)
 
@@ -538,10 +617,320 @@ def test_database_error_after_print(mocker, receive_messsage_unit_test_fixture):
     mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
     mock_client = mocker.patch('google.cloud.firestore.Client')
     mock_client.return_value.collection.return_value.where.return_value.stream.return_value = []
-    mock_client.return_value.collection.return_value.add.side_effect = RuntimeError("Error!")
-    mock_print = mocker.patch('subprocess.run')
+    mock_client.return_value.batch.return_value.commit.side_effect = RuntimeError("Error!")
+    mock_print = mocker.patch.object(main, 'run_watched')
+
+    data = base64.b64encode(TEST_LABEL)
+    attributes = {"order_number": "1234", "event_date": TEST_EVENT_DATE}
+    msg = receive_messsage_unit_test_fixture(data, attributes)
+
+    main.received_message_to_print(msg)
+
+    mock_ack.assert_called_once()
+    mock_nack.assert_not_called()
+    mock_print.assert_called_once()
+
+
+WMIC_PRINTER_STATE = """
+
+Node,DetectedErrorState,Name,WorkOffline
+ADMIN-PC,2,Dymo LabelMaker 450 Turbo,FALSE
+"""
+WMIC_PRINT_JOBS = """
+
+Node,Name
+ADMIN-PC,"Dymo LabelMaker 450 Turbo, 12"
+ADMIN-PC,"Dymo LabelMaker 450 Turbo, 13"
+ADMIN-PC,"Fax, 14"
+"""
+
+
+class FakePrinterBackend():
+    # pylint: disable=too-few-public-methods
+    """ printer backend whose state is set directly by the test case """
+    def __init__(self, state=main.PrinterState(online=True, error_state=2, queue_length=0)):
+        self.state = state
+
+    def get_state(self, _printer):
+        """ returns the state set by the test case, raising it if it is an exception """
+        if isinstance(self.state, Exception):
+            raise self.state
+        return self.state
+
+
+def test_wmic_printer_backend(mocker):
+    """ Tests that printer state and spooler queue length are parsed from wmic output """
+    mocker.patch('subprocess.check_output', side_effect=[WMIC_PRINTER_STATE, WMIC_PRINT_JOBS])
+
+    state = main.WmicPrinterBackend().get_state("Dymo LabelMaker 450 Turbo")
+
+    assert state == main.PrinterState(online=True, error_state=2, queue_length=2)
+
+
+@pytest.mark.parametrize("state", [
+    main.PrinterState(online=False, error_state=2, queue_length=0),
+    main.PrinterState(online=True, error_state=4, queue_length=0),
+    main.PrinterState(online=True, error_state=2, queue_length=3),
+])
+def test_printer_monitor_pauses_and_resumes(state):
+    """ Tests that the readiness monitor pauses when the printer is offline, in an error state or
+        has a deep spooler queue, and resumes once the printer recovers
+    """
+    backend = FakePrinterBackend(state)
+    monitor = main.PrinterReadinessMonitor("default_printer", backend, max_queue_length=3)
+
+    assert not monitor.check()
+    assert not monitor.wait_until_ready(timeout=0.01)
+
+    backend.state = main.PrinterState(online=True, error_state=2, queue_length=2)
+    assert monitor.check()
+    assert monitor.wait_until_ready(timeout=0.01)
+
+
+def test_printer_monitor_fails_open():
+    """ Tests that if the printer state can not be determined, printing is not paused """
+    monitor = main.PrinterReadinessMonitor("default_printer",
+                                           FakePrinterBackend(RuntimeError("wmic failed")))
+    assert monitor.check()
+
+
+def test_print_waits_for_ready_printer(mocker, monkeypatch, receive_messsage_unit_test_fixture):
+    """ Tests that a message is held, rather than printed or nacked, while the printer is not
+        ready, and is printed once the printer recovers
+    """
+    mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
+    mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
+    mock_client = mocker.patch('google.cloud.firestore.Client')
+    mock_client.return_value.collection.return_value.where.return_value.stream.return_value = []
+    mock_print = mocker.patch.object(main, 'run_watched')
+    backend = FakePrinterBackend(main.PrinterState(online=False, error_state=9, queue_length=0))
+    monitor = main.PrinterReadinessMonitor("default_printer", backend)
+    monitor.check()
+    monkeypatch.setattr(main, "PRINTER_MONITOR", monitor)
+
+    data = base64.b64encode(TEST_LABEL)
+    attributes = {"order_number": "1234", "event_date": TEST_EVENT_DATE}
+    msg = receive_messsage_unit_test_fixture(data, attributes)
+
+    callback = threading.Thread(target=main.received_message_to_print, args=(msg,))
+    callback.start()
+    callback.join(timeout=0.2)
+    assert callback.is_alive()
+    mock_print.assert_not_called()
+    mock_nack.assert_not_called()
+
+    backend.state = main.PrinterState(online=True, error_state=2, queue_length=0)
+    monitor.check()
+    callback.join(timeout=5)
+
+    mock_print.assert_called_once()
+    mock_ack.assert_called_once()
+
+
+def test_consistent_hash_ring_rebalances_minimally():
+    """ Tests that every order number has exactly one owner, and that removing a host only moves
+        the order numbers that host owned
+    """
+    three_hosts = main.ConsistentHashRing(["a", "b", "c"])
+    two_hosts = main.ConsistentHashRing(["a", "b"])
+
+    before = {order: three_hosts.owner(order) for order in range(1000)}
+    after = {order: two_hosts.owner(order) for order in range(1000)}
+
+    assert set(before.values()) == {"a", "b", "c"}
+    assert all(after[order] == owner for order, owner in before.items() if owner != "c")
+    assert main.ConsistentHashRing().owner(1) is None
+
+
+def test_shard_membership_heartbeat(mocker):
+    """ Tests that a heartbeat renews our lease and rebuilds the ring from the live clients, and
+        that a failed heartbeat keeps the current ring
+    """
+    mock_client = mocker.patch('google.cloud.firestore.Client')
+    collection = mock_client.return_value.collection.return_value
+    collection.where.return_value.stream.return_value = [mock.Mock(id="other")]
+
+    membership = main.ShardMembership("me", "default_printer")
+    membership.heartbeat()
+
+    collection.document.assert_called_with("me")
+    assert collection.document.return_value.set.call_args[0][0]['printer_name'] == \
+        "default_printer"
+    assert membership.ring.hosts == ["me", "other"]
+    owned = [order for order in range(100) if membership.owns(order)]
+    assert 0 < len(owned) < 100
+
+    collection.where.side_effect = RuntimeError("Error!")
+    membership.heartbeat()
+    assert membership.ring.hosts == ["me", "other"]
+
+
+def test_shard_messages_not_owned_are_nacked(mocker, monkeypatch,
+                                             receive_messsage_unit_test_fixture):
+    """ Tests that in shard mode a message for an order number owned by another print client is
+        nacked so that it can be redelivered to its owner
+    """
+    mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
+    mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
+    mock_print = mocker.patch.object(main, 'run_watched')
+    monkeypatch.setattr(main, "SHARD_MEMBERSHIP", mock.Mock(**{"owns.return_value": False}))
+
+    data = base64.b64encode(TEST_LABEL)
+    attributes = {"order_number": "1234", "event_date": TEST_EVENT_DATE}
+    msg = receive_messsage_unit_test_fixture(data, attributes)
+
+    main.ARGS.number = "shard"
+    main.received_message_to_print(msg)
+
+    main.SHARD_MEMBERSHIP.owns.assert_called_once_with(1234)
+    mock_ack.assert_not_called()
+    mock_nack.assert_called_once()
+    mock_print.assert_not_called()
+
+
+def test_replay_requires_since_or_orders():
+    """ Tests that the replay command refuses to run without a time or order range to replay """
+    with pytest.raises(SystemExit) as system_exit_e:
+        main.parse_command_line_args(["replay"])
+    assert system_exit_e.value.code == 2
+
+    args = main.parse_command_line_args(["replay", "--orders", "100-150", "--reprint"])
+    assert args.orders == range(100, 151)
+    assert args.reprint
+
+
+@pytest.mark.parametrize("value", ["abc", "5-1", "1-x"])
+def test_invalid_order_range(value):
+    """ Tests that malformed or empty order ranges are rejected """
+    with pytest.raises(argparse.ArgumentTypeError):
+        main.order_range(value)
+
+
+def test_bulk_dedup_queries_once_per_event():
+    """ Tests that duplicate checks within the replayed range are answered from a single query,
+        and that order numbers outside of it fall back to the per-message query
+    """
+    print_queue_ref = mock.Mock()
+    ranged = print_queue_ref.where.return_value.where.return_value
+    ranged.select.return_value.stream.return_value = [mock.Mock(**{"get.return_value": 101})]
+    print_queue_ref.where.return_value.stream.return_value = []
+
+    dedup = main.BulkDedup(orders=range(100, 201))
+
+    assert dedup(print_queue_ref, TEST_EVENT_DATE, 101)
+    assert not dedup(print_queue_ref, TEST_EVENT_DATE, 102)
+    ranged.select.return_value.stream.assert_called_once()
+    main.PRINTED_ORDERS.add(TEST_EVENT_DATE, 102)
+    assert dedup(print_queue_ref, TEST_EVENT_DATE, 102)
+    assert not dedup(print_queue_ref, TEST_EVENT_DATE, 999)
+    print_queue_ref.where.assert_called_with(u'order_number', u'==', 999)
+
+    assert not main.BulkDedup(orders=range(100, 201), reprint=True)(print_queue_ref,
+                                                                     TEST_EVENT_DATE, 101)
+
+
+def test_replay_prints_range(mocker, receive_messsage_unit_test_fixture):
+    """ Tests that replay seeks the subscription, prints the redelivered labels in the requested
+        range, acks the others without printing them, and finishes once the subscription goes quiet
+    """
+    mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
+    mock_client = mocker.patch('google.cloud.firestore.Client')
+    collection = mock_client.return_value.collection.return_value
+    collection.where.return_value.where.return_value.select.return_value.stream.return_value = []
+    mock_print = mocker.patch.object(main, 'run_watched')
+
+    messages = [receive_messsage_unit_test_fixture(base64.b64encode(TEST_LABEL),
+                                                   {"order_number": str(order_number),
+                                                    "event_date": TEST_EVENT_DATE})
+                for order_number in (5, 6, 7)]
+    replay = main.Replay(orders=range(5, 7), rate=1000, idle_timeout=0.05)
+    subscriber = mock.Mock()
+
+    def _subscribe(*_, callback, **__):
+        for msg in messages:
+            callback(msg)
+        return mock.Mock()
+    subscriber.subscribe.side_effect = _subscribe
+
+    assert replay.run(subscriber, "projects/p/subscriptions/print_queue",
+                      main.timestamp("2020-02-28T18:30+00:00")) == 2
+
+    assert subscriber.seek.call_args[1]['time'].seconds == 1582914600
+    assert replay.skipped == 1
+    assert mock_print.call_count == 2
+    assert mock_ack.call_count == 3
+
+
+PREFLIGHT_LIMITS = {"max_bytes": 1024 * 1024, "max_pages": 2, "max_image_pixels": 1000000}
+
+
+@pytest.mark.parametrize("data,problem", [
+    (b'1234', "PDF header"),
+    (TEST_LABEL[:-2000], "truncated"),
+    (TEST_LABEL.replace(b'startxref\n216', b'startxref\n217'), "cross-reference"),
+    (TEST_LABEL.replace(b'/Type /Page ', b'/Type /Pagx '), "no pages"),
+    (TEST_LABEL + b' ' * 1024 * 1024, "bytes"),
+])
+def test_preflight_rejects_broken_pdf(data, problem):
+    """ Tests that payloads which are not complete PDFs within limits are rejected """
+    with pytest.raises(main.PreflightError) as exc:
+        main.preflight_pdf(data, **PREFLIGHT_LIMITS)
+    assert problem in str(exc.value)
+
+
+def test_preflight_limits_pages_and_images():
+    """ Tests that page counts include compressed object streams, and that oversized embedded
+        images are rejected
+    """
+    main.preflight_pdf(TEST_LABEL, **PREFLIGHT_LIMITS)
+    with pytest.raises(main.PreflightError):
+        main.preflight_pdf(TEST_LABEL, **dict(PREFLIGHT_LIMITS, max_pages=0))
+
+    image = b'9 0 obj\n<< /Type /XObject /Subtype /Image /Width 3000 /Height 3000 >>\nstream\n'
+    assert list(main._image_pixels(image)) == [9000000]  # pylint: disable=protected-access
+
+
+def _object_stream_pdf(padding=b''):
+    """ returns a PDF whose only page is in an object stream with nested DecodeParms """
+    pages = zlib.compress(b'3 0 << /Type /Page /Parent 2 0 R >>')
+    stream = (b'<< /Type /ObjStm /N 1 /First 4 /Filter /FlateDecode '
+              b'/DecodeParms << /Columns 1 >> /Length %d >>\nstream\n' % len(pages))
+    return (b'%PDF-1.5\n4 0 obj\n' + stream + pages +
+            b'\nendstream\nendobj\nstartxref\n9\n%%EOF\n' + padding)
+
+
+@pytest.mark.parametrize("padding", [b'', b'\x00' * 2048, b'\r\n \x00\n'])
+def test_preflight_accepts_valid_pdf(padding):
+    """ Tests that pages in an object stream with nested dictionaries are counted, and that
+        padding after the %%EOF trailer is allowed
+    """
+    data = _object_stream_pdf(padding)
+    assert main.count_pages(data) == 1
+    main.preflight_pdf(data, **PREFLIGHT_LIMITS)
+
+
+def test_preflight_cached_by_content(mocker):
+    """ Tests that preflight results are cached by content hash """
+    spy = mocker.spy(main, "_preflight_problem")
+    limits = dict(PREFLIGHT_LIMITS, max_pages=3)
+
+    for _ in range(3):
+        main.preflight_pdf(TEST_LABEL, **limits)
+        with pytest.raises(main.PreflightError):
+            main.preflight_pdf(b'not a pdf', **limits)
+
+    assert spy.call_count == 2
+
+
+def test_preflight_failure_discards_label(mocker, receive_messsage_unit_test_fixture):
+    """ Tests that a truncated PDF is acked without being sent to the printer """
+    mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
+    mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
+    mock_client = mocker.patch('google.cloud.firestore.Client')
+    mock_client.return_value.collection.return_value.where.return_value.stream.return_value = []
+    mock_print = mocker.patch.object(main, 'run_watched')
 
-    data = base64.b64encode(b'1234')
+    data = base64.b64encode(TEST_LABEL[:1000])
     attributes = {"order_number": "1234", "event_date": TEST_EVENT_DATE}
     msg = receive_messsage_unit_test_fixture(data, attributes)
 
@@ -549,4 +938,1168 @@ def test_database_error_after_print(mocker, receive_messsage_unit_test_fixture):
 
     mock_ack.assert_called_once()
     mock_nack.assert_not_called()
+    mock_print.assert_not_called()
+
+
+def test_print_record_and_counter_batched(mocker, receive_messsage_unit_test_fixture):
+    """ Tests that the print record and a print counter shard increment are written together in
+        a single batch
+    """
+    mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
+    mock_client = mocker.patch('google.cloud.firestore.Client')
+    print_queue_ref = mock_client.return_value.collection.return_value
+    print_queue_ref.where.return_value.stream.return_value = []
+    counters_ref = print_queue_ref.parent.collection.return_value
+    batch = mock_client.return_value.batch.return_value
+    mocker.patch.object(main, 'run_watched')
+
+    data = base64.b64encode(TEST_LABEL)
+    attributes = {"order_number": "1234", "event_date": TEST_EVENT_DATE}
+    msg = receive_messsage_unit_test_fixture(data, attributes)
+
+    main.received_message_to_print(msg)
+
+    print_queue_ref.parent.collection.assert_called_with(u'print_counters')
+    assert batch.set.call_count == 2
+    record, counter = [call[0] for call in batch.set.call_args_list]
+    assert record == (print_queue_ref.document.return_value, mock.ANY)
+    assert record[1]['order_number'] == 1234
+    assert counter[0] == counters_ref.document.return_value
+    assert counter[1]['printer_name'] == "default_printer"
+    assert isinstance(counter[1]['count'], main.firestore.Increment)
+    assert 0 <= counter[1]['shard'] < main.ARGS.counter_shards
+    assert isinstance(counter[1]['queues']['print_queue']['wait_seconds'], main.firestore.Increment)
+    batch.commit.assert_called_once()
+
+
+def test_summary_command(mocker, capsys):
+    """ Tests that the summary command adds up the counter shards by printer and host without
+        connecting to the subscription
+    """
+    mock_client = mocker.patch('google.cloud.firestore.Client')
+    counters_ref = mock_client.return_value.collection.return_value.parent.collection.return_value
+    counters_ref.stream.return_value = [
+        mock.Mock(**{"to_dict.return_value": {"printer_name": "default_printer",
+                                              "hostname": host, "count": count,
+                                              "hangs": hangs}})
+        for host, count, hangs in [("a", 3, 0), ("a", 4, 2), ("b", 5, 0)]
+    ]
+    mock_sc = mocker.patch('google.cloud.pubsub_v1.SubscriberClient')
+
+    totals = main.main(["summary", TEST_EVENT_DATE])
+
+    assert totals == {("default_printer", "a"): 7, ("default_printer", "b"): 5}
+    out = capsys.readouterr().out
+    assert out.startswith(f"12 labels printed for event {TEST_EVENT_DATE}")
+    assert "7  (2 hung)" in out
+    mock_sc.assert_not_called()
+
+
+@pytest.mark.parametrize("encoding,encode", [
+    ("base64", base64.b64encode),
+    ("binary", lambda data: data),
+    ("gzip", gzip.compress),
+    ("zstd", lambda data: zstandard.ZstdCompressor().compress(data)),
+])
+def test_content_encodings_print(encoding, encode, mocker, receive_messsage_unit_test_fixture):
+    """ Tests that labels sent with each supported content encoding are decoded and printed """
+    mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
+    mock_client = mocker.patch('google.cloud.firestore.Client')
+    mock_client.return_value.collection.return_value.where.return_value.stream.return_value = []
+    mock_print = mocker.patch.object(main, 'run_watched')
+    written = []
+    mocker.patch.object(main, "WinNamedTempFile",
+                        return_value=mock.MagicMock(**{"__enter__.return_value.write":
+                                                       written.append}))
+
+    attributes = {"order_number": "1234", "event_date": TEST_EVENT_DATE,
+                  "content_encoding": encoding}
+    msg = receive_messsage_unit_test_fixture(encode(TEST_LABEL), attributes)
+
+    main.received_message_to_print(msg)
+
+    assert written == [TEST_LABEL]
+    mock_print.assert_called_once()
+    mock_ack.assert_called_once()
+
+
+@pytest.mark.parametrize("data,encoding", [
+    (TEST_LABEL, "bzip2"),
+    (b'not gzip', "gzip"),
+    (gzip.compress(TEST_LABEL)[:-20], "gzip"),
+    (b'not zstd', "zstd"),
+    (gzip.compress(b'\0' * 2 * 1024 * 1024), "gzip"),
+])
+def test_undecodable_content_discarded(data, encoding, mocker,
+                                       receive_messsage_unit_test_fixture):
+    """ Tests that unsupported encodings, corrupt compressed data and payloads inflating past the
+        size limit are acked without being printed
+    """
+    mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
+    mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
+    mock_client = mocker.patch('google.cloud.firestore.Client')
+    mock_client.return_value.collection.return_value.where.return_value.stream.return_value = []
+    mock_print = mocker.patch.object(main, 'run_watched')
+
+    main.ARGS.max_pdf_bytes = 1024 * 1024
+    attributes = {"order_number": "1234", "event_date": TEST_EVENT_DATE,
+                  "content_encoding": encoding}
+    msg = receive_messsage_unit_test_fixture(data, attributes)
+
+    main.received_message_to_print(msg)
+
+    mock_ack.assert_called_once()
+    mock_nack.assert_not_called()
+    mock_print.assert_not_called()
+
+
+TEST_TEMPLATE = {
+    "width": 162, "height": 90,
+    "elements": [{"text": "#{order_number}", "x": 8, "y": 66, "size": 20,
+                  "font": "Helvetica-Bold"},
+                 {"text": "{name}", "x": 80, "y": 70},
+                 {"text": "{items}", "x": 8, "y": 50, "size": 8, "leading": 9}],
+}
+
+
+@pytest.fixture
+def template_dir(tmp_path):
+    """ installs TEST_TEMPLATE as template 'order' and points the client at it """
+    (tmp_path / "order.json").write_text(json.dumps(TEST_TEMPLATE))
+    main.ARGS.template_dir = str(tmp_path)
+    return tmp_path
+
+
+def test_template_renders_printable_pdf(template_dir):
+    """ Tests that a template renders fields (escaping PDF syntax and putting list items on
+        separate lines) into a PDF that passes preflight
+    """
+    pdf = main.render_label("order", b'{"name": "Smith (J)", "items": ["2x Fish", "1x Fries"]}',
+                            {"order_number": "12"})
+
+    main.preflight_pdf(pdf, **PREFLIGHT_LIMITS)
+    assert b"(#12) Tj" in pdf
+    assert b"(Smith \\(J\\)) Tj" in pdf
+    assert b"(2x Fish) Tj T* (1x Fries) Tj" in pdf
+
+
+def test_template_parsed_once(template_dir, mocker):
+    """ Tests that templates are parsed once and only parsed again when their file changes """
+    spy = mocker.spy(main, "LabelTemplate")
+
+    for _ in range(3):
+        main.load_template(str(template_dir), "order")
+    assert spy.call_count == 1
+
+    os.utime(template_dir / "order.json", (0, 0))
+    main.load_template(str(template_dir), "order")
+    assert spy.call_count == 2
+
+
+@pytest.mark.parametrize("spec,template_id", [
+    ({"width": 10, "height": 10, "elements": [{"text": "x", "x": 0, "y": 0, "font": "Comic"}]},
+     "order"),
+    ({"width": 10, "elements": []}, "order"),
+    (TEST_TEMPLATE, "../order"),
+])
+def test_invalid_templates(spec, template_id, template_dir):
+    """ Tests that templates with unknown fonts, missing dimensions or unsafe ids are rejected """
+    (template_dir / "order.json").write_text(json.dumps(spec))
+    with pytest.raises(main.TemplateError):
+        main.load_template(str(template_dir), template_id)
+
+
+@pytest.mark.parametrize("template_id,data,acked", [
+    ("order", b'{"name": "Smith", "items": ["2x Fish"]}', True),
+    ("order", b'not json', True),
+    ("missing", b'{}', False),
+])
+def test_template_messages(template_id, data, acked, template_dir, mocker,
+                           receive_messsage_unit_test_fixture):
+    """ Tests that template messages are rendered and printed, that invalid field data is
+        discarded, and that a template not installed here is nacked for another client to print
+    """
+    mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
+    mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
+    mock_client = mocker.patch('google.cloud.firestore.Client')
+    mock_client.return_value.collection.return_value.where.return_value.stream.return_value = []
+    mock_print = mocker.patch.object(main, 'run_watched')
+    mocker.patch.object(time, "sleep")
+
+    attributes = {"order_number": "1234", "event_date": TEST_EVENT_DATE,
+                  "template_id": template_id, "content_encoding": "binary"}
+    msg = receive_messsage_unit_test_fixture(data, attributes)
+
+    main.received_message_to_print(msg)
+
+    assert mock_ack.called == acked
+    assert mock_nack.called != acked
+    assert mock_print.called == (data.startswith(b'{') and template_id == "order")
+
+
+def test_state_snapshot_round_trip(tmp_path):
+    """ Tests that printers, printed orders and preflight results survive a save and restore """
+    main._PREFLIGHT_CACHE.clear()  # pylint: disable=protected-access
+    main.PRINTED_ORDERS.add(TEST_EVENT_DATE, 1234)
+    main.preflight_pdf(TEST_LABEL, **PREFLIGHT_LIMITS)
+    path = str(tmp_path / "state.json.gz")
+    main.save_state(path, ["projects/p/subscriptions/print_queue"])
+
+    main.PRINTED_ORDERS = main.PrintedOrders()
+    main._PREFLIGHT_CACHE.clear()  # pylint: disable=protected-access
+    state = main.load_state(path)
+    main.restore_state(state)
+
+    assert state["subscriptions"] == ["projects/p/subscriptions/print_queue"]
+    assert main.Printers().printers == ["default_printer", "good_printer"]
+    assert main.Printers().default_printer == "default_printer"
+    assert (TEST_EVENT_DATE, 1234) in main.PRINTED_ORDERS
+    assert (TEST_EVENT_DATE, 1235) not in main.PRINTED_ORDERS
+    assert len(main._PREFLIGHT_CACHE) == 1  # pylint: disable=protected-access
+
+
+@pytest.mark.parametrize("contents", [b"not gzip", gzip.compress(b'{"version": 0}')])
+def test_unusable_state_snapshot_ignored(contents, tmp_path):
+    """ Tests that a corrupt snapshot, or one from another version, is ignored """
+    path = tmp_path / "state.json.gz"
+    path.write_bytes(contents)
+    assert main.load_state(str(path)) is None
+    assert main.load_state(str(tmp_path / "missing.json.gz")) is None
+
+
+def test_printed_orders_kept_for_recent_events():
+    """ Tests that printed order numbers are only remembered for the most recent events """
+    printed = main.PrintedOrders()
+    for day in range(1, main.PrintedOrders.MAX_EVENTS + 2):
+        printed.add(f"1900-01-0{day}", 7)
+    assert ("1900-01-01", 7) not in printed
+    assert (f"1900-01-0{main.PrintedOrders.MAX_EVENTS + 1}", 7) in printed
+
+
+def test_warm_start_skips_discovery_and_drains(mocker):
+    """ Tests that a client restarted with a state snapshot doesn't wait on discovering printers
+        or subscriptions before subscribing, and that it drains and saves state when stopping
+    """
+    subscription_path = "projects/print-client-123456/subscriptions/print_queue"
+    main.save_state(main.DEFAULT_STATE_FILE, [subscription_path])
+    mock_sc = mocker.patch('google.cloud.pubsub_v1.SubscriberClient')
+    mock_sc.return_value.subscription_path.return_value = subscription_path
+    mock_scan = mocker.patch.object(main.Printers, "_scan")
+    mock_validate = mocker.patch.object(main, "validate_state")
+    mocker.patch.object(main, "block", return_value=False)
+
+    main.main(["--readiness-interval", "0"])
+
+    mock_scan.assert_not_called()
+    mock_sc.return_value.list_subscriptions.assert_not_called()
+    mock_validate.assert_called_once()
+    mock_sc.return_value.subscribe.return_value.cancel.assert_called_once()
+    assert main.SHUTDOWN.is_set()
+    assert main.load_state(main.DEFAULT_STATE_FILE)["subscriptions"] == [subscription_path]
+
+
+def test_messages_released_while_shutting_down(mocker, receive_messsage_unit_test_fixture):
+    """ Tests that labels delivered after shutdown is requested are left for another client """
+    mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
+    mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
+    mock_print = mocker.patch.object(main, 'run_watched')
+    main.SHUTDOWN.set()
+
+    msg = receive_messsage_unit_test_fixture(base64.b64encode(TEST_LABEL),
+                                             {"order_number": "1234",
+                                              "event_date": TEST_EVENT_DATE})
+    main.received_message_to_print(msg)
+
+    mock_nack.assert_called_once()
+    mock_ack.assert_not_called()
+    mock_print.assert_not_called()
+
+
+def test_messages_released_when_shutdown_while_scheduled(mocker,
+                                                        receive_messsage_unit_test_fixture):
+    """ Tests that a label waiting for the printer when shutdown is requested gives up its slot
+        and is left for another client
+    """
+    mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
+    mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
+    mock_client = mocker.patch('google.cloud.firestore.Client')
+    mock_client.return_value.collection.return_value.where.return_value.stream.return_value = []
+    mock_print = mocker.patch.object(main, 'run_watched')
+    main.SCHEDULER = main.WeightedFairScheduler(slots=1)
+    slot = main.SCHEDULER.slot
+
+    @contextlib.contextmanager
+    def slot_during_shutdown(queue_name, cost=1.0):
+        with slot(queue_name, cost) as waited:
+            main.SHUTDOWN.set()
+            yield waited
+
+    mocker.patch.object(main.SCHEDULER, 'slot', slot_during_shutdown)
+
+    msg = receive_messsage_unit_test_fixture(base64.b64encode(TEST_LABEL),
+                                             {"order_number": "1234",
+                                              "event_date": TEST_EVENT_DATE})
+    main.received_message_to_print(msg)
+
+    mock_nack.assert_called_once()
+    mock_ack.assert_not_called()
+    mock_print.assert_not_called()
+    # the only slot is free again
+    released = threading.Thread(target=lambda: slot("other").__enter__(), daemon=True)
+    released.start()
+    released.join(5)
+    assert not released.is_alive()
+
+
+def test_message_traced_to_file(mocker, monkeypatch, tmp_path, receive_messsage_unit_test_fixture):
+    """ Tests that each step of printing a label is traced, from publish through to ack """
+    mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
+    mock_client = mocker.patch('google.cloud.firestore.Client')
+    mock_client.return_value.collection.return_value.where.return_value.stream.return_value = []
+    mocker.patch.object(main, 'run_watched')
+    path = str(tmp_path / "traces.jsonl")
+    monkeypatch.setattr(main, "TRACE_EXPORTERS", [main.TraceFileExporter(path, 1024 * 1024)])
+
+    msg = receive_messsage_unit_test_fixture(base64.b64encode(TEST_LABEL),
+                                             {"order_number": "1234",
+                                              "event_date": TEST_EVENT_DATE})
+    main.received_message_to_print(msg)
+    main.stop_tracing()
+
+    [trace] = main.slowest_traces(path, 10)
+    assert trace["message_id"] == msg.message_id
+    assert trace["order_number"] == "1234"
+    assert trace["outcome"] == "ack"
+    assert [span["name"] for span in trace["spans"]] == [
+        "receive", "validate", "wait", "dedup", "decode", "preflight", "schedule", "spool",
+        "record", "ack"]
+    assert trace["spans"][0]["start"] == 0
+
+
+def test_slowest_command(tmp_path, capsys):
+    """ Tests that the slowest command lists the slowest traced labels in the requested window,
+        including those in rotated trace files
+    """
+    path = str(tmp_path / "traces.jsonl")
+    exporter = main.TraceFileExporter(path, 1)
+    for order_number, (hour, duration) in enumerate([(10, 4.0), (11, 40.0), (12, 2.5), (13, 9.0)]):
+        exporter.export({"trace_id": "t", "message_id": str(order_number),
+                         "order_number": str(order_number), "event_date": TEST_EVENT_DATE,
+                         "publish_time": f"1900-01-01T{hour}:00:00+00:00", "duration": duration,
+                         "outcome": "ack",
+                         "spans": [{"name": "spool", "start": 0.5, "duration": duration - 1}]})
+    exporter.stop()
+    with open(f"{path}.1", "a") as trace_file:
+        trace_file.write('{"truncated": ')
+
+    args = ["--trace-file", path, "slowest", "--count", "2", "--until", "1900-01-01T13:00+00:00"]
+    traces = main.main(args)
+
+    assert [trace["order_number"] for trace in traces] == ["1", "0"]
+    assert "spool 39.00s" in capsys.readouterr().out
+
+    with pytest.raises(SystemExit):
+        main.parse_command_line_args(["slowest"])
+
+
+def test_traces_exported_to_otlp_collector(mocker):
+    """ Tests that traces are posted to a collector as a span tree under one root span """
+    mock_urlopen = mocker.patch('urllib.request.urlopen')
+    exporter = main.OtlpTraceExporter("http://localhost:4318/v1/traces")
+    exporter.export({"trace_id": "ab" * 16, "message_id": "1", "order_number": "7",
+                     "event_date": TEST_EVENT_DATE, "publish_time": "1900-01-01T10:00:00+00:00",
+                     "duration": 3.0, "outcome": "ack",
+                     "spans": [{"name": "receive", "start": 0, "duration": 1.0},
+                               {"name": "spool", "start": 1.0, "duration": 2.0}]})
+    exporter.stop()
+
+    request = mock_urlopen.call_args[0][0]
+    assert request.full_url == "http://localhost:4318/v1/traces"
+    spans = json.loads(request.data)["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert [span["name"] for span in spans] == ["print_message", "receive", "spool"]
+    assert {span.get("parentSpanId") for span in spans[1:]} == {spans[0]["spanId"]}
+    assert int(spans[0]["endTimeUnixNano"]) - int(spans[0]["startTimeUnixNano"]) == 3 * 10**9
+
+
+def test_pbm_to_zpl():
+    """ Tests that each page of a PBM bitmap is encoded as a ZPL graphic field """
+    page = b"P4\n# Image generated by Ghostscript\n10 2\n" + bytes([0xFF, 0xC0, 0x80, 0x40])
+    assert main.pbm_to_zpl(page * 2) == b"^XA^FO0,0^GFA,4,4,2,FFC08040^FS^XZ\n" * 2
+    with pytest.raises(ValueError):
+        main.pbm_to_zpl(page[:-1])
+
+
+def test_native_label_sent_raw(mocker, receive_messsage_unit_test_fixture):
+    """ Tests that printer-native labels are sent straight to the printer without Ghostscript """
+    mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
+    mock_client = mocker.patch('google.cloud.firestore.Client')
+    mock_client.return_value.collection.return_value.where.return_value.stream.return_value = []
+    mock_print = mocker.patch.object(main, 'run_watched')
+    mock_win32print = mocker.patch.object(main, "win32print")
+
+    msg = receive_messsage_unit_test_fixture(b"^XA^FO50,50^FDHello^FS^XZ",
+                                             {"order_number": "1234", "format": "zpl",
+                                              "content_encoding": "binary",
+                                              "event_date": TEST_EVENT_DATE})
+    main.received_message_to_print(msg)
+
+    mock_ack.assert_called_once()
+    mock_print.assert_not_called()
+    handle = mock_win32print.OpenPrinter.return_value
+    mock_win32print.OpenPrinter.assert_called_once_with("default_printer")
+    mock_win32print.WritePrinter.assert_called_once_with(handle, b"^XA^FO50,50^FDHello^FS^XZ")
+    mock_win32print.ClosePrinter.assert_called_once_with(handle)
+
+
+def test_native_label_send_times_out(mocker, caplog, receive_messsage_unit_test_fixture):
+    """ Tests that a raw send stuck in the spooler is given up on after --print-timeout, and is
+        logged as a recycled worker and retried like a hung Ghostscript
+    """
+    main.ARGS = main.Config(main.parse_command_line_args(["--print-timeout", "0.2"]))
+    mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
+    mock_client = mocker.patch('google.cloud.firestore.Client')
+    mock_client.return_value.collection.return_value.where.return_value.stream.return_value = []
+    mocker.patch.object(main.time, 'sleep')
+    mock_hang = mocker.patch.object(main, 'record_hang')
+    mock_win32print = mocker.patch.object(main, "win32print")
+    stuck = threading.Event()
+    mock_win32print.WritePrinter.side_effect = lambda handle, data: stuck.wait(5)
+
+    msg = receive_messsage_unit_test_fixture(b"^XA^XZ", {"order_number": "1234", "format": "zpl",
+                                                        "content_encoding": "binary",
+                                                        "event_date": TEST_EVENT_DATE})
+    try:
+        main.received_message_to_print(msg)
+    finally:
+        stuck.set()
+
+    mock_nack.assert_called_once()
+    mock_hang.assert_called_once()
+    assert "Recycled print worker sending 'Order #1234' to 'default_printer'" in caplog.text
+
+
+@pytest.mark.parametrize("attributes", [{"format": "epl"},
+                                        {"format": "zpl", "template_id": "order"}])
+def test_unsupported_label_format_discarded(attributes, mocker,
+                                            receive_messsage_unit_test_fixture):
+    """ Tests that labels in a format we can't print (or can't render to) are discarded """
+    mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
+    mock_print = mocker.patch.object(main, 'run_watched')
+
+    msg = receive_messsage_unit_test_fixture(b"^XA^XZ", {"order_number": "1234",
+                                                        "event_date": TEST_EVENT_DATE,
+                                                        **attributes})
+    main.received_message_to_print(msg)
+
+    mock_ack.assert_called_once()
+    mock_print.assert_not_called()
+
+
+def test_pdf_converted_to_native_once(mocker, tmp_path, receive_messsage_unit_test_fixture):
+    """ Tests that with --native-format a PDF label is converted once, and the cached conversion
+        is sent raw to the printer when the label is printed again
+    """
+    mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
+    mock_client = mocker.patch('google.cloud.firestore.Client')
+    mock_client.return_value.collection.return_value.where.return_value.stream.return_value = []
+    mock_run = mocker.patch.object(main, 'run_watched')
+    mock_run.return_value = b"P4\n8 1\n\xAA"
+    mock_win32print = mocker.patch.object(main, "win32print")
+    main.ARGS = main.Config(main.parse_command_line_args(["--native-format", "zpl",
+                                                          "--native-cache-dir", str(tmp_path)]))
+
+    for _ in range(2):
+        msg = receive_messsage_unit_test_fixture(base64.b64encode(TEST_LABEL),
+                                                 {"order_number": "1234", "reprint": "true",
+                                                  "event_date": TEST_EVENT_DATE})
+        main.received_message_to_print(msg)
+
+    mock_run.assert_called_once()
+    assert "-sDEVICE=pbmraw" in mock_run.call_args[0][0]
+    assert [c[0][1] for c in mock_win32print.WritePrinter.call_args_list] == \
+        [b"^XA^FO0,0^GFA,1,1,1,AA^FS^XZ\n"] * 2
+    assert len(os.listdir(tmp_path)) == 1
+
+
+def test_pdf_optimized_once(mocker, tmp_path, receive_messsage_unit_test_fixture):
+    """ Tests that with --optimize a PDF label is downsampled to the printer resolution once, and
+        the cached optimized label is what gets printed, including when it is printed again
+    """
+    mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
+    mock_client = mocker.patch('google.cloud.firestore.Client')
+    mock_client.return_value.collection.return_value.where.return_value.stream.return_value = []
+    printed = []
+
+    def _run_watched(command, timeout, capture_output=False):
+        pdf_path = command.rsplit('"', 2)[-2]
+        if "-sDEVICE=pdfwrite" in command:
+            with open(command.split('-sOutputFile="')[1].split('"')[0], 'wb') as optimized:
+                optimized.write(b"%PDF-1.4 optimized")
+        else:
+            with open(pdf_path, 'rb') as pdf:
+                printed.append(pdf.read())
+
+    mock_run = mocker.patch.object(main, 'run_watched', side_effect=_run_watched)
+    main.ARGS = main.Config(main.parse_command_line_args(["--optimize", "--optimize-dpi", "300",
+                                                          "--optimize-cache-dir", str(tmp_path)]))
+
+    for _ in range(2):
+        msg = receive_messsage_unit_test_fixture(base64.b64encode(TEST_LABEL),
+                                                 {"order_number": "1234", "reprint": "true",
+                                                  "event_date": TEST_EVENT_DATE})
+        main.received_message_to_print(msg)
+
+    optimize_commands = [c[0][0] for c in mock_run.call_args_list if "pdfwrite" in c[0][0]]
+    assert len(optimize_commands) == 1
+    assert "-dColorImageResolution=300" in optimize_commands[0]
+    assert printed == [b"%PDF-1.4 optimized"] * 2
+    assert len(os.listdir(tmp_path)) == 1
+
+
+def test_cache_tolerates_concurrent_jobs(mocker, tmp_path):
+    """ Tests that cached conversions are written via their own temporary file, which eviction
+        leaves alone, and that a file evicted by another job during the sweep is skipped
+    """
+    (tmp_path / "other.zpl.1a2b.tmp").write_bytes(b"being written by another job")
+    for name in ("a.zpl", "b.zpl"):
+        assert main._cached(str(tmp_path), name, 1, lambda: b"converted") == b"converted"
+    assert sorted(os.listdir(tmp_path)) == ["b.zpl", "other.zpl.1a2b.tmp"]
+
+    getmtime = os.path.getmtime
+
+    def _evicted_meanwhile(path):
+        if path.endswith("b.zpl"):
+            os.remove(path)
+        return getmtime(path)
+
+    mocker.patch.object(main.os.path, "getmtime", side_effect=_evicted_meanwhile)
+    assert main._cached(str(tmp_path), "c.zpl", 1, lambda: b"converted") == b"converted"
+    assert sorted(os.listdir(tmp_path)) == ["c.zpl", "other.zpl.1a2b.tmp"]
+
+
+@pytest.mark.skipif(os.name == 'nt', reason="uses a POSIX shell")
+def test_run_watched_kills_process_tree(tmp_path, caplog):
+    """ Tests that a command that runs past its timeout is killed along with its children, and
+        that failures and output are reported like subprocess.run(check=True)
+    """
+    pid_file = tmp_path / "child.pid"
+    with pytest.raises(subprocess.TimeoutExpired):
+        main.run_watched(f"sleep 30 & echo $! > {pid_file}; wait", 0.5)
+    assert "Recycled print worker 'sleep 30" in caplog.text
+
+    child = int(pid_file.read_text())
+    for _ in range(50):
+        try:
+            os.kill(child, 0)
+        except ProcessLookupError:
+            break
+        time.sleep(0.05)
+    else:
+        pytest.fail("child process was not killed")
+
+    with pytest.raises(subprocess.CalledProcessError):
+        main.run_watched("exit 3", 5)
+    assert main.run_watched("echo label", 5, capture_output=True) == b"label\n"
+
+
+def test_print_timeout_scales_with_pages():
+    """ Tests that labels are given longer to print the more pages they have """
+    main.ARGS = main.Config(main.parse_command_line_args(["--print-timeout", "20",
+                                                          "--print-timeout-per-page", "5"]))
+    assert main.print_timeout(TEST_LABEL) == 25
+    assert main.print_timeout(TEST_LABEL.replace(b"/Type /Page ", b"/Type /Page " * 3)) == 35
+
+
+def test_hung_print_retried_and_counted(mocker, receive_messsage_unit_test_fixture):
+    """ Tests that a print job killed by the watchdog is retried and counted as a hang """
+    mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
+    mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
+    mock_client = mocker.patch('google.cloud.firestore.Client')
+    print_queue_ref = mock_client.return_value.collection.return_value
+    print_queue_ref.where.return_value.stream.return_value = []
+    mocker.patch.object(main, 'run_watched',
+                        side_effect=subprocess.TimeoutExpired(cmd="gswin64.exe", timeout=40))
+    mocker.patch.object(time, "sleep")
+
+    msg = receive_messsage_unit_test_fixture(base64.b64encode(TEST_LABEL),
+                                             {"order_number": "1234",
+                                              "event_date": TEST_EVENT_DATE})
+    main.received_message_to_print(msg)
+
+    mock_nack.assert_called_once()
+    mock_ack.assert_not_called()
+    counter_ref = print_queue_ref.parent.collection.return_value.document.return_value
+    counter, = counter_ref.set.call_args[0]
+    assert counter["printer_name"] == "default_printer"
+    assert isinstance(counter["hangs"], main.firestore.Increment)
+
+
+def _failing_print_message(receive_messsage_unit_test_fixture):
+    return receive_messsage_unit_test_fixture(base64.b64encode(TEST_LABEL),
+                                              {"order_number": "1234",
+                                               "event_date": TEST_EVENT_DATE})
+
+
+def test_poison_label_quarantined(mocker, tmp_path, receive_messsage_unit_test_fixture):
+    """ Tests that a label which keeps failing to print is quarantined and acked, and published to
+        the dead-letter topic, once it has failed --max-print-attempts times
+    """
+    mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
+    mock_nack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
+    mock_client = mocker.patch('google.cloud.firestore.Client')
+    mock_client.return_value.collection.return_value.where.return_value.stream.return_value = []
+    mocker.patch.object(main, 'run_watched',
+                        side_effect=subprocess.CalledProcessError(cmd="gswin64.exe", returncode=1))
+    mocker.patch.object(time, "sleep")
+    publisher = mock.Mock()
+    mocker.patch.object(main, "DEAD_LETTER", (publisher, "projects/p/topics/dead_labels"))
+    main.ARGS = main.Config(main.parse_command_line_args(["--max-print-attempts", "3",
+                                                          "--quarantine-dir", str(tmp_path)]))
+
+    for _ in range(3):
+        main.received_message_to_print(_failing_print_message(receive_messsage_unit_test_fixture))
+
+    assert mock_nack.call_count == 2
+    mock_ack.assert_called_once()
+    [label] = main.quarantined_labels(str(tmp_path))
+    assert label["attempts"] == 3
+    assert label["attributes"]["order_number"] == "1234"
+    assert base64.b64decode(label["data"]) == base64.b64encode(TEST_LABEL)
+    topic, data = publisher.publish.call_args[0]
+    assert topic == "projects/p/topics/dead_labels"
+    assert data == base64.b64encode(TEST_LABEL)
+
+
+@pytest.mark.parametrize("delivery_attempt,printer_ready,quarantined", [
+    (5, True, True),
+    (2, True, False),
+    (None, False, False),
+])
+def test_quarantine_uses_delivery_attempt(delivery_attempt, printer_ready, quarantined, mocker,
+                                          tmp_path, receive_messsage_unit_test_fixture):
+    """ Tests that Pub/Sub's delivery attempt is used where it is available, and that failures
+        while the printer is not ready aren't blamed on the label
+    """
+    mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
+    mock_client = mocker.patch('google.cloud.firestore.Client')
+    mock_client.return_value.collection.return_value.where.return_value.stream.return_value = []
+    mocker.patch.object(main, 'run_watched',
+                        side_effect=subprocess.CalledProcessError(cmd="gswin64.exe", returncode=1))
+    mocker.patch.object(time, "sleep")
+    mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.nack')
+    monitor = mock.Mock(**{"check.return_value": printer_ready})
+    mocker.patch.object(main, "PRINTER_MONITOR", monitor)
+    max_attempts = "1" if delivery_attempt is None else "5"
+    main.ARGS = main.Config(main.parse_command_line_args(["--max-print-attempts", max_attempts,
+                                                          "--quarantine-dir", str(tmp_path)]))
+
+    msg = _failing_print_message(receive_messsage_unit_test_fixture)
+    msg.delivery_attempt = delivery_attempt
+    main.received_message_to_print(msg)
+
+    assert mock_ack.called == quarantined
+    assert len(main.quarantined_labels(str(tmp_path))) == quarantined
+
+
+def test_quarantine_command(mocker, tmp_path, capsys):
+    """ Tests that quarantined labels can be listed, requeued to the print topic, and discarded """
+    main.ARGS = main.Config(main.parse_command_line_args(["--quarantine-dir", str(tmp_path)]))
+    for order_number in ("1", "2"):
+        msg = mock.Mock(message_id=f"id-{order_number}", data=b"label " + order_number.encode(),
+                        attributes={"order_number": order_number, "event_date": TEST_EVENT_DATE})
+        main.quarantine_message(msg, "gs failed", 5)
+    mock_pc = mocker.patch('google.cloud.pubsub_v1.PublisherClient')
+    mock_pc.return_value.topic_path.return_value = "projects/p/topics/print_queue"
+
+    args = ["--quarantine-dir", str(tmp_path), "quarantine"]
+    assert len(main.main(args)) == 2
+    assert "2 labels quarantined" in capsys.readouterr().out
+    mock_pc.assert_not_called()
+
+    [requeued] = main.main(args + ["requeue", "id-1"])
+    assert requeued["message_id"] == "id-1"
+    mock_pc.return_value.publish.assert_called_once_with(
+        "projects/p/topics/print_queue", b"label 1", order_number="1", event_date=TEST_EVENT_DATE)
+
+    main.main(args + ["discard"])
+    assert main.quarantined_labels(str(tmp_path)) == []
+
+
+def test_requeued_label_quarantined_again(mocker, tmp_path):
+    """ Tests that a label requeued from the dead-letter topic can be quarantined again, with the
+        new reason replacing the one it was dead-lettered with
+    """
+    main.ARGS = main.Config(main.parse_command_line_args(["--quarantine-dir", str(tmp_path)]))
+    publisher = mock.Mock()
+    mocker.patch.object(main, "DEAD_LETTER", (publisher, "projects/p/topics/dead_labels"))
+    msg = mock.Mock(message_id="id-1", data=b"label 1",
+                    attributes={"order_number": "1", "event_date": TEST_EVENT_DATE,
+                                "quarantine_reason": "gs failed"})
+
+    main.quarantine_message(msg, "print timed out", 5)
+
+    publisher.publish.assert_called_once_with(
+        "projects/p/topics/dead_labels", b"label 1", order_number="1",
+        event_date=TEST_EVENT_DATE, quarantine_reason="print timed out")
+    [label] = main.quarantined_labels(str(tmp_path))
+    assert label["reason"] == "print timed out"
+
+
+def test_weighted_fair_scheduler():
+    """ Tests that waiting labels take turns at the printer in proportion to their queue's weight,
+        so that a burst on one queue doesn't starve another
+    """
+    scheduler = main.WeightedFairScheduler({"burst": 2, "other": 1}, slots=1)
+    granted = []
+    holding = threading.Event()
+    release = threading.Event()
+
+    def _hold():
+        with scheduler.slot("holder"):
+            holding.set()
+            release.wait()
+
+    def _print(queue_name):
+        with scheduler.slot(queue_name):
+            granted.append(queue_name)
+
+    threads = [threading.Thread(target=_hold)]
+    threads[0].start()
+    holding.wait()
+    for queue_name in ["burst"] * 6 + ["other"] * 2:
+        threads.append(threading.Thread(target=_print, args=(queue_name,)))
+        threads[-1].start()
+    waiting = scheduler._waiting  # pylint: disable=protected-access
+    while sum(len(tickets) for tickets in waiting.values()) < 8:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert granted == ["burst", "other", "burst", "burst", "other", "burst", "burst", "burst"]
+    count, mean, longest = scheduler.wait_stats()["other"]
+    assert count == 2 and 0 < mean <= longest
+
+
+def test_multiple_queues_subscribed(mocker):
+    """ Tests that a subscription is opened for each queue, with the queue's weight scheduled """
+    mock_sc = mocker.patch('google.cloud.pubsub_v1.SubscriberClient')
+    mock_sc.return_value.subscription_path.side_effect = \
+        lambda project, name: f"projects/{project}/subscriptions/{name}"
+    subscriptions = [mock.Mock() for _ in range(2)]
+    for subscription, name in zip(subscriptions, ["kitchen", "pickup"]):
+        subscription.name = f"projects/print-client-123456/subscriptions/{name}"
+    mock_sc.return_value.list_subscriptions.return_value = subscriptions
+    mocker.patch.object(main, "block", return_value=False)
+
+    main.main(["--readiness-interval", "0", "-q", "kitchen=2", "--queue", "pickup"])
+
+    callbacks = {call[0][0]: call[1]["callback"]
+                 for call in mock_sc.return_value.subscribe.call_args_list}
+    assert {path.rsplit("/", 1)[-1]: callback.keywords["queue_name"]
+            for path, callback in callbacks.items()} == {"kitchen": "kitchen", "pickup": "pickup"}
+    assert main.SCHEDULER.weights == {"kitchen": 2.0, "pickup": 1.0}
+    assert mock_sc.return_value.subscribe.return_value.cancel.call_count == 2
+
+    with pytest.raises(SystemExit):
+        main.parse_command_line_args(["--queue", "kitchen=0"])
+
+
+def test_traffic_capture(mocker, tmp_path, receive_messsage_unit_test_fixture):
+    """ Tests that received messages are captured with their timing, attributes and size (and
+        optionally payload), and that appended and unfinished captures can be read back
+    """
+    mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
+    path = str(tmp_path / "capture.jsonl.gz")
+    attributes = {"order_number": "1234", "event_date": TEST_EVENT_DATE}
+    msg = receive_messsage_unit_test_fixture(base64.b64encode(TEST_LABEL), attributes)
+
+    for payloads in (True, False):
+        capture = main.TrafficCapture(path, payloads=payloads)
+        mocker.patch.object(main, "CAPTURE", capture)
+        mocker.patch.object(main, "_print_message")
+        for queue_name in ("kitchen", "pickup"):
+            main.received_message_to_print(msg, queue_name=queue_name)
+        capture.stop()
+
+    records = list(main.read_capture(path))
+    assert [record["queue"] for record in records] == ["kitchen", "pickup"] * 2
+    assert [record["t"] for record in records] == sorted(record["t"] for record in records)
+    assert all(record["attributes"] == attributes for record in records)
+    assert all(record["size"] == len(base64.b64encode(TEST_LABEL)) for record in records)
+    assert base64.b64decode(records[0]["data"]) == base64.b64encode(TEST_LABEL)
+    assert "data" not in records[2]
+
+    with open(path, "rb") as capture_file:
+        truncated = capture_file.read()[:-10]
+    with open(path, "wb") as capture_file:
+        capture_file.write(truncated)
+    assert len(list(main.read_capture(path))) >= 2
+
+
+def test_fake_printer(mocker, receive_messsage_unit_test_fixture):
+    """ Tests that labels are not sent to a printer when load testing with a fake printer """
+    mock_ack = mocker.patch('google.cloud.pubsub_v1.subscriber.message.Message.ack')
+    mock_client = mocker.patch('google.cloud.firestore.Client')
+    mock_client.return_value.collection.return_value.where.return_value.stream.return_value = []
+    mock_print = mocker.patch.object(main, 'run_watched')
+    main.ARGS = main.Config(main.parse_command_line_args(["--fake-printer", "0"]))
+
+    msg = receive_messsage_unit_test_fixture(base64.b64encode(TEST_LABEL),
+                                             {"order_number": "1234",
+                                              "event_date": TEST_EVENT_DATE})
+    main.received_message_to_print(msg)
+
+    mock_print.assert_not_called()
+    mock_ack.assert_called_once()
+
+
+def test_config_reload(mocker, tmp_path):
+    """ Tests that a changed config file replaces settings between jobs, that settings which need
+        a restart (including a switch to --number shard) keep their value, and that an invalid
+        file is not applied
+    """
+    mocker.patch.object(main, "PRINTER_MONITOR", None)
+    config_path = tmp_path / "print-client.conf"
+    base_args = ["--printer", "default_printer", "--state-file", "state.json.gz"]
+    main.ARGS = main.Config(main.parse_command_line_args(base_args))
+    reloader = main.ConfigReloader(base_args, str(config_path))
+
+    config_path.write_text("--printer=good_printer\n--state-file=other.json.gz\n--number=odd\n")
+    with main.ARGS.job():
+        assert reloader.reload() == {"printer", "number"}
+        assert main.ARGS.printer == "default_printer"
+    assert main.ARGS.printer == "good_printer"
+    assert main.ARGS.state_file == "state.json.gz"
+    assert main.ARGS.number == "odd"
+
+    config_path.write_text("--printer=good_printer\n--number=shard\n")
+    assert reloader.reload() == set()
+    assert main.ARGS.number == "odd"
+
+    config_path.write_text("--print-timeout=soon\n")
+    with pytest.raises(ValueError, match="print-timeout"):
+        reloader.reload()
+    assert main.ARGS.printer == "good_printer"
+
+
+def test_config_admin_endpoint(mocker):
+    """ Tests that the admin endpoint returns the current settings and overrides them """
+    mocker.patch.object(main, "PRINTER_MONITOR", None)
+    main.ARGS = main.Config(main.parse_command_line_args(["--printer", "default_printer"]))
+    with socket.socket() as free_port:
+        free_port.bind(("127.0.0.1", 0))
+        port = free_port.getsockname()[1]
+    reloader = main.ConfigReloader(["--printer", "default_printer"], admin_port=port)
+    reloader.start()
+    url = "http://127.0.0.1:%d/config" % port
+    try:
+        with urllib.request.urlopen(url) as response:
+            assert json.load(response)["printer"] == "default_printer"
+
+        request = urllib.request.Request(url, data=json.dumps(["--max-print-attempts=2"]).encode(),
+                                         method="POST")
+        with urllib.request.urlopen(request) as response:
+            assert json.load(response) == {"changed": ["max_print_attempts"]}
+        assert main.ARGS.max_print_attempts == 2
+
+        request = urllib.request.Request(url, data=b'{"printer": "good_printer"}', method="POST")
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(request)
+        assert error.value.code == 400
+
+        request = urllib.request.Request(url, data=b'["--help"]', method="POST")
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(request)
+        assert error.value.code == 400
+        assert json.load(error.value) == {"error": "invalid arguments"}
+    finally:
+        reloader.stop()
+
+
+def test_config_reloader_keeps_watching(mocker, tmp_path):
+    """ Tests that the config file is still watched after it couldn't be read (as while an editor
+        has it locked) or applied
+    """
+    reloader = main.ConfigReloader([], str(tmp_path / "print-client.conf"), interval=0)
+    mocker.patch.object(reloader, "_mtime_changed", return_value=True)
+    mocker.patch.object(reloader, "_file_args",
+                        side_effect=[PermissionError("locked"), [], []])
+
+    applied = []
+
+    def _apply_config(args):
+        applied.append(args)
+        if len(applied) == 1:
+            raise RuntimeError("Error!")
+        reloader.stop()
+        return {"printer"}
+
+    mocker.patch.object(main, "apply_config", side_effect=_apply_config)
+    reloader._run()
+
+    assert len(applied) == 2
+
+
+def test_subscribe_streams(mocker, monkeypatch):
+    """ Tests that callback threads are shared between parallel streaming pulls, each leasing no
+        more messages than it has threads, and that the channel gets the gRPC settings
+    """
+    main.ARGS = main.Config(main.parse_command_line_args(["--streams", "2",
+                                                          "--callback-threads", "5",
+                                                          "--keepalive", "5",
+                                                          "--compression", "gzip"]))
+    subscriber = mock.Mock()
+    futures = main.subscribe(subscriber, "projects/test/subscriptions/print_queue", print)
+
+    assert len(futures) == 2
+    calls = subscriber.subscribe.call_args_list
+    assert [call[1]["flow_control"].max_messages for call in calls] == [3, 2]
+    assert [call[1]["scheduler"]._executor._max_workers for call in calls] == [3, 2]
+
+    monkeypatch.setenv("PUBSUB_EMULATOR_HOST", "localhost:8085")
+    mock_channel = mocker.patch('grpc.insecure_channel')
+    mocker.patch('google.cloud.pubsub_v1.SubscriberClient')
+    main.subscriber_client()
+    options = dict(mock_channel.call_args[1]["options"])
+    assert options["grpc.keepalive_time_ms"] == 5000
+    assert options["grpc.max_receive_message_length"] == -1
+    assert mock_channel.call_args[1]["compression"] == main.grpc.Compression.Gzip
+
+
+def test_local_intake_hot_folder(mocker, tmp_path):
+    """ Tests that a job dropped in the hot folder is printed through the usual pipeline and then
+        deleted, that an unreadable job, or one for another client's order, is set aside rather
+        than retried, and that a .json file with no label beside it is left alone
+    """
+    mock_client = mocker.patch('google.cloud.firestore.Client')
+    mock_client.return_value.collection.return_value.where.return_value.stream.return_value = []
+    mock_print = mocker.patch.object(main, 'run_watched')
+    main.ARGS = main.Config(main.parse_command_line_args(["--hot-folder", str(tmp_path)]))
+    (tmp_path / "1234.pdf").write_bytes(TEST_LABEL)
+    (tmp_path / "1234.pdf.json").write_text(json.dumps({"order_number": 1234,
+                                                        "event_date": TEST_EVENT_DATE,
+                                                        "reprint": "true"}))
+    (tmp_path / "1235.pdf").write_bytes(TEST_LABEL)
+    (tmp_path / "1235.pdf.json").write_text("not json")
+    (tmp_path / "1237.json").write_text(json.dumps({"name": "Smith"}))
+
+    intake = main.LocalIntake(str(tmp_path))
+    intake.start()
+    intake._poll()
+    intake.stop()
+
+    mock_print.assert_called_once()
+    assert sorted(os.listdir(tmp_path)) == ["1235.pdf", "1235.pdf.json.invalid", "1237.json"]
+    record = mock_client.return_value.batch.return_value.set.call_args_list[0][0][1]
+    assert record["subscription"] == main.LOCAL_QUEUE
+    assert record["message_id"] == "hot-folder-1234.pdf"
+
+    main.ARGS = main.Config(main.parse_command_line_args(["--hot-folder", str(tmp_path),
+                                                          "--number", "odd"]))
+    (tmp_path / "1236.pdf").write_bytes(TEST_LABEL)
+    (tmp_path / "1236.pdf.json").write_text(json.dumps({"order_number": 1236,
+                                                        "event_date": TEST_EVENT_DATE}))
+    intake._print_file("1236.pdf.json")
     mock_print.assert_called_once()
+    assert "1236.pdf.json.invalid" in os.listdir(tmp_path)
+
+
+def test_local_intake_hot_folder_quarantine(mocker, tmp_path):
+    """ Tests that a hot folder job which keeps failing to print is quarantined under a usable
+        file name, and can be discarded from there, and that a later job with the same file name
+        starts counting its failures afresh
+    """
+    mock_client = mocker.patch('google.cloud.firestore.Client')
+    mock_client.return_value.collection.return_value.where.return_value.stream.return_value = []
+    mocker.patch.object(main, 'run_watched',
+                        side_effect=subprocess.CalledProcessError(cmd="gswin64.exe", returncode=1))
+    mocker.patch.object(time, "sleep")
+    hot_folder = tmp_path / "hot"
+    quarantine_dir = tmp_path / "quarantine"
+    main.ARGS = main.Config(main.parse_command_line_args(["--hot-folder", str(hot_folder),
+                                                          "--max-print-attempts", "2",
+                                                          "--quarantine-dir",
+                                                          str(quarantine_dir)]))
+    hot_folder.mkdir()
+    (hot_folder / "1234.pdf").write_bytes(TEST_LABEL)
+    (hot_folder / "1234.pdf.json").write_text(json.dumps({"order_number": 1234,
+                                                          "event_date": TEST_EVENT_DATE}))
+
+    intake = main.LocalIntake(str(hot_folder))
+    intake._print_file("1234.pdf.json")
+    assert sorted(os.listdir(hot_folder)) == ["1234.pdf", "1234.pdf.json"]
+    intake._print_file("1234.pdf.json")
+
+    assert os.listdir(hot_folder) == []
+    assert os.listdir(quarantine_dir) == ["hot-folder-1234.pdf.json"]
+    [label] = main.manage_quarantine("discard", [])
+    assert label["message_id"] == "hot-folder-1234.pdf"
+    assert os.listdir(quarantine_dir) == []
+
+    # a new job with the same file name gets its own attempts
+    (hot_folder / "1234.pdf").write_bytes(TEST_LABEL)
+    (hot_folder / "1234.pdf.json").write_text(json.dumps({"order_number": 1234,
+                                                          "event_date": TEST_EVENT_DATE}))
+    intake._print_file("1234.pdf.json")
+    assert sorted(os.listdir(hot_folder)) == ["1234.pdf", "1234.pdf.json"]
+    assert os.listdir(quarantine_dir) == []
+
+
+def test_local_intake_endpoint(mocker):
+    """ Tests that a label POSTed to the intake endpoint is printed before the response, and that
+        a job with invalid attributes, or for another client's order, is rejected
+    """
+    mock_client = mocker.patch('google.cloud.firestore.Client')
+    mock_client.return_value.collection.return_value.where.return_value.stream.return_value = []
+    mock_print = mocker.patch.object(main, 'run_watched')
+    main.ARGS = main.Config(main.parse_command_line_args([]))
+    with socket.socket() as free_port:
+        free_port.bind(("127.0.0.1", 0))
+        port = free_port.getsockname()[1]
+    intake = main.LocalIntake(port=port)
+    intake.start()
+    url = "http://127.0.0.1:%d/print?order_number=1234&event_date=%s" % (port, TEST_EVENT_DATE)
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=TEST_LABEL)) as response:
+            assert json.load(response)["outcome"] == "ack"
+        mock_print.assert_called_once()
+
+        request = urllib.request.Request(url.replace("1234", "twelve"), data=TEST_LABEL)
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(request)
+        assert error.value.code == 400
+        mock_print.assert_called_once()
+
+        main.ARGS = main.Config(main.parse_command_line_args(["--number", "odd"]))
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(urllib.request.Request(url, data=TEST_LABEL))
+        assert error.value.code == 422
+        assert "not this client's order" in json.load(error.value)["error"]
+        mock_print.assert_called_once()
+    finally:
+        intake.stop()
+
+
+def test_status_publisher(mocker):
+    """ Tests that the status holds the labels in hand, print rate, ETA and newest order printed,
+        and that an unchanged status is only republished as a heartbeat
+    """
+    main.ARGS = main.Config(main.parse_command_line_args([]))
+    publisher = mock.Mock()
+    status = main.StatusPublisher(publisher, "projects/test/topics/print_status")
+    for queue_name in ("kitchen", "kitchen", "pickup"):
+        status.received(queue_name)
+    status.printed(TEST_EVENT_DATE, 12)
+    status.printed(TEST_EVENT_DATE, 11)
+    status.done("pickup")
+
+    current = status.status()
+    assert current["in_hand"] == 2 and current["queues"] == {"kitchen": 2}
+    assert current["printers"]["default_printer"]["in_hand"] == 2
+    assert current["rate"] == 2.0
+    assert current["newest"] == {"event_date": TEST_EVENT_DATE, "order_number": 12}
+    eta = current["printers"]["default_printer"]["eta"]
+    assert datetime.datetime.fromisoformat(eta) > datetime.datetime.now(datetime.timezone.utc)
+
+    for _ in range(status.HEARTBEAT + 1):
+        status.publish()
+    assert publisher.publish.call_count == 2
+    published = json.loads(publisher.publish.call_args[0][1])
+    assert published["in_hand"] == 2 and "time" in published
+
+
+def test_memory_watchdog_recycles(mocker, monkeypatch, tmp_path):
+    """ Tests that temp files left behind are deleted where possible, that allocation growth is
+        logged when tracing memory, and that crossing a limit drains the client to be restarted
+    """
+    monkeypatch.setattr(main.tempfile, "tempdir", str(tmp_path))
+    with main.WinNamedTempFile() as in_use:
+        (tmp_path / f"{main.WinNamedTempFile.PREFIX}leaked").write_bytes(b"%PDF")
+        # a directory can't be unlinked, so stands in for a file Ghostscript still has open
+        (tmp_path / f"{main.WinNamedTempFile.PREFIX}stuck").mkdir()
+        watchdog = main.MemoryWatchdog(max_temp_files=1, trace_frames=1)
+        watchdog.start()
+        rss, handles, temp_files = watchdog.check()
+        watchdog.stop()
+
+        assert os.path.exists(in_use.name)
+    assert sorted(os.listdir(tmp_path)) == [f"{main.WinNamedTempFile.PREFIX}stuck"]
+    assert rss > 0 and handles > 0 and temp_files == 1
+    assert not main.RECYCLE.is_set()
+
+    watchdog.max_rss_mb = 1
+    watchdog.check()
+    assert main.RECYCLE.is_set() and main.SHUTDOWN.is_set()
+
+    subscription = mock.Mock()
+    subscription.name = "projects/print-client-123456/subscriptions/print_queue"
+    mock_sc = mocker.patch('google.cloud.pubsub_v1.SubscriberClient')
+    mock_sc.return_value.subscription_path.return_value = subscription.name
+    mock_sc.return_value.list_subscriptions.return_value = [subscription]
+    mocker.patch.object(main, "block", side_effect=lambda: main.request_recycle("test"))
+    with pytest.raises(SystemExit) as exited:
+        main.main(["--readiness-interval", "0", "--watchdog-interval", "0"])
+    assert exited.value.code == main.RECYCLE_EXIT_CODE
+
+
+def test_temp_file_in_use_once_created(mocker, monkeypatch, tmp_path):
+    """ Tests that a sweep for temp files left behind never sees one that has just been created
+        but is about to be used
+    """
+    monkeypatch.setattr(main.tempfile, "tempdir", str(tmp_path))
+    named_temporary_file = main.tempfile.NamedTemporaryFile
+    swept = []
+    sweeps = []
+
+    def _create(**kwargs):
+        created = named_temporary_file(**kwargs)
+        sweeps.append(threading.Thread(
+            target=lambda: swept.append(main.WinNamedTempFile.left_behind())))
+        sweeps[0].start()
+        sweeps[0].join(0.1)
+        return created
+
+    mocker.patch.object(main.tempfile, "NamedTemporaryFile", side_effect=_create)
+    with main.WinNamedTempFile():
+        sweeps[0].join()
+    assert swept == [[]]
+
+
+def test_render_cost_model(mocker, tmp_path):
+    """ Tests that a fitted render cost model predicts print time from PDF features, and that the
+        client uses it for print timeouts, the Ghostscript profile and sharing the printer
+    """
+    samples = [({"pages": pages, "megapixels": megapixels}, 0.2 + 0.05 * pages + 0.3 * megapixels)
+               for pages, megapixels in [(1, 0), (2, 0), (4, 0), (1, 1.5), (1, 6), (3, 1.5)]]
+    fast = main.RenderCostModel.fit(samples, "-r203 -dNumRenderingThreads=4")
+    assert fast.intercept == pytest.approx(0.2)
+    assert fast.coefficients == pytest.approx({"pages": 0.05, "megapixels": 0.3})
+    path = tmp_path / "render-cost.json"
+    path.write_text(json.dumps({"fastest": "fast",
+                                "profiles": {"fast": fast.to_dict(),
+                                             "slow": main.RenderCostModel(9, {}).to_dict()}}))
+
+    main.ARGS = main.Config(main.parse_command_line_args(["--print-timeout", "20"]))
+    main.COST_MODEL = main.RenderCostModel.load(str(path))
+    try:
+        label_seconds = main.COST_MODEL.predict(TEST_LABEL)
+        assert label_seconds == pytest.approx(0.2 + 0.05 * main.count_pages(TEST_LABEL))
+        assert main.print_timeout(TEST_LABEL) == \
+            pytest.approx(20 + main.COST_TIMEOUT_FACTOR * label_seconds)
+        assert main.RenderCostModel.load(str(path), "slow").predict(TEST_LABEL) == 9
+        assert main.RenderCostModel(-1, {}).predict(TEST_LABEL) == main.RenderCostModel.MIN_SECONDS
+
+        mock_run = mocker.patch.object(main, 'run_watched')
+        main.print_pdf("default_printer", TEST_LABEL)
+        assert "-dPDFFitPage -r203 -dNumRenderingThreads=4 -sDEVICE=mswinpr2" in \
+            mock_run.call_args[0][0]
+    finally:
+        main.COST_MODEL = None
+
+    scheduler = main.WeightedFairScheduler({"kitchen": 1, "pickup": 1}, slots=1)
+    with scheduler.slot("kitchen", cost=4.0):
+        pass
+    with scheduler.slot("pickup", cost=1.0):
+        pass
+    assert scheduler._pass == {"kitchen": 4.0, "pickup": 1.0}